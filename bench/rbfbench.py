@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+"""@package rbfbench
+Benchmarks For RootFS Build Factory
+
+Builds a repository of synthetic rpms, serves it on localhost & times builds of a template against it, stage by stage
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import platform
+import threading
+import subprocess
+import xml.dom.minidom
+try:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+RBF_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RbfBenchServer(ThreadingMixIn, HTTPServer):
+    """RbfBenchServer Class.
+
+    HTTP server for the synthetic repository, standing in for the mirror templates point to
+    """
+    daemon_threads = True
+
+class RbfBenchHandler(SimpleHTTPRequestHandler):
+    """RbfBenchHandler Class.
+
+    Serves files of the repository directory instead of the current directory & logs nothing
+    """
+    root = None
+
+    def translate_path(self, path):
+        """Returns path of requested file in the repository directory"""
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        """Requests are not logged"""
+        return
+
+class RbfBenchRepo():
+    """RbfBenchRepo Class.
+
+    Repository of count noarch rpms, each holding size K of data, & a comps group holding half of them.
+    Payloads are derived from seed, so the same settings always give the same repository. Repositories are kept
+    & reused, building them is not part of the benchmark
+    """
+    NAME = "rbfbench"
+    COMPS_GROUP = "rbfbench"
+
+    def __init__(self, benchDir, count, size, seed):
+        """Constructor for RbfBenchRepo"""
+        self.count = count
+        self.size = size
+        self.seed = seed
+        self.repoDir = os.path.join(benchDir, "repos", str(count) + "x" + str(size) + "K-" + str(seed))
+        self.packages = [RbfBenchRepo.NAME + "-" + str(i) for i in range(0, count)]
+
+    def getPayload(self, package):
+        """Returns size K of reproducible data. Half random, half text, so compression has work to do"""
+        randomSize = self.size*512
+        blocks = []
+        for i in range(0, (randomSize + 31)//32):
+            blocks.append(hashlib.sha256((str(self.seed) + package + str(i)).encode("utf-8")).digest())
+        text = (package + " synthetic payload for rootfs build factory benchmarks\n").encode("utf-8")
+        return b"".join(blocks)[0:randomSize] + (text*(self.size*512//len(text) + 1))[0:self.size*1024 - randomSize]
+
+    def getSpec(self):
+        """Returns spec file building every package as a subpackage, so a single rpmbuild run builds the repository"""
+        spec = "Name: " + RbfBenchRepo.NAME + "\nVersion: 1.0\nRelease: 1\nSummary: Synthetic packages for rbf benchmarks\n"
+        spec = spec + "License: GPLv3\nBuildArch: noarch\n"
+        for i in range(0, self.count):
+            spec = spec + "Source" + str(i) + ": " + self.packages[i] + ".dat\n"
+        spec = spec + "\n%description\nSynthetic packages for rbf benchmarks\n"
+        for package in self.packages:
+            spec = spec + "\n%package -n " + package + "\nSummary: Synthetic package " + package + "\n\n%description -n " + package + "\nSynthetic package " + package + "\n"
+        spec = spec + "\n%prep\n\n%build\n\n%install\n"
+        for i in range(0, self.count):
+            spec = spec + "install -D -m 644 %{SOURCE" + str(i) + "} %{buildroot}/usr/share/" + RbfBenchRepo.NAME + "/" + self.packages[i] + ".dat\n"
+        for package in self.packages:
+            spec = spec + "\n%files -n " + package + "\n/usr/share/" + RbfBenchRepo.NAME + "/" + package + ".dat\n"
+        return spec
+
+    def getComps(self):
+        """Returns comps file with a group of the first half of the packages"""
+        comps = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<!DOCTYPE comps PUBLIC \"-//CentOS//DTD Comps info//EN\" \"comps.dtd\">\n<comps>\n"
+        comps = comps + "  <group>\n    <id>" + RbfBenchRepo.COMPS_GROUP + "</id>\n    <name>RBF Bench</name>\n    <description>Synthetic packages for rbf benchmarks</description>\n"
+        comps = comps + "    <default>true</default>\n    <uservisible>true</uservisible>\n    <packagelist>\n"
+        for package in self.getGroupPackages():
+            comps = comps + "      <packagereq type=\"mandatory\">" + package + "</packagereq>\n"
+        return comps + "    </packagelist>\n  </group>\n</comps>\n"
+
+    def getGroupPackages(self):
+        """Returns packages installed through the comps group"""
+        return self.packages[0:self.count//2]
+
+    def getExtraPackages(self):
+        """Returns packages installed by name"""
+        return self.packages[self.count//2:]
+
+    def create(self):
+        """Builds repository unless it exists. Returns repository directory"""
+        if os.path.exists(os.path.join(self.repoDir, "repodata", "repomd.xml")):
+            sys.stdout.write("Reusing Repository: " + self.repoDir + "\n")
+            return self.repoDir
+        createrepo = [c for c in ["createrepo_c", "createrepo"] if self.findCommand(c)]
+        if not self.findCommand("rpmbuild") or len(createrepo) == 0:
+            raise ValueError("Building The Repository Needs rpmbuild & createrepo_c Or createrepo")
+        sys.stdout.write("Building Repository Of " + str(self.count) + " Packages Of " + str(self.size) + "K: " + self.repoDir + "\n")
+        topDir = self.repoDir + ".build"
+        shutil.rmtree(topDir, True)
+        sourceDir = os.path.join(topDir, "SOURCES")
+        os.makedirs(sourceDir)
+        for package in self.packages:
+            payload = open(os.path.join(sourceDir, package + ".dat"), "wb")
+            payload.write(self.getPayload(package))
+            payload.close()
+        specPath = os.path.join(topDir, RbfBenchRepo.NAME + ".spec")
+        spec = open(specPath, "w")
+        spec.write(self.getSpec())
+        spec.close()
+        buildLog = open(topDir + ".log", "w")
+        buildRet = subprocess.call(["rpmbuild", "-bb", "--define", "_topdir " + topDir, specPath], stdout=buildLog, stderr=subprocess.STDOUT)
+        buildLog.close()
+        if buildRet != 0:
+            raise ValueError("rpmbuild Failed. Log: " + topDir + ".log")
+        shutil.rmtree(self.repoDir, True)
+        shutil.move(os.path.join(topDir, "RPMS", "noarch"), self.repoDir)
+        compsPath = os.path.join(topDir, "comps.xml")
+        comps = open(compsPath, "w")
+        comps.write(self.getComps())
+        comps.close()
+        if subprocess.call([createrepo[0], "-q", "-g", compsPath, self.repoDir]) != 0:
+            raise ValueError(createrepo[0] + " Failed For " + self.repoDir)
+        shutil.rmtree(topDir, True)
+        return self.repoDir
+
+    def findCommand(self, command):
+        """Returns True if command is in PATH"""
+        return len([p for p in os.environ.get("PATH", "").split(os.pathsep) if os.access(os.path.join(p, command), os.X_OK)]) != 0
+
+class RbfBench():
+    """RbfBench Class.
+
+    Writes a copy of the template using only the local repository & times builds of it. The first run starts with
+    an empty package cache, later runs reuse it, so cache, snapshot & prefetch wins show up. Per stage wall times are
+    taken from report.json of every build & compared with a baseline
+    """
+    DEFAULT_THRESHOLD = 10
+    MIN_DIFFERENCE = 0.5
+
+    def __init__(self, benchDir, repo, template, runs, flags):
+        """Constructor for RbfBench"""
+        self.benchDir = benchDir
+        self.repo = repo
+        self.template = template
+        self.runs = runs
+        self.flags = flags
+        self.cacheDir = os.path.join(benchDir, "cache")
+        self.templatePath = os.path.join(benchDir, "bench.xml")
+
+    def writeTemplate(self, repoUrl):
+        """Writes template with the local repository, its packages & no kernel. Everything else is kept"""
+        dom = xml.dom.minidom.parse(self.template)
+        setElement = lambda parent, tag, attributes, text: self.setElement(dom, parent, tag, attributes, text)
+        root = dom.documentElement
+        for tag in ["repos", "packages", "cache", "prefetch"]:
+            for e in root.getElementsByTagName(tag):
+                e.parentNode.removeChild(e)
+        repos = setElement(root, "repos", {}, None)
+        setElement(repos, "repo", {"name": RbfBenchRepo.NAME, "path": repoUrl}, None)
+        packages = setElement(root, "packages", {}, None)
+        setElement(packages, "group", {}, "@" + RbfBenchRepo.COMPS_GROUP)
+        for package in self.repo.getExtraPackages():
+            setElement(packages, "package", {}, package)
+        setElement(root, "cache", {"path": os.path.abspath(self.cacheDir)}, None)
+        setElement(root, "prefetch", {}, None)
+        for k in root.getElementsByTagName("kernel"):
+            """Synthetic repositories have no kernel"""
+            k.setAttribute("type", "none")
+        for i in root.getElementsByTagName("image"):
+            i.setAttribute("path", "bench.img")
+        templateFile = open(self.templatePath, "w")
+        templateFile.write(dom.toxml())
+        templateFile.close()
+
+    def setElement(self, dom, parent, tag, attributes, text):
+        """Appends element to parent. Returns element"""
+        element = dom.createElement(tag)
+        for name in attributes:
+            element.setAttribute(name, attributes[name])
+        if text != None:
+            element.appendChild(dom.createTextNode(text))
+        parent.appendChild(element)
+        return element
+
+    def build(self, name):
+        """Builds template in a fresh workspace. Returns result of the run"""
+        workspace = os.path.join(self.benchDir, "runs", name)
+        shutil.rmtree(workspace, True)
+        os.makedirs(workspace)
+        sys.stdout.write("Run " + name + ": " + workspace + "\n")
+        sys.stdout.flush()
+        startTime = time.time()
+        consoleLog = open(os.path.join(workspace, "console.log"), "w")
+        buildRet = subprocess.call([sys.executable, os.path.join(RBF_DIR, "rbf.py"), "build", os.path.abspath(self.templatePath), "--workspace", os.path.abspath(workspace), "--non-interactive"] + self.flags, stdout=consoleLog, stderr=subprocess.STDOUT, stdin=open(os.devnull), cwd=RBF_DIR)
+        consoleLog.close()
+        result = {"name": name, "exitCode": buildRet, "wallTime": round(time.time() - startTime, 3), "stages": {}}
+        reportPath = os.path.join(workspace, "report.json")
+        if os.path.exists(reportPath):
+            reportFile = open(reportPath)
+            report = json.load(reportFile)
+            reportFile.close()
+            for entry in report.get("stages", []):
+                """Retried stages count with all their attempts"""
+                result["stages"][entry["stage"]] = round(result["stages"].get(entry["stage"], 0) + entry["wallTime"], 3)
+        statusPath = os.path.join(workspace, "status.json")
+        if os.path.exists(statusPath):
+            statusFile = open(statusPath)
+            result["status"] = json.load(statusFile).get("status", "")
+            statusFile.close()
+        sys.stdout.write("Run " + name + ": Exit Code " + str(buildRet) + " In " + str(round(result["wallTime"], 1)) + "s. Log: " + os.path.join(workspace, "console.log") + "\n")
+        return result
+
+    def run(self):
+        """Serves repository, runs builds & removes their images. Returns results"""
+        RbfBenchHandler.root = self.repo.create()
+        server = RbfBenchServer(("127.0.0.1", 0), RbfBenchHandler)
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+        repoUrl = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+        sys.stdout.write("Serving Repository At " + repoUrl + "\n")
+        results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "host": platform.node(), "cpus": os.sysconf("SC_NPROCESSORS_ONLN"), "python": platform.python_version(),
+                   "settings": {"template": self.template, "packages": self.repo.count, "size": self.repo.size, "seed": self.repo.seed, "flags": self.flags}, "runs": []}
+        try:
+            self.writeTemplate(repoUrl)
+            shutil.rmtree(self.cacheDir, True)
+            for i in range(0, self.runs):
+                name = ["cold", "warm"][i > 0]
+                if i > 1:
+                    name = name + str(i)
+                results["runs"].append(self.build(name))
+                imagePath = os.path.join(self.benchDir, "runs", name, "bench.img")
+                if os.path.exists(imagePath):
+                    os.remove(imagePath)
+        finally:
+            server.shutdown()
+            server.server_close()
+        return results
+
+def compareResults(results, baseline, threshold):
+    """Prints stage times of every run next to the baseline. Returns number of regressions"""
+    regressions = 0
+    baselineRuns = dict([(r["name"], r) for r in baseline.get("runs", [])])
+    for run in results["runs"]:
+        baseRun = baselineRuns.get(run["name"], {"stages": {}, "wallTime": None})
+        sys.stdout.write("\n" + run["name"] + ": Exit Code " + str(run["exitCode"]) + "\n")
+        sys.stdout.write("  " + "Stage".ljust(24) + "Now".rjust(10) + "Baseline".rjust(10) + "Change".rjust(10) + "\n")
+        rows = sorted(run["stages"].items(), key=lambda s: s[1], reverse=True) + [("Total", run["wallTime"])]
+        for stage, wallTime in rows:
+            baseTime = baseRun["stages"].get(stage)
+            if stage == "Total":
+                baseTime = baseRun["wallTime"]
+            line = "  " + stage.ljust(24) + (str(round(wallTime, 1)) + "s").rjust(10)
+            if baseTime == None:
+                sys.stdout.write(line + "-".rjust(10) + "\n")
+                continue
+            change = 100.0*(wallTime - baseTime)/max(baseTime, 0.001)
+            line = line + (str(round(baseTime, 1)) + "s").rjust(10) + (("+" if change > 0 else "") + str(round(change)) + "%").rjust(10)
+            if change > threshold and wallTime - baseTime > RbfBench.MIN_DIFFERENCE:
+                line = line + "  REGRESSION"
+                regressions = regressions + 1
+            elif change < -threshold and baseTime - wallTime > RbfBench.MIN_DIFFERENCE:
+                line = line + "  FASTER"
+            sys.stdout.write(line + "\n")
+    return regressions
+
+def parseArguments(argv):
+    """Splits command line arguments into options. Returns None on unknown option"""
+    options = {"--packages": "200", "--size": "256", "--seed": "1", "--runs": "2", "--threshold": str(RbfBench.DEFAULT_THRESHOLD), "--template": os.path.join(RBF_DIR, "templates", "qemu.xml"),
+               "--benchdir": os.path.join(RBF_DIR, "bench", "work"), "--baseline": os.path.join(RBF_DIR, "bench", "baseline.json"), "--save-baseline": False, "--loopfree": False}
+    i = 0
+    while i < len(argv):
+        if argv[i] in ["--save-baseline", "--loopfree"]:
+            options[argv[i]] = True
+            i = i + 1
+        elif argv[i] in options and i + 1 < len(argv):
+            options[argv[i]] = argv[i + 1]
+            i = i + 2
+        else:
+            return None
+    for option in ["--packages", "--size", "--seed", "--runs", "--threshold"]:
+        if not options[option].isdigit():
+            return None
+    return options
+
+if __name__ == "__main__":
+    """rbfbench.py [--packages N] [--size K] [--seed N] [--runs N] [--template xml] [--benchdir dir] [--baseline json] [--threshold %] [--save-baseline] [--loopfree]"""
+    options = parseArguments(sys.argv[1:])
+    if options == None or int(options["--runs"]) < 1 or int(options["--packages"]) < 2:
+        sys.stderr.write("Usage: rbfbench.py [--packages N] [--size K] [--seed N] [--runs N] [--template xml] [--benchdir dir] [--baseline json] [--threshold %] [--save-baseline] [--loopfree]\n")
+        sys.exit(1)
+    benchDir = options["--benchdir"]
+    if not os.path.isdir(benchDir):
+        os.makedirs(benchDir)
+    repo = RbfBenchRepo(benchDir, int(options["--packages"]), int(options["--size"]), int(options["--seed"]))
+    flags = [flag for flag in ["--loopfree"] if options[flag]]
+    try:
+        results = RbfBench(benchDir, repo, os.path.abspath(options["--template"]), int(options["--runs"]), flags).run()
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
+    resultsPath = os.path.join(benchDir, "results-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    resultsFile = open(resultsPath, "w")
+    json.dump(results, resultsFile, indent=2, sort_keys=True)
+    resultsFile.close()
+    sys.stdout.write("Results: " + resultsPath + "\n")
+    baseline = {}
+    if os.path.exists(options["--baseline"]):
+        baselineFile = open(options["--baseline"])
+        baseline = json.load(baselineFile)
+        baselineFile.close()
+        if baseline.get("settings", {}).get("packages") != repo.count or baseline.get("settings", {}).get("size") != repo.size:
+            sys.stdout.write("Baseline " + options["--baseline"] + " Was Taken With Other Package Settings\n")
+    elif not options["--save-baseline"]:
+        sys.stdout.write("No Baseline " + options["--baseline"] + ". Use --save-baseline\n")
+    regressions = compareResults(results, baseline, int(options["--threshold"]))
+    if options["--save-baseline"]:
+        shutil.copy(resultsPath, options["--baseline"])
+        sys.stdout.write("Saved Baseline: " + options["--baseline"] + "\n")
+    failed = [r["name"] for r in results["runs"] if r["exitCode"] != 0]
+    if len(failed) != 0:
+        sys.stdout.write("Failed Runs: " + " ".join(failed) + "\n")
+    sys.stdout.write(str(regressions) + " Regressions\n")
+    sys.exit(int(len(failed) != 0 or regressions != 0))
@@ -0,0 +1,13 @@
+#!/usr/bin/bash
+UBOOT=$1
+DEVICE=$2
+
+#Enter Custom Commands Below
+if [ "$UBOOT" == "" ]; then
+    echo "U-Boot Image Not Given. Use --uboot"
+    exit 1
+fi
+echo "Writing U-Boot Image To $DEVICE"
+dd if=$UBOOT of=$DEVICE bs=1024 seek=8 conv=fsync,notrunc
+
+exit 0
@@ -13,23 +13,74 @@ import platform
 import logging
 import uuid
 import errno
+import hashlib
+import time
+import shutil
+import fcntl
+import glob
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from xml.dom.minidom import parse
 import xml.dom.minidom
-from rbfutils import RbfUtils
+from rbfutils import RbfUtils, RbfPartitionTable
+from rbfcache import RbfCache
+from rbfexecutor import RbfStage, RbfExecutor
+from rbfbackend import RbfPackageBackend, RbfYumBackend, RbfDnfBackend
+from rbflint import RbfTemplateLinter
+from rbfdelta import RbfDelta
+from rbfflash import RbfMultiFlasher
 
 def printUsage():
-   logging.info("./rbf.py <parse|build> <xmlTemplate.xml>")
+   logging.info("./rbf.py <parse|build> <xmlTemplate.xml> [--workspace dir] [--loopfree] [--resume] [--non-interactive]. Default workspace is builds/<template name>")
+   logging.info("./rbf.py build-many <xmlTemplate.xml>... [--jobs N] [--loopfree] [--resume] [--non-interactive]. Expands matrix templates")
+   logging.info("./rbf.py lint <xmlTemplate.xml>... [--jobs N]. Needs no root & writes no files")
+   logging.info("./rbf.py delta <old.img> <new.img> [delta]. Default delta is <new.img>.delta")
+   logging.info("./rbf.py delta-apply <old.img> <delta> <new.img>. Rebuilds & verifies new image. Also rbfdelta.py apply on the board")
+   logging.info("./rbf.py flash <image.img> <device>... [--board name] [--uboot file] [--allow-file]. Flashes & verifies all devices at once, then runs boards.d/<board>-flash.sh <uboot> <device> for each. Devices must be block devices unless --allow-file")
 
-def initLogging():
-    """Initialize Logging"""   
+def parseArguments(argv):
+    """Splits command line arguments into positional arguments & options. Returns None on unknown option"""
+    options = {"--workspace": None, "--jobs": None, "--board": None, "--uboot": None}
+    flags = ["--loopfree", "--resume", "--non-interactive", "--allow-file"]
+    for flag in flags:
+        options[flag] = False
+    positional = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in flags:
+            options[argv[i]] = True
+            i = i + 1
+        elif argv[i] in options:
+            if i + 1 == len(argv):
+                return None
+            options[argv[i]] = argv[i+1]
+            i = i + 2
+        elif argv[i].startswith("--"):
+            return None
+        else:
+            positional.append(argv[i])
+            i = i + 1
+    return positional, options
+
+def getDefaultWorkspace(xmlTemplate):
+    """Returns default workspace for a template"""
+    return os.path.join("builds", os.path.splitext(os.path.basename(xmlTemplate))[0])
+
+def initLogging(workspace):
+    """Initialize Logging. Logs only to console if workspace is None"""   
     logFormatter = logging.Formatter("[%(levelname)-5.5s]  %(message)s")
     rootLogger = logging.getLogger()
     rootLogger.setLevel(logging.INFO)
-    if os.path.exists("rbf.log"):
-        os.remove("rbf.log")
-    fileHandler = logging.FileHandler("rbf.log")
-    fileHandler.setFormatter(logFormatter)    
-    rootLogger.addHandler(fileHandler)
+    if workspace != None:
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        logFile = os.path.join(workspace, "rbf.log")
+        if os.path.exists(logFile):
+            os.remove(logFile)
+        fileHandler = logging.FileHandler(logFile)
+        fileHandler.setFormatter(logFormatter)    
+        rootLogger.addHandler(fileHandler)
     
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
@@ -78,14 +129,206 @@ def checkCommandExistsAccess(commandList):
         return False
 
 
+def buildTemplate(xmlTemplate, workspace, flags):
+    """Builds a single template in a child rbf.py process. flags are passed on to it. Returns exit code & duration"""
+    startTime = time.time()
+    if not os.path.isdir(workspace):
+        os.makedirs(workspace)
+    logging.info("Building " + xmlTemplate + " in workspace " + workspace)
+    consoleLog = open(os.path.join(workspace, "console.log"), "w")
+    buildCommand = [sys.executable, os.path.abspath(__file__), "build", xmlTemplate, "--workspace", workspace] + flags
+    buildRet = subprocess.call(buildCommand, stdout=consoleLog, stderr=subprocess.STDOUT)
+    consoleLog.close()
+    duration = time.time() - startTime
+    logging.info("Finished " + xmlTemplate + " Exit Code: " + str(buildRet) + " Duration: " + str(int(duration)) + "s")
+    return buildRet, duration
+
+def getPackageKey(dom):
+    """Returns hash of the tags that decide the installed packages. Builds with the same key share a rootfs snapshot"""
+    packageInputs = []
+    for tag in ["distro", "repos", "packages", "cache"]:
+        for x in dom.getElementsByTagName(tag):
+            packageInputs.append(x.toxml())
+    for k in dom.getElementsByTagName("kernel"):
+        packageInputs.append(k.getAttribute("type"))
+    return hashlib.sha1("\n".join(packageInputs).encode("utf-8")).hexdigest()
+
+def getBuildJobs(xmlTemplates):
+    """Expands matrix templates. Variant templates are written to their workspace. Returns List of (name, template, workspace, package key)"""
+    rbfUtils = RbfUtils()
+    buildJobs = []
+    workspaces = []
+    for xmlTemplate in xmlTemplates:
+        try:
+            variants = rbfUtils.getMatrixVariants(xmlTemplate)
+            if variants == None:
+                variants = [(None, rbfUtils.loadTemplate(xmlTemplate))]
+        except Exception as e:
+            logging.error("Error Parsing XML Template File " + xmlTemplate + ": " + str(e))
+            sys.exit(BoardTemplateParser.ERROR_PARSING_XML)
+        for name, dom in variants:
+            workspace = getDefaultWorkspace(xmlTemplate)
+            if name != None:
+                workspace = workspace + "-" + name
+            suffix = 1
+            baseWorkspace = workspace
+            while workspace in workspaces:
+                suffix = suffix + 1
+                workspace = baseWorkspace + "-" + str(suffix)
+            workspaces.append(workspace)
+            if name == None:
+                buildJobs.append((xmlTemplate, xmlTemplate, workspace, getPackageKey(dom)))
+                continue
+            if not os.path.isdir(workspace):
+                os.makedirs(workspace)
+            variantTemplate = os.path.join(workspace, "template.xml")
+            variantFile = open(variantTemplate, "w")
+            variantFile.write(dom.toxml())
+            variantFile.close()
+            logging.info("Matrix " + xmlTemplate + " Variant " + name + ": " + variantTemplate)
+            buildJobs.append((xmlTemplate + ":" + name, variantTemplate, workspace, getPackageKey(dom)))
+    return buildJobs
+
+def buildMany(xmlTemplates, jobs, flags):
+    """Builds several templates & matrix variants concurrently, each in its own workspace. Returns exit code
+
+    Builds that install the same packages are grouped. One build per group runs first & saves the rootfs snapshot,
+    the others restore it instead of running yum"""
+    buildJobs = getBuildJobs(xmlTemplates)
+    seeds = []
+    followers = []
+    packageKeys = []
+    for buildJob in buildJobs:
+        if buildJob[3] in packageKeys:
+            followers.append(buildJob)
+        else:
+            packageKeys.append(buildJob[3])
+            seeds.append(buildJob)
+
+    logging.info("Building " + str(len(buildJobs)) + " Templates With " + str(jobs) + " Jobs. " + str(len(seeds)) + " Package Sets")
+    pool = ThreadPool(jobs)
+    results = pool.map(lambda t: buildTemplate(t[1], t[2], flags), seeds)
+    results = results + pool.map(lambda t: buildTemplate(t[1], t[2], flags), followers)
+    pool.close()
+    pool.join()
+
+    buildManyRet = 0
+    logging.info("Build Summary:")
+    buildJobs = seeds + followers
+    for i in range(0, len(buildJobs)):
+        buildRet, duration = results[i]
+        if buildRet == 0:
+            status = "OK"
+        else:
+            status = "FAILED (" + str(buildRet) + ")"
+            buildManyRet = BoardTemplateParser.BUILD_MANY_ERROR
+        logging.info("  " + buildJobs[i][0] + " " + status + " " + str(int(duration)) + "s " + buildJobs[i][2])
+    return buildManyRet
+
+def lintTemplate(xmlTemplate):
+    """Lints a single template. Returns List of errors"""
+    if not os.path.exists(xmlTemplate):
+        return ["XML Template Not Found"]
+    try:
+        variants = RbfUtils().getMatrixVariants(xmlTemplate)
+    except Exception as e:
+        return ["Error Parsing XML Template File: " + str(e)]
+    if variants == None:
+        return RbfTemplateLinter(xmlTemplate).lint()
+    errors = []
+    for name, dom in variants:
+        errors = errors + [name + ": " + e for e in RbfTemplateLinter(xmlTemplate, dom).lint()]
+    return errors
+
+def lintMany(xmlTemplates, jobs):
+    """Lints templates concurrently & reports all errors of each template. Returns exit code"""
+    pool = ThreadPool(jobs)
+    results = pool.map(lintTemplate, xmlTemplates)
+    pool.close()
+    pool.join()
+
+    lintRet = 0
+    for i in range(0, len(xmlTemplates)):
+        if len(results[i]) == 0:
+            logging.info(xmlTemplates[i] + ": OK")
+            continue
+        lintRet = BoardTemplateParser.LINT_ERROR
+        for error in results[i]:
+            logging.error(xmlTemplates[i] + ": " + error)
+    logging.info("Linted " + str(len(xmlTemplates)) + " Templates. " + str(len([r for r in results if len(r) != 0])) + " With Errors")
+    return lintRet
+
+def deltaImages(action, paths):
+    """Writes delta between old & new image or rebuilds new image from old image & delta. Returns exit code"""
+    for path in paths[0:2]:
+        if not os.path.exists(path):
+            logging.error("Image Or Delta Not Found: " + path)
+            return BoardTemplateParser.DELTA_ERROR
+    try:
+        if action == "delta":
+            deltaPath = paths[1] + ".delta"
+            if len(paths) == 3:
+                deltaPath = paths[2]
+            logging.info("Writing Delta From " + paths[0] + " To " + paths[1] + ": " + deltaPath)
+            RbfDelta(paths[0], paths[1]).create(deltaPath)
+        else:
+            logging.info("Rebuilding " + paths[2] + " From " + paths[0] + " & " + paths[1])
+            RbfDelta(paths[0], paths[2]).apply(paths[1])
+    except (ValueError, IOError, OSError) as e:
+        logging.error("Delta Failed: " + str(e))
+        return BoardTemplateParser.DELTA_ERROR
+    return 0
+
+def flashImage(imagePath, devicePaths, board, ubootPath, allowFile):
+    """Writes image to all devices at once, verifies them & runs the flash hook of board for each. Devices may be existing files with allowFile. Returns exit code"""
+    if not os.path.isfile(imagePath):
+        logging.error("Image Not Found: " + imagePath)
+        return BoardTemplateParser.FLASH_ERROR
+    bmapPath = None
+    if os.path.exists(imagePath + ".bmap"):
+        bmapPath = imagePath + ".bmap"
+    else:
+        logging.info("No Block Map " + imagePath + ".bmap. Mapping Image")
+    hook = None
+    if board != None:
+        hookPath = os.path.join("boards.d", board + "-flash.sh")
+        if not os.path.isfile(hookPath):
+            logging.error("Board Flash Hook Not Found: " + hookPath)
+            return BoardTemplateParser.FLASH_ERROR
+        logging.info("Board Flash Hook: " + hookPath)
+        hook = ["./" + hookPath, ubootPath or ""]
+    try:
+        results = RbfMultiFlasher(imagePath, devicePaths, bmapPath, hook, allowFile).flash()
+    except (ValueError, IOError, OSError) as e:
+        logging.error("Flash Failed: " + str(e))
+        return BoardTemplateParser.FLASH_ERROR
+    flashRet = 0
+    for devicePath in devicePaths:
+        if results[devicePath]["error"] != None:
+            logging.error("Flashing " + devicePath + " Failed: " + results[devicePath]["error"])
+            flashRet = BoardTemplateParser.FLASH_ERROR
+    return flashRet
+
 class BoardTemplateParser():
     """BoardTemplateParser Class.
     
     Parses XML Template and performs required actions on image file
     """
-    INDEX, SIZE, BEGIN, PTYPE, FS, MOUNTPOINT, UUID = range (0,7)
-    INCORRECT_ARGUMENTS, ERROR_PARSING_XML, ERROR_IMAGE_FILE, INVALID_PARTITION_DATA, NO_PACKAGES, NO_KERNEL_TYPE, INCORRECT_REPOSITORY, IMAGE_EXISTS, NO_UBOOT, LOGICAL_PART_ERROR, PRIMARY_PART_ERROR, PARTITION_SIZES_ERROR, FSTAB_ERROR, CLEANUP_ERROR, NOT_ROOT, COMMANDS_NOT_FOUND, SYS_MKFS_COMMANDS_NOT_FOUND, NO_FIRMWARE_FOUND, TEMPLATE_NOT_FOUND, TOTAL_PARTITIONS_ERROR = range(100,120)    
-    LOOP_DEVICE_EXISTS, FALLOCATE_ERROR, PARTED_ERROR, LOOP_DEVICE_CREATE_ERROR, PARTITION_DOES_NOT_EXIST, MOUNTING_ERROR, WRITE_REPO_ERROR, COPY_KERNEL_ERROR, COPY_FIRMWARE_ERROR, RPMDB_INIT_ERROR, GROUP_INSTALL_ERROR, PACKAGE_INSTALL_ERROR, ETC_OVERLAY_ERROR, ROOT_PASS_ERROR, SELINUX_ERROR, BOARD_SCRIPT_ERROR, FINALIZE_SCRIPT_ERROR, EXTLINUXCONF_ERROR, NO_ETC_OVERLAY, LOOP_DEVICE_DELETE_ERROR = range (200,220)
+    INDEX, SIZE, BEGIN, PTYPE, FS, MOUNTPOINT, UUID, INIT = range (0,8)
+    DEFAULT_DEVICE_TIMEOUT = 30
+    DEFAULT_HEADROOM = "256M"
+    GROWFS_SCRIPT = "/usr/sbin/rbf-growfs"
+    GROWFS_SERVICE = "rbf-growfs.service"
+    EMULATED_STAGES = ["groups", "packages", "initramfs", "board", "finalize"]
+    BINFMT_DIR = "/proc/sys/fs/binfmt_misc"
+    BINFMT_CONF_DIRS = ["/etc/binfmt.d", "/usr/lib/binfmt.d"]
+    TMPFS_STAGES = ["repos", "prefetch", "groups", "packages"]
+    INITRAMFS_COMPRESSION = ["none", "zstd", "xz"]
+    DRACUT_CONF_PATHS = ["/etc/dracut.conf", "/etc/dracut.conf.d", "/usr/lib/dracut/dracut.conf.d"]
+    OUTPUT_FORMATS = ["bmap", "sparse", "qcow2", "gz", "xz", "manifest"]
+    DEFAULT_POLICIES = {"groups": (RbfStage.RETRY, 2, 10), "packages": (RbfStage.RETRY, 2, 10), "rootpass": (RbfStage.WARN, 0, 0), "selinux": (RbfStage.WARN, 0, 0)}
+    INCORRECT_ARGUMENTS, ERROR_PARSING_XML, ERROR_IMAGE_FILE, INVALID_PARTITION_DATA, NO_PACKAGES, NO_KERNEL_TYPE, INCORRECT_REPOSITORY, IMAGE_EXISTS, NO_UBOOT, LOGICAL_PART_ERROR, PRIMARY_PART_ERROR, PARTITION_SIZES_ERROR, FSTAB_ERROR, CLEANUP_ERROR, NOT_ROOT, COMMANDS_NOT_FOUND, SYS_MKFS_COMMANDS_NOT_FOUND, NO_FIRMWARE_FOUND, TEMPLATE_NOT_FOUND, TOTAL_PARTITIONS_ERROR, CACHE_ERROR, BUILD_MANY_ERROR, WORKSPACE_ERROR, RESUME_ERROR, POLICY_ERROR, LINT_ERROR, PREFETCH_ERROR, PACKAGE_MANAGER_ERROR, CROSS_BUILD_ERROR, FAST_INSTALL_ERROR, INITRAMFS_SETTINGS_ERROR, OUTPUT_SETTINGS_ERROR, DELTA_ERROR, FLASH_ERROR = range(100,134)    
+    LOOP_DEVICE_EXISTS, FALLOCATE_ERROR, PARTED_ERROR, LOOP_DEVICE_CREATE_ERROR, PARTITION_DOES_NOT_EXIST, MOUNTING_ERROR, WRITE_REPO_ERROR, COPY_KERNEL_ERROR, COPY_FIRMWARE_ERROR, RPMDB_INIT_ERROR, GROUP_INSTALL_ERROR, PACKAGE_INSTALL_ERROR, ETC_OVERLAY_ERROR, ROOT_PASS_ERROR, SELINUX_ERROR, BOARD_SCRIPT_ERROR, FINALIZE_SCRIPT_ERROR, EXTLINUXCONF_ERROR, NO_ETC_OVERLAY, LOOP_DEVICE_DELETE_ERROR, SNAPSHOT_ERROR, MKFS_ERROR, DOWNLOAD_ERROR, RESIZE_ERROR, INSTALLROOT_ERROR, INITRAMFS_ERROR, OUTPUT_ERROR = range (200,227)
     RbfScriptErrors = { LOOP_DEVICE_EXISTS: "LOOP_DEVICE_EXISTS: Specified Loop Device Already Exists. Check losetup -l",
                         FALLOCATE_ERROR : "FALLOCATE_ERROR: Error While Creating Image File",
                         PARTED_ERROR: "PARTED_ERROR: Could Not Partition Image",
@@ -105,12 +348,40 @@ class BoardTemplateParser():
                         FINALIZE_SCRIPT_ERROR: "FINALIZE_SCRIPT_ERROR: Error In Finalize Script",
                         EXTLINUXCONF_ERROR: "EXTLINUXCONF_ERROR: Error Creating /boot/extlinux/extlinux.conf",
                         NO_ETC_OVERLAY: "No Etc Overlay Found",
-                        LOOP_DEVICE_DELETE_ERROR: "Could Not Delete Loop Device. Device Might Be Busy. Check \"losetup -l\""  }
+                        LOOP_DEVICE_DELETE_ERROR: "Could Not Delete Loop Device. Device Might Be Busy. Check \"losetup -l\"",
+                        SNAPSHOT_ERROR: "SNAPSHOT_ERROR: Could Not Restore Rootfs Snapshot",
+                        MKFS_ERROR: "MKFS_ERROR: Could Not Create Filesystem",
+                        DOWNLOAD_ERROR: "DOWNLOAD_ERROR: Could Not Resolve Or Download Packages",
+                        RESIZE_ERROR: "RESIZE_ERROR: Could Not Shrink Last Partition & Image",
+                        INSTALLROOT_ERROR: "INSTALLROOT_ERROR: Could Not Stage Installroot On tmpfs Or Copy It To Rootfs",
+                        INITRAMFS_ERROR: "INITRAMFS_ERROR: Could Not Create Initramfs",
+                        OUTPUT_ERROR: "OUTPUT_ERROR: Could Not Write Block Map, Sparse, qcow2 Or Compressed Image Or Delta"  }
    
-    def __init__(self, action, xmlTemplate):
+    def __init__(self, action, xmlTemplate, workspace, loopFree=False, resume=False, nonInteractive=False):
         """Constructor for BoardTemplateParser"""
         logging.info("Xml Template: "+xmlTemplate)
         self.action = action
+        self.workspace = workspace
+        self.loopFree = loopFree
+        self.resume = resume
+        self.nonInteractive = nonInteractive
+        self.policies = dict(BoardTemplateParser.DEFAULT_POLICIES)
+        self.statusPath = os.path.join(workspace, "status.json")
+        self.checkpointPath = ""
+        self.resumeUuids = {}
+        self.logFile = os.path.join(workspace, "rbf.log")
+        self.scriptLog = "$RBFLOG"
+        self.rbfScriptPath = os.path.join(workspace, "rbf.sh")
+        self.initramfsScriptPath = os.path.join(workspace, "initramfs.sh")
+        self.cleanupScriptPath = os.path.join(workspace, "cleanup.sh")
+        self.outputScriptPath = os.path.join(workspace, "output.sh")
+        self.loopDeviceFile = os.path.join(workspace, "loopdevice")
+        self.workspaceLock = open(os.path.join(workspace, ".lock"), "w")
+        try:
+            fcntl.flock(self.workspaceLock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.error("Workspace Is In Use By Another Build: " + workspace)
+            sys.exit(BoardTemplateParser.WORKSPACE_ERROR)
         self.imagePath = ""
         self.xmlTemplate = xmlTemplate
         self.boardDom = None
@@ -121,13 +392,41 @@ class BoardTemplateParser():
         self.imageData = []
         self.stockKernels = []
         self.repoNames = []
-        self.rbfScript = open("rbf.sh","w")
-        self.initramfsScript = None
+        self.repoPaths = {}
+        self.cache = None
+        self.deviceTimeout = BoardTemplateParser.DEFAULT_DEVICE_TIMEOUT
+        self.autoSize = False
+        self.hostArch = platform.machine()
+        self.targetArch = self.hostArch
+        self.crossBuild = False
+        self.qemuInterpreter = ""
+        self.fastInstall = ""
+        self.tmpfsSize = ""
+        self.tmpfsInstall = False
+        self.noSync = False
+        self.installRoot = ""
+        self.installRootStage = "rootfs"
+        self.initramfsCompress = "none"
+        self.initramfsThreads = "0"
+        self.initramfsLevel = ""
+        self.initramfsStages = ["initramfs"]
+        self.outputFormats = []
+        self.outputThreads = "0"
+        self.outputLevel = "6"
+        self.outputFrameSize = "4"
+        self.outputDelta = ""
+        self.headroom = BoardTemplateParser.DEFAULT_HEADROOM
+        self.partitionTable = None
+        self.packageCacheMounted = False
+        self.backend = None
+        self.prefetchConnections = 0
+        self.prefetchRetries = 0
+        self.reportPath = os.path.join(workspace, "report.json")
+        self.prefetchReportPath = os.path.join(workspace, "prefetch.json")
+        self.startTime = time.time()
+        self.executor = RbfExecutor(os.path.join(workspace, "stages"), multiprocessing.cpu_count(), "LOOPDEVICE=$(cat " + os.path.abspath(self.loopDeviceFile) + " 2> /dev/null)\n", {"imageBytes": self.getImageBytes, "downloadedBytes": self.getDownloadedBytes}, {"downloadedBytes": ["prefetch", "groups", "packages"]})
+        self.rbfScript = None
         self.cleanupScript = None
-        
-    def __del__(self):
-        """Destructor for BoardTemplateParser"""
-        self.rbfScript.close()    
     
     def getTagValue(self, dom, domTag):
         """Extracts Tag Value from DOMTree"""
@@ -139,44 +438,376 @@ class BoardTemplateParser():
         """Parses xmlTemplate"""
         logging.info("Parsing: "+ self.xmlTemplate)
         try:
-            self.boardDom = xml.dom.minidom.parse(self.xmlTemplate)            
+            self.boardDom = self.rbfUtils.loadTemplate(self.xmlTemplate)
         except:
             logging.error("Error Parsing XML Template File")
             sys.exit(BoardTemplateParser.ERROR_PARSING_XML)
+        if len(self.boardDom.getElementsByTagName("matrix")) != 0:
+            logging.error("Matrix Templates Are Built With build-many")
+            sys.exit(BoardTemplateParser.ERROR_PARSING_XML)
         
         self.boardName = self.getTagValue(self.boardDom,"board")        
         self.workDir = self.getTagValue(self.boardDom,"workdir")        
         self.finalizeScript = self.getTagValue(self.boardDom,"finalizescript")
-        self.loopDevice = subprocess.check_output(['losetup','-f']).strip()
+        self.loopDevice = "${LOOPDEVICE}"
         self.selinuxConf = self.getTagValue(self.boardDom,"selinux")
         self.etcOverlay = self.getTagValue(self.boardDom,"etcoverlay")
+        self.prepareWorkspace()
         self.linuxDistro = self.getTagValue(self.boardDom,"distro")
         self.extlinuxConf = self.getTagValue(self.boardDom,"extlinuxconf")
         self.hostName = self.getTagValue(self.boardDom,"hostname")
         self.rootFiles = self.getTagValue(self.boardDom,"rootfiles")
         self.ubootPath = self.getTagValue(self.boardDom,"uboot")
         self.firmwareDir = self.getTagValue(self.boardDom,"firmware")
+        self.parseCache()
+        self.parseArch()
+        self.parsePackageManager()
+        self.parsePrefetch()
+        self.parseFastInstall()
+        self.parseInitramfs()
+        self.parseOutputs()
+        self.parsePolicies()
         logging.info("Successfully Parsed Board Template For: " + self.boardName)
     
+    def prepareWorkspace(self):
+        """Scopes workdir to workspace & gives the build its own copy of the etc overlay"""
+        workspacePath = os.path.abspath(self.workspace)
+        workspaceId = os.path.basename(workspacePath) + "-" + hashlib.sha1(workspacePath.encode("utf-8")).hexdigest()[0:8]
+        self.workDir = self.workDir.rstrip("/") + "/" + workspaceId
+        logging.info("Workspace: " + self.workspace + " Workdir: " + self.workDir)
+
+        workspaceOverlay = os.path.join(self.workspace, "etc")
+        if os.path.exists(workspaceOverlay):
+            shutil.rmtree(workspaceOverlay)
+        if os.path.exists(self.etcOverlay):
+            if subprocess.call(["cp", "-a", "--reflink=auto", self.etcOverlay, workspaceOverlay]) != 0:
+                logging.error("Could Not Copy Etc Overlay To Workspace: " + self.etcOverlay)
+                sys.exit(BoardTemplateParser.WORKSPACE_ERROR)
+        self.etcOverlay = workspaceOverlay
+
+    def parseCache(self):
+        """Reads host package cache settings. Cache is enabled by default"""
+        cacheDir = RbfCache.DEFAULT_CACHE_DIR
+        cacheSize = RbfCache.DEFAULT_MAX_SIZE
+        self.metadataExpire = ""
+        self.useSnapshots = True
+        for c in self.boardDom.getElementsByTagName("cache"):
+            if c.hasAttribute("path"):
+                cacheDir = c.getAttribute("path")
+            if c.hasAttribute("size"):
+                cacheSize = c.getAttribute("size")
+            if c.hasAttribute("metadataexpire"):
+                self.metadataExpire = c.getAttribute("metadataexpire")
+            if c.hasAttribute("snapshots"):
+                self.useSnapshots = c.getAttribute("snapshots") != "false"
+        if cacheDir == "none":
+            logging.info("Package Cache Disabled")
+            return
+        if not (cacheSize[-1:] == "M" or cacheSize[-1:] == "G") or not self.rbfUtils.isSizeInt(cacheSize[0:-1]):
+            logging.error("Cache Size Error. Only Integers with suffix G or M allowed. You Specified " + cacheSize)
+            sys.exit(BoardTemplateParser.CACHE_ERROR)
+        self.cache = RbfCache(cacheDir, self.rbfUtils.getImageSizeInM(cacheSize)[0:-1])
+        logging.info("Package Cache: " + self.cache.cacheDir + " " + cacheSize)
+
+    def parseArch(self):
+        """Reads target architecture. Builds for another architecture run target binaries through qemu-user"""
+        arch = self.getTagValue(self.boardDom, "arch")
+        if arch == None:
+            if not self.hostArch.startswith("arm") and not self.hostArch.startswith("aarch64"):
+                logging.error("This script is not meant to be run on " + self.hostArch + ". Add an arch tag to the template for a cross build")
+            return
+        self.targetArch = arch.strip()
+        if self.targetArch not in RbfUtils.QEMU_ARCHES:
+            logging.error("Unknown Architecture: " + self.targetArch + ". Use one of " + ", ".join(sorted(RbfUtils.QEMU_ARCHES)))
+            sys.exit(BoardTemplateParser.CROSS_BUILD_ERROR)
+        if RbfUtils.QEMU_ARCHES[self.targetArch] == RbfUtils.QEMU_ARCHES.get(self.hostArch, self.hostArch):
+            logging.info("Architecture: " + self.targetArch)
+            return
+        self.crossBuild = True
+        logging.info("Cross Build For " + self.targetArch + " On " + self.hostArch + " Using qemu-user")
+        self.verifyBinfmt(RbfUtils.QEMU_ARCHES[self.targetArch])
+
+    def verifyBinfmt(self, qemuArch):
+        """Checks that a binfmt_misc handler for qemu-qemuArch is enabled, registering it from binfmt.d if required.
+        Interpreters registered without the F flag are copied into the rootfs"""
+        handlerPath = os.path.join(BoardTemplateParser.BINFMT_DIR, "qemu-" + qemuArch)
+        if not os.path.exists(handlerPath):
+            for confDir in BoardTemplateParser.BINFMT_CONF_DIRS:
+                for conf in sorted(glob.glob(os.path.join(confDir, "qemu-" + qemuArch + "*.conf"))):
+                    if os.path.exists(handlerPath):
+                        break
+                    logging.info("Registering binfmt Handler: " + conf)
+                    try:
+                        confFile = open(conf)
+                        rules = [l.strip() for l in confFile if l.strip().startswith(":")]
+                        confFile.close()
+                        registerFile = open(os.path.join(BoardTemplateParser.BINFMT_DIR, "register"), "w")
+                        registerFile.write(rules[0])
+                        registerFile.close()
+                    except (IOError, OSError, IndexError) as e:
+                        logging.error("Could Not Register binfmt Handler " + conf + ": " + str(e))
+        if not os.path.exists(handlerPath):
+            logging.error("No binfmt Handler For qemu-" + qemuArch + ". Install qemu-user-static & run systemctl restart systemd-binfmt")
+            sys.exit(BoardTemplateParser.CROSS_BUILD_ERROR)
+        handlerFile = open(handlerPath)
+        handler = handlerFile.read().split("\n")
+        handlerFile.close()
+        if handler[0].strip() != "enabled":
+            logging.error("binfmt Handler Is Disabled: " + handlerPath)
+            sys.exit(BoardTemplateParser.CROSS_BUILD_ERROR)
+        interpreter = ""
+        flags = ""
+        for line in handler:
+            if line.startswith("interpreter "):
+                interpreter = line.split(" ", 1)[1].strip()
+            if line.startswith("flags:"):
+                flags = line.split(":", 1)[1].strip()
+        logging.info("binfmt Handler: " + handlerPath + " Interpreter: " + interpreter + " Flags: " + flags)
+        if "F" not in flags:
+            if not os.path.exists(interpreter):
+                logging.error("qemu Interpreter Not Found: " + interpreter)
+                sys.exit(BoardTemplateParser.CROSS_BUILD_ERROR)
+            self.qemuInterpreter = interpreter
+
+    def installEmulator(self):
+        """Copies qemu interpreter into rootfs if its binfmt handler does not keep it open. Returns stage inputs to wait for"""
+        if self.qemuInterpreter == "":
+            return []
+        self.addStage("emulator", [self.installRootStage], ["emulator"], rerun=True)
+        logging.info("Copying qemu Interpreter Into Rootfs: " + self.qemuInterpreter)
+        self.rbfScript.write("mkdir -p " + self.installRoot + os.path.dirname(self.qemuInterpreter) + " && cp " + self.qemuInterpreter + " " + self.installRoot + self.qemuInterpreter + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.CROSS_BUILD_ERROR))
+        return ["emulator"]
+
+    def removeEmulator(self, script):
+        """Removes qemu interpreter copied into rootfs"""
+        if self.qemuInterpreter != "":
+            script.write("rm -f " + self.workDir + self.qemuInterpreter + "\n")
+
+    def parsePackageManager(self):
+        """Reads package manager backend. Eg. <packagemanager type="dnf" paralleldownloads="10" installweakdeps="false"></packagemanager>. yum by default"""
+        backendType = "yum"
+        parallelDownloads = ""
+        installWeakDeps = ""
+        releaseVer = ""
+        for p in self.boardDom.getElementsByTagName("packagemanager"):
+            backendType = p.getAttribute("type") or backendType
+            parallelDownloads = p.getAttribute("paralleldownloads")
+            installWeakDeps = p.getAttribute("installweakdeps")
+            releaseVer = p.getAttribute("releasever")
+        if backendType not in ["yum", "dnf"] or (parallelDownloads != "" and not parallelDownloads.isdigit()) or installWeakDeps not in ["", "true", "false"]:
+            logging.error("Invalid Package Manager Settings. Use type yum or dnf, integer paralleldownloads & installweakdeps true or false")
+            sys.exit(BoardTemplateParser.PACKAGE_MANAGER_ERROR)
+        if backendType == "dnf":
+            forceArch = ""
+            if self.crossBuild:
+                forceArch = self.targetArch
+            self.backend = RbfDnfBackend(self.workDir, self.nonInteractive, parallelDownloads, installWeakDeps, releaseVer, forceArch)
+        elif self.crossBuild:
+            logging.error("Cross Builds Need The dnf Backend For --forcearch. Add <packagemanager type=\"dnf\"></packagemanager>")
+            sys.exit(BoardTemplateParser.CROSS_BUILD_ERROR)
+        else:
+            if parallelDownloads != "" or installWeakDeps != "" or releaseVer != "":
+                logging.info("yum Ignores paralleldownloads, installweakdeps & releasever")
+            self.backend = RbfYumBackend(self.workDir, self.nonInteractive)
+        if not checkCommandExistsAccess([self.backend.COMMAND]):
+            sys.exit(BoardTemplateParser.PACKAGE_MANAGER_ERROR)
+        logging.info("Package Manager: " + backendType)
+
+    def parsePrefetch(self):
+        """Reads package prefetch settings. Eg. <prefetch connections="8" retries="3"></prefetch>. Prefetch is disabled by default"""
+        for p in self.boardDom.getElementsByTagName("prefetch"):
+            connections = p.getAttribute("connections") or "4"
+            retries = p.getAttribute("retries") or "3"
+            if not connections.isdigit() or int(connections) < 1 or not retries.isdigit():
+                logging.error("Invalid Prefetch Settings. connections & retries must be integers")
+                sys.exit(BoardTemplateParser.PREFETCH_ERROR)
+            if self.cache == None:
+                logging.error("Prefetch Needs The Package Cache. Remove path=\"none\" from the cache tag")
+                sys.exit(BoardTemplateParser.PREFETCH_ERROR)
+            if not checkCommandExistsAccess([self.backend.PREFETCH_COMMAND]):
+                sys.exit(BoardTemplateParser.PREFETCH_ERROR)
+            self.prefetchConnections = int(connections)
+            self.prefetchRetries = int(retries)
+            logging.info("Prefetching Packages With " + connections + " Connections & " + retries + " Retries")
+
+    def parseFastInstall(self):
+        """Reads fast install settings. Eg. <fastinstall mode="tmpfs" size="3G"></fastinstall>. Fast install is disabled by default"""
+        self.installRoot = self.workDir
+        for f in self.boardDom.getElementsByTagName("fastinstall"):
+            self.fastInstall = f.getAttribute("mode") or "tmpfs"
+            self.tmpfsSize = f.getAttribute("size")
+        if self.fastInstall not in ["", "tmpfs", "nosync"] or (self.tmpfsSize != "" and not (self.tmpfsSize[-1:] in ["M", "G"] and self.rbfUtils.isSizeInt(self.tmpfsSize[0:-1]))):
+            logging.error("Invalid Fast Install Settings. Use mode tmpfs or nosync & size with suffix M or G")
+            sys.exit(BoardTemplateParser.FAST_INSTALL_ERROR)
+        if self.fastInstall == "nosync" and not checkCommandExistsAccess(["eatmydata"]):
+            logging.error("Fast Install Mode nosync Needs eatmydata")
+            sys.exit(BoardTemplateParser.FAST_INSTALL_ERROR)
+        if self.fastInstall != "":
+            logging.info("Fast Install: " + self.fastInstall)
+
+    def parseInitramfs(self):
+        """Reads initramfs compression. Eg. <initramfs compress="zstd" threads="0" level="15"></initramfs>. Uncompressed by default"""
+        for i in self.boardDom.getElementsByTagName("initramfs"):
+            self.initramfsCompress = i.getAttribute("compress") or self.initramfsCompress
+            self.initramfsThreads = i.getAttribute("threads") or self.initramfsThreads
+            self.initramfsLevel = i.getAttribute("level")
+        if self.initramfsCompress not in BoardTemplateParser.INITRAMFS_COMPRESSION or not self.initramfsThreads.isdigit() or (self.initramfsLevel != "" and not self.initramfsLevel.isdigit()):
+            logging.error("Invalid Initramfs Settings. Use compress none, zstd or xz & integer threads & level")
+            sys.exit(BoardTemplateParser.INITRAMFS_SETTINGS_ERROR)
+        logging.info("Initramfs Compression: " + self.initramfsCompress)
+
+    def parseOutputs(self):
+        """Reads output formats written next to the raw image. Eg. <output formats="bmap,sparse,qcow2,gz,xz,manifest" threads="0" level="6" framesize="4" delta="previous.img"></output>"""
+        for o in self.boardDom.getElementsByTagName("output"):
+            self.outputFormats = [f.strip() for f in o.getAttribute("formats").split(",") if f.strip() != ""]
+            self.outputThreads = o.getAttribute("threads") or self.outputThreads
+            self.outputLevel = o.getAttribute("level") or self.outputLevel
+            self.outputFrameSize = o.getAttribute("framesize") or self.outputFrameSize
+            self.outputDelta = o.getAttribute("delta")
+        for outputFormat in self.outputFormats:
+            if outputFormat not in BoardTemplateParser.OUTPUT_FORMATS:
+                logging.error("Unknown Output Format: " + outputFormat + ". Use " + ", ".join(BoardTemplateParser.OUTPUT_FORMATS))
+                sys.exit(BoardTemplateParser.OUTPUT_SETTINGS_ERROR)
+        if not self.outputThreads.isdigit() or not self.outputLevel.isdigit() or int(self.outputLevel) > 9 or not self.outputFrameSize.isdigit() or int(self.outputFrameSize) == 0:
+            logging.error("Invalid Output Settings. Use integer threads, level 0-9 & frame size in M")
+            sys.exit(BoardTemplateParser.OUTPUT_SETTINGS_ERROR)
+        if "qcow2" in self.outputFormats and not checkCommandExistsAccess(["qemu-img"]):
+            logging.error("qcow2 Output Needs qemu-img")
+            sys.exit(BoardTemplateParser.OUTPUT_SETTINGS_ERROR)
+        if self.outputDelta != "" and not os.path.isfile(self.outputDelta):
+            logging.error("Previous Image For Delta Not Found: " + self.outputDelta)
+            sys.exit(BoardTemplateParser.OUTPUT_SETTINGS_ERROR)
+        if len(self.outputFormats) != 0:
+            logging.info("Output Formats: raw " + " ".join(self.outputFormats))
+        if self.outputDelta != "":
+            logging.info("Delta From Previous Image: " + self.outputDelta)
+
+    def parsePolicies(self):
+        """Reads failure policies of stages. Eg. <policy stage="packages" onfailure="retry" retries="3" backoff="10"></policy>"""
+        for p in self.boardDom.getElementsByTagName("policy"):
+            stage = p.getAttribute("stage")
+            policy = p.getAttribute("onfailure")
+            retries = p.getAttribute("retries") or "0"
+            backoff = p.getAttribute("backoff") or "0"
+            if stage == "" or policy not in [RbfStage.ABORT, RbfStage.WARN, RbfStage.RETRY] or not retries.isdigit() or not backoff.isdigit():
+                logging.error("Invalid Failure Policy For Stage " + stage + ": " + policy + ". Use abort, warn or retry with integer retries & backoff")
+                sys.exit(BoardTemplateParser.POLICY_ERROR)
+            self.policies[stage] = (policy, int(retries), int(backoff))
+            logging.info("Failure Policy For Stage " + stage + ": " + policy + " Retries: " + retries + " Backoff: " + backoff + "s")
+
+    def addStage(self, name, inputs, outputs, interactive=False, rerun=False):
+        """Adds a build stage. Following commands are written to it. Nothing is interactive in non interactive builds"""
+        self.rbfScript = self.executor.addStage(RbfStage(name, inputs, outputs, interactive and not self.nonInteractive, rerun))
+        self.rbfScript.emulated = self.crossBuild and name.split("-")[0] in BoardTemplateParser.EMULATED_STAGES
+        if name in self.policies:
+            self.rbfScript.setPolicy(*self.policies[name])
+        return self.rbfScript
+
+    def getImageBytes(self):
+        """Returns bytes allocated to image file"""
+        if self.imagePath == "" or not os.path.exists(self.imagePath):
+            return 0
+        return os.stat(self.imagePath).st_blocks*512
+
+    def getDownloadedBytes(self):
+        """Returns size of package caches. Grows as packages & metadata are downloaded. Walks the caches, so only sampled for stages that download"""
+        cacheDirs = [self.installRoot + "/var/cache/yum", self.installRoot + "/var/cache/dnf"]
+        if self.cache != None:
+            cacheDirs = [os.path.join(self.cache.cacheDir, RbfCache.PACKAGES_DIR)]
+        size = 0
+        for cacheDir in cacheDirs:
+            for root, dirs, files in os.walk(cacheDir):
+                for f in files:
+                    try:
+                        size = size + os.lstat(os.path.join(root, f)).st_size
+                    except OSError:
+                        pass
+        return size
+
+    def writeStatus(self, exitCode):
+        """Writes status.json with exit code, error, failed stage, warnings & retried stages"""
+        status = "success"
+        if exitCode != 0:
+            status = "failed"
+        elif len(self.executor.warnings) != 0:
+            status = "warnings"
+        message = ""
+        if exitCode != 0:
+            message = self.RbfScriptErrors.get(exitCode, "Stage Failed: " + str(self.executor.failedStage))
+        warnings = []
+        for warning in self.executor.warnings:
+            warnings.append({"stage": warning["stage"], "exitCode": warning["exitCode"], "message": self.RbfScriptErrors.get(warning["exitCode"], "")})
+        retried = {}
+        for entry in self.executor.report:
+            if entry.get("attempt", 1) > 1:
+                retried[entry["stage"]] = entry["attempt"]
+        statusFile = open(self.statusPath, "w")
+        json.dump({"status": status, "exitCode": exitCode, "message": message, "failedStage": self.executor.failedStage, "warnings": warnings, "retried": retried, "template": self.xmlTemplate, "image": self.imagePath}, statusFile, indent=2, sort_keys=True)
+        statusFile.write("\n")
+        statusFile.close()
+        logging.info("Build Status: " + status + " Exit Code: " + str(exitCode) + " " + self.statusPath)
+
+    def writeReport(self, exitCode):
+        """Writes report.json & logs per stage summary"""
+        logging.info("Stage Report: " + self.reportPath)
+        for line in self.executor.getSummary():
+            logging.info("  " + line)
+        info = {"template": self.xmlTemplate, "image": self.imagePath, "workspace": self.workspace, "exitCode": exitCode, "wallTime": round(time.time() - self.startTime, 3), "arch": self.targetArch, "hostArch": self.hostArch, "installRoot": "direct"}
+        if self.tmpfsInstall:
+            info["installRoot"] = "tmpfs"
+        elif self.noSync:
+            info["installRoot"] = "nosync"
+        if self.crossBuild:
+            emulated = [e for e in self.executor.report if e.get("emulated", False)]
+            for entry in emulated:
+                logging.info("Emulated " + self.targetArch + " Stage: " + entry["stage"] + " " + str(round(entry["wallTime"], 1)) + "s")
+            info["emulatedWallTime"] = round(sum([e["wallTime"] for e in emulated]), 3)
+        if len(self.outputFormats) != 0:
+            outputSuffixes = {"bmap": ".bmap", "sparse": ".simg", "qcow2": ".qcow2", "gz": ".gz", "xz": ".xz", "manifest": ".manifest.json"}
+            info["outputs"] = [self.imagePath + outputSuffixes[f] for f in self.outputFormats if os.path.exists(self.imagePath + outputSuffixes[f])]
+        if self.outputDelta != "" and os.path.exists(self.imagePath + ".delta"):
+            info["delta"] = {"from": self.outputDelta, "path": self.imagePath + ".delta", "size": os.path.getsize(self.imagePath + ".delta")}
+        if self.prefetchConnections != 0 and os.path.exists(self.prefetchReportPath):
+            prefetchFile = open(self.prefetchReportPath)
+            info["prefetch"] = json.load(prefetchFile)
+            prefetchFile.close()
+        try:
+            self.executor.writeReport(self.reportPath, info)
+            self.writeStatus(exitCode)
+        except IOError:
+            logging.error("Could Not Write Report: " + self.reportPath)
+
+    def getScriptHeader(self):
+        """Returns header for generated scripts. Commands log to $RBFLOG"""
+        return "RBFLOG=${RBFLOG:-" + os.path.abspath(self.logFile) + "}\n"
+
     def getShellExitString(self,exitCode):
         """Generates Shell Exit command. Used to check successful command execution"""
         return "if [ $? != 0 ]; then exit " + str(exitCode) + "; fi\n\n"
     
     def getShellErrorString(self,exitCode):
-        """Generates Shell Error command. Used to check successful command execution"""
+        """Generates Shell Error command. Used to check successful command execution. Prompts unless build is non interactive"""
+        if self.nonInteractive:
+            return "if [ $? != 0 ]; then echo [INFO ]  " + self.RbfScriptErrors[exitCode] + "; exit " + str(exitCode) + "; fi\n\n"
         return "if [ $? != 0 ]; then echo [INFO ]  " + self.RbfScriptErrors[exitCode] + ";  read -p \"Press Enter To Continue\"; fi\n\n"
         
     def createImage(self):
         """Creates Image File"""        
-        self.rbfScript.write("echo [INFO ]   $0 Detacing Loop Device If Busy: " + self.loopDevice+"\n")
-        self.rbfScript.write(self.delDeviceIfExists(self.loopDevice))
+        self.addStage("image", [], ["image"])
         logging.info("Creating Image File")
         imageDom = self.boardDom.getElementsByTagName("image")[0]
         if imageDom.hasAttribute("size") and imageDom.hasAttribute("size") and imageDom.hasAttribute("size"):
             self.imageSize = imageDom.getAttribute("size")
             imageType = imageDom.getAttribute("type")
             self.imagePath = imageDom.getAttribute("path")
-            if self.imageSize[len(self.imageSize)-1] == "M" or self.imageSize[len(self.imageSize)-1] == "G":
+            if not os.path.isabs(self.imagePath):
+                self.imagePath = os.path.join(self.workspace, self.imagePath)
+            if self.imageSize == "auto":
+                self.autoSize = True
+                self.imageSize = self.getAutoImageSize(imageDom)
+                logging.info("Creating Image: " + self.imageSize + " " + imageType + " " + self.imagePath + ". Shrinking To Content Plus " + self.headroom + " After Build")
+            elif self.imageSize[len(self.imageSize)-1] == "M" or self.imageSize[len(self.imageSize)-1] == "G":
                 logging.info("Creating Image: " + self.imageSize + " " + imageType + " " + self.imagePath)
             else:
                  logging.error("Invalid Image Size: " + self.imageSize)
@@ -186,15 +817,69 @@ class BoardTemplateParser():
             sys.exit(BoardTemplateParser.ERROR_IMAGE_FILE)
     
         self.imageSize = self.rbfUtils.getImageSizeInM(self.imageSize)
+        if imageDom.hasAttribute("devicetimeout"):
+            if not self.rbfUtils.isSizeInt(imageDom.getAttribute("devicetimeout")):
+                logging.error("Invalid Device Timeout: " + imageDom.getAttribute("devicetimeout"))
+                sys.exit(BoardTemplateParser.ERROR_IMAGE_FILE)
+            self.deviceTimeout = int(imageDom.getAttribute("devicetimeout"))
 
-        if os.path.exists(self.imagePath):
-            logging.error("Image Already Exists")
+        self.checkpointPath = self.imagePath + ".checkpoint"
+        if self.resume and self.action == "build":
+            self.loadCheckpoint()
+        elif os.path.exists(self.imagePath):
+            logging.error("Image Already Exists. Use --resume to continue a failed build")
             sys.exit(BoardTemplateParser.IMAGE_EXISTS)
         
         self.rbfScript.write("echo [INFO ]    $0 Creating " + self.imagePath + "\n")
-        self.rbfScript.write("fallocate -l " + self.imageSize + " " + self.imagePath + " &>> rbf.log \n")
+        self.rbfScript.write("fallocate -l " + self.imageSize + " " + self.imagePath + " &>> " + self.scriptLog + " \n")
         self.rbfScript.write(self.getShellExitString(BoardTemplateParser.FALLOCATE_ERROR))
     
+    def getAutoImageSize(self, imageDom):
+        """Returns working size for size="auto". Large enough for all partitions & their alignment"""
+        if imageDom.hasAttribute("headroom"):
+            self.headroom = imageDom.getAttribute("headroom")
+        if not (self.headroom[-1:] == "M" or self.headroom[-1:] == "G") or not self.rbfUtils.isSizeInt(self.headroom[0:-1]):
+            logging.error("Invalid Headroom: " + self.headroom + ". Only Integers with suffix G or M allowed")
+            sys.exit(BoardTemplateParser.ERROR_IMAGE_FILE)
+        if not checkCommandExistsAccess(["e2fsck", "resize2fs", "dumpe2fs"]):
+            logging.error("Please Install e2fsprogs To Use size=\"auto\"")
+            sys.exit(BoardTemplateParser.COMMANDS_NOT_FOUND)
+        partitionsDom = self.boardDom.getElementsByTagName("partitions")
+        align = RbfUtils.PARTITION_BEGIN
+        if len(partitionsDom) != 0 and partitionsDom[0].hasAttribute("align"):
+            align = partitionsDom[0].getAttribute("align")
+        try:
+            sectors = 0
+            partitions = self.boardDom.getElementsByTagName("partition")
+            for p in partitions:
+                if p.getAttribute("type") != "extended":
+                    sectors = sectors + self.rbfUtils.getSizeInSectors(self.rbfUtils.getImageSizeInM(p.getAttribute("size")))
+            # Every partition may start on a new align boundary, each logical one after its EBR, gpt needs its backup at the end
+            sectors = sectors + (len(partitions) + 2)*(self.rbfUtils.getSizeInSectors(align) + 1) + 34
+        except ValueError as e:
+            logging.error("Invalid Partition Data: " + str(e))
+            sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
+        return str((sectors*int(RbfUtils.SECTOR_SIZE) + 1024*1024 - 1)//(1024*1024)) + "M"
+
+    def loadCheckpoint(self):
+        """Loads checkpoint of an earlier build of the image. Stages unchanged since are skipped"""
+        if not os.path.exists(self.imagePath):
+            logging.info("Image Does Not Exist. Nothing To Resume, Starting New Build")
+            if os.path.exists(self.checkpointPath):
+                os.remove(self.checkpointPath)
+            self.resume = False
+            return
+        checkpointData = self.executor.loadCheckpoint(self.checkpointPath)
+        if checkpointData == None:
+            logging.error("No Checkpoint Found For Image: " + self.checkpointPath)
+            sys.exit(BoardTemplateParser.RESUME_ERROR)
+        if checkpointData.get("loopFree", False) != self.loopFree:
+            logging.error("Image Was Not Built With The Same --loopfree Setting. Cannot Resume")
+            sys.exit(BoardTemplateParser.RESUME_ERROR)
+        # Reuse filesystem UUIDs so partition & mkfs stages keep their fingerprints
+        self.resumeUuids = checkpointData.get("uuids", {})
+        logging.info("Resuming Build From Checkpoint: " + self.checkpointPath)
+
     def verifyPartitionSizes(self,partitionsDom):
         """Checks if partition size is exceeding total image size"""
         partitionSizeSum = 0
@@ -223,6 +908,7 @@ class BoardTemplateParser():
     def createPartitions(self):
         """Creates Partitions"""
         logging.info("Creating Partitions")
+        self.addStage("partitions", ["image"], ["partitiontable"])
         try:
             partitionsDom = self.boardDom.getElementsByTagName("partitions")
         except:
@@ -232,13 +918,24 @@ class BoardTemplateParser():
             logging.error("Parititon Sizes Exceed Image Size")
             sys.exit(BoardTemplateParser.PARTITION_SIZES_ERROR)
             
-        partedString = "parted " + self.imagePath + " -s mklabel msdos "
+        table = "msdos"
+        align = self.rbfUtils.PARTITION_BEGIN
+        if partitionsDom[0].hasAttribute("table"):
+            table = partitionsDom[0].getAttribute("table")
+        if partitionsDom[0].hasAttribute("align"):
+            align = partitionsDom[0].getAttribute("align")
+        try:
+            partitionTable = RbfPartitionTable(self.imageSize, table, align)
+        except ValueError as e:
+            logging.error("Invalid Partition Table: " + str(e))
+            sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
+        logging.info("Partition Table: " + table + " Aligned To " + align)
+
         extendedStart = False
         totalPartitionCount = 0
-        begin = self.rbfUtils.PARTITION_BEGIN
+        templateData = []
         for partitions in partitionsDom:
             partition = partitions.getElementsByTagName("partition")
-            primaryCount = 0
             for p in partition:
                 partuuid = str(uuid.uuid4())
                 if p.hasAttribute("index") and p.hasAttribute("size") and p.hasAttribute("type") and p.hasAttribute("fs") and p.hasAttribute("mountpoint"):
@@ -247,34 +944,19 @@ class BoardTemplateParser():
                     ptype = p.getAttribute("type")
                     fs = p.getAttribute("fs")
                     mountpoint = p.getAttribute("mountpoint")                                        
+                    init = partitions.getAttribute("init")
+                    if p.hasAttribute("init"):
+                        init = p.getAttribute("init")
+                    if init not in ["", "lazy", "eager"]:
+                        logging.error("Invalid Filesystem Init For Partition " + index + ": " + init + ". Use lazy or eager")
+                        sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
                     
                     if fs == "vfat":
                         partuuid = partuuid.upper()[:8]
+                    partuuid = self.resumeUuids.get(index, partuuid)
                     
-                    if (ptype =="primary" or ptype == "extended") and totalPartitionCount == 4:
-                        logging.error("Cannot Have More Than 4 Primary Partitions")
-                        sys.exit(BoardTemplateParser.TOTAL_PARTITIONS_ERROR)
-                    if ptype == "primary":
-                        primaryCount = primaryCount + 1
                     if ptype == "primary" or ptype == "extended":
                         totalPartitionCount = totalPartitionCount + 1
-                    
-                    """Adjust partition indexes. parted seems to skip a partition number if a logical partition is create before 3 primary ones"""
-                    if primaryCount < 3 and extendedStart == True:
-                        index = str(int(index) + 1)
-                        
-                    logging.info("Creating Partition " + index + " " + size + " " + ptype + " " + fs + " " + mountpoint + " " + partuuid)
-                    x = [index, size, begin, ptype, fs, mountpoint, partuuid]
-                    self.imageData.append(x)
-                    
-                    end = self.rbfUtils.calcParitionEndSize(begin,size)
-                    
-                    if fs == "swap":
-                        fs = "linux-swap"
-                    elif fs == "vfat":
-                        fs = "fat32"
-                    partedString = partedString + "mkpart " + ptype + " " + fs + " " + begin[0:-1] + " " + end[0:-1] + " "
-                    
                     if ptype == "logical" and extendedStart == False:
                         logging.error("Cannot Create Logical Parititon before Extended")
                         sys.exit(BoardTemplateParser.LOGICAL_PART_ERROR)
@@ -283,23 +965,71 @@ class BoardTemplateParser():
                         sys.exit(BoardTemplateParser.PRIMARY_PART_ERROR)
                     elif ptype == "extended":
                         extendedStart = True
-                    else:
-                        begin = end
+                    if extendedStart and table == "msdos" and totalPartitionCount > 4:
+                        logging.error("Cannot Have More Than 4 Primary Partitions")
+                        sys.exit(BoardTemplateParser.TOTAL_PARTITIONS_ERROR)
+                    try:
+                        partitionTable.addPartition(size, fs, ptype)
+                    except ValueError as e:
+                        logging.error("Invalid Partition Data: " + str(e))
+                        sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
+                    templateData.append([index, size, ptype, fs, mountpoint, partuuid, init])
                 else:
                     logging.error("Invalid Partition Data")
                     sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
-            self.rbfScript.write("echo [INFO ]   $0 Creating Parititons\n")
-            self.rbfScript.write(partedString + " &>> rbf.log \n")
-            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.PARTED_ERROR))
+
+        if self.autoSize and templateData[-1][3] not in ["ext2", "ext3", "ext4"]:
+            logging.error("size=\"auto\" Needs An ext2, ext3 Or ext4 Last Partition To Shrink & Grow")
+            sys.exit(BoardTemplateParser.INVALID_PARTITION_DATA)
+        self.partitionTable = partitionTable
+        try:
+            layout = partitionTable.plan()
+        except ValueError as e:
+            logging.error(str(e))
+            sys.exit(BoardTemplateParser.PARTITION_SIZES_ERROR)
+        # Drop extended partition added by the table for more than 4 partitions
+        if not extendedStart:
+            layout = [l for l in layout if l[1] != "extended"]
+        for i in range(0, len(templateData)):
+            index, size, ptype, fs, mountpoint, partuuid, init = templateData[i]
+            number, ptype, tableFs, beginSector, endSector = layout[i]
+            if str(number) != index:
+                logging.info("Partition " + index + " Is Numbered " + str(number) + " In The Partition Table")
+            logging.info("Creating Partition " + str(number) + " " + size + " " + ptype + " " + fs + " " + mountpoint + " " + partuuid + " Sectors " + str(beginSector) + "-" + str(endSector))
+            self.imageData.append([str(number), size, str(beginSector) + "s", ptype, fs, mountpoint, partuuid, init])
+
+        uuids = {}
+        for index, size, ptype, fs, mountpoint, partuuid, init in templateData:
+            uuids[index] = partuuid
+        self.executor.setCheckpoint(self.checkpointPath, {"template": os.path.abspath(self.xmlTemplate), "loopFree": self.loopFree, "uuids": uuids})
+
+        self.rbfScript.write("echo [INFO ]   $0 Creating Parititons\n")
+        self.rbfScript.write(sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfutils.py") + " " + self.imagePath + " " + " ".join(partitionTable.getCommandArgs()) + " &>> " + self.scriptLog + " \n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.PARTED_ERROR))
 
     def delDeviceIfExists(self, device):
-        """Generates command to detach loop device if it exists"""
-        return "[ -b " + device + " ] && losetup -d " + device + " &>> rbf.log \nsleep 2\n"
+        """Generates command to detach loop device if it exists & wait till it is released"""
+        detachString = "[ -b \"" + device + "\" ] && losetup -d " + device + " &>> " + self.scriptLog + " \n"
+        return detachString + self.getWaitString("[ ! -e /sys/block/$(basename \"" + device + "\")/loop/backing_file ]", BoardTemplateParser.LOOP_DEVICE_DELETE_ERROR)
+
+    def getWaitString(self, condition, exitCode):
+        """Generates command polling condition till it is true or device timeout expires"""
+        waitString = "for i in $(seq " + str(self.deviceTimeout*10) + "); do " + condition + " && break; sleep 0.1; done\n"
+        return waitString + condition + " || exit " + str(exitCode) + "\n"
 
     def createFilesystems(self):
         """Creates Filesystem"""
-        self.rbfScript.write("losetup " + self.loopDevice + " " + self.imagePath + "\n")
-        self.rbfScript.write("partprobe " + self.loopDevice + "\nsleep 2\n")
+        if self.loopFree:
+            logging.info("Loop Free Build. Filesystems Will Be Created From Staging Directory")
+            return
+        self.addStage("loopdevice", ["partitiontable"], ["loopdevice"], rerun=True)
+        self.rbfScript.write("LOOPDEVICE=$(losetup -f -P --show " + self.imagePath + ")\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.LOOP_DEVICE_CREATE_ERROR))
+        self.rbfScript.write("echo $LOOPDEVICE > " + self.loopDeviceFile + "\n")
+        self.rbfScript.write("echo [INFO ]   $0 Using Loop Device: $LOOPDEVICE\n")
+        for i in range(0, len(self.imageData)):
+            if self.imageData[i][BoardTemplateParser.PTYPE] != "extended":
+                self.rbfScript.write(self.getWaitString("[ -b " + self.loopDevice + "p" + self.imageData[i][BoardTemplateParser.INDEX] + " ]", BoardTemplateParser.PARTITION_DOES_NOT_EXIST))
         for i in range(0, len(self.imageData)):
             if self.imageData[i][BoardTemplateParser.PTYPE] == "extended":
                 continue
@@ -307,31 +1037,125 @@ class BoardTemplateParser():
             index = self.imageData[i][BoardTemplateParser.INDEX]
             partuuid = self.imageData[i][BoardTemplateParser.UUID]
             ptype = self.imageData[i][BoardTemplateParser.PTYPE]
+            init = self.imageData[i][BoardTemplateParser.INIT]
+            self.addStage("mkfs-" + index, ["loopdevice"], ["filesystem-" + index])
 
-            size = self.rbfUtils.getImageSizeInM(self.imageData[i][BoardTemplateParser.SIZE])
-            begin = self.rbfUtils.getImageSizeInM(self.imageData[i][BoardTemplateParser.BEGIN])
-            
             self.rbfScript.write("[ -b " + self.loopDevice + "p" + index + " ] && echo [INFO ]   $0 Creating Filesystem " + fs + " on partition " + index + " || exit " + str(BoardTemplateParser.PARTITION_DOES_NOT_EXIST) + "\n")
             
             if fs == "vfat":
                 if not checkCommandExistsAccess(['mkfs.vfat']):
                     logging.error("Please Install mkfs.vfat")
                     sys.exit(BoardTemplateParser.SYS_MKFS_COMMANDS_NOT_FOUND)                                    
-                self.rbfScript.write("mkfs.vfat -n " + partuuid + " " + self.loopDevice + "p"+ index + " &>> rbf.log \n")
+                self.rbfScript.write("mkfs.vfat -n " + partuuid + " " + self.loopDevice + "p"+ index + " &>> " + self.scriptLog + " \n")
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
             elif fs == "swap":
                 if not checkCommandExistsAccess(['mkswap']):
                     logging.error("Please Install mkswap")
                     sys.exit(BoardTemplateParser.SYS_MKFS_COMMANDS_NOT_FOUND)
-                self.rbfScript.write("mkswap -U " + partuuid + " " + self.loopDevice + "p" + index +" &>> rbf.log \n")
+                self.rbfScript.write("mkswap -U " + partuuid + " " + self.loopDevice + "p" + index +" &>> " + self.scriptLog + " \n")
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
             else:
                 if not checkCommandExistsAccess(['mkfs.'+fs]):
                     logging.error("Please Install mkfs."+fs)
                     sys.exit(BoardTemplateParser.SYS_MKFS_COMMANDS_NOT_FOUND)
-                self.rbfScript.write("mkfs." + fs + " -U " + partuuid + " " + self.loopDevice + "p" + index + " &>> rbf.log \n")    
+                initString = ""
+                if init == "lazy" and fs.startswith("ext"):
+                    initString = " -E lazy_itable_init=1,lazy_journal_init=1"
+                elif init == "eager" and fs.startswith("ext"):
+                    initString = " -E lazy_itable_init=0,lazy_journal_init=0"
+                self.rbfScript.write("mkfs." + fs + " -U " + partuuid + initString + " " + self.loopDevice + "p" + index + " &>> " + self.scriptLog + " \n")    
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
                 
+    def createStagingDir(self):
+        """Creates staging directory used instead of mounted partitions in loop free builds"""
+        logging.info("Creating Staging Directory: " + self.workDir)
+        self.addStage("staging", [], ["rootfs"], rerun=True)
+        self.rbfScript.write("mkdir -p " + self.workDir + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MOUNTING_ERROR))
+        for i in range(0, len(self.imageData)):
+            mountpoint = self.imageData[i][BoardTemplateParser.MOUNTPOINT]
+            if self.imageData[i][BoardTemplateParser.PTYPE] != "extended" and mountpoint != "/" and mountpoint != "swap":
+                self.rbfScript.write("mkdir -p " + self.workDir + mountpoint + "\n")
+        self.rbfScript.write("mkdir -p " + self.workDir + "/proc " + self.workDir + "/sys\n")
+
+    def assembleImage(self):
+        """Creates filesystem images from staging directory & writes them into the image at partition offsets"""
+        logging.info("Assembling Image From Staging Directory")
+        partitionsDir = os.path.join(os.path.abspath(self.workspace), "partitions")
+        self.addStage("split", ["extlinux"], ["split"])
+        self.removeEmulator(self.rbfScript)
+        self.rbfScript.write("rm -rf " + partitionsDir + "\nmkdir -p " + partitionsDir + "\n")
+        partitionTrees = {}
+        nonRoot = []
+        for i in range(0, len(self.imageData)):
+            mountpoint = self.imageData[i][BoardTemplateParser.MOUNTPOINT]
+            if self.imageData[i][BoardTemplateParser.PTYPE] != "extended" and mountpoint != "/" and mountpoint != "swap":
+                nonRoot.append((mountpoint.count("/"), mountpoint, self.imageData[i][BoardTemplateParser.INDEX]))
+        # Move deepest mountpoints first so nested partitions are split correctly
+        for depth, mountpoint, index in sorted(nonRoot, reverse=True):
+            partitionTrees[index] = partitionsDir + "/tree-" + index
+            self.rbfScript.write("mv " + self.workDir + mountpoint + " " + partitionTrees[index] + " && mkdir " + self.workDir + mountpoint + "\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
+
+        for i in range(0, len(self.imageData)):
+            if self.imageData[i][BoardTemplateParser.PTYPE] == "extended":
+                continue
+            fs = self.imageData[i][BoardTemplateParser.FS]
+            index = self.imageData[i][BoardTemplateParser.INDEX]
+            partuuid = self.imageData[i][BoardTemplateParser.UUID]
+            mountpoint = self.imageData[i][BoardTemplateParser.MOUNTPOINT]
+            size = self.rbfUtils.getImageSizeInM(self.imageData[i][BoardTemplateParser.SIZE])
+            beginSector = int(self.imageData[i][BoardTemplateParser.BEGIN][0:-1])
+            tree = partitionTrees.get(index, self.workDir)
+            partitionImage = partitionsDir + "/partition-" + index + ".img"
+
+            self.addStage("mkfs-" + index, ["split"], ["filesystem-" + index])
+            self.rbfScript.write("echo [INFO ]   $0 Creating Filesystem " + fs + " for partition " + index + "\n")
+            if fs == "vfat":
+                if not checkCommandExistsAccess(['mkfs.vfat', 'mcopy']):
+                    logging.error("Please Install mkfs.vfat & mtools")
+                    sys.exit(BoardTemplateParser.SYS_MKFS_COMMANDS_NOT_FOUND)
+                self.rbfScript.write("mkfs.vfat -C -n " + partuuid + " " + partitionImage + " " + str(int(size[0:-1])*1024) + " &>> " + self.scriptLog + " \n")
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
+                self.rbfScript.write("if [ -n \"$(ls -A " + tree + ")\" ]; then mcopy -s -p -i " + partitionImage + " " + tree + "/* ::/ &>> " + self.scriptLog + "; fi\n")
+            elif fs == "swap":
+                self.rbfScript.write("truncate -s " + size + " " + partitionImage + " && mkswap -U " + partuuid + " " + partitionImage + " &>> " + self.scriptLog + " \n")
+            else:
+                if not checkCommandExistsAccess(['mkfs.'+fs]):
+                    logging.error("Please Install mkfs."+fs)
+                    sys.exit(BoardTemplateParser.SYS_MKFS_COMMANDS_NOT_FOUND)
+                initString = ""
+                if self.imageData[i][BoardTemplateParser.INIT] == "lazy":
+                    initString = " -E lazy_itable_init=1,lazy_journal_init=1"
+                elif self.imageData[i][BoardTemplateParser.INIT] == "eager":
+                    initString = " -E lazy_itable_init=0,lazy_journal_init=0"
+                self.rbfScript.write("truncate -s " + size + " " + partitionImage + " && mkfs." + fs + " -U " + partuuid + initString + " -d " + tree + " " + partitionImage + " &>> " + self.scriptLog + " \n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
+
+            writeInputs = ["filesystem-" + index, "partitiontable"]
+            if self.autoSize and i == len(self.imageData) - 1:
+                self.addStage("shrink", ["filesystem-" + index] + ["written-" + d[BoardTemplateParser.INDEX] for d in self.imageData[0:-1] if d[BoardTemplateParser.PTYPE] != "extended"], ["shrunk"])
+                self.rbfScript.write("echo [INFO ]   $0 Shrinking Partition " + index + " To Its Content Plus " + self.headroom + "\n")
+                self.rbfScript.write(self.getResizeCommand(partitionImage) + "\n")
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.RESIZE_ERROR))
+                writeInputs = ["shrunk"]
+            self.addStage("write-" + index, writeInputs, ["written-" + index])
+            self.rbfScript.write("echo [INFO ]   $0 Writing partition " + index + " at sector " + str(beginSector) + "\n")
+            self.rbfScript.write("dd if=" + partitionImage + " of=" + self.imagePath + " bs=1M seek=" + str(beginSector*int(self.rbfUtils.SECTOR_SIZE)) + " oflag=seek_bytes conv=notrunc,sparse &>> " + self.scriptLog + " && rm -f " + partitionImage + "\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MKFS_ERROR))
+        return self.executor.run()
+
     def mountPartitions(self):
         """Mounting Partitions"""
+        if self.loopFree:
+            self.createStagingDir()
+            return
         logging.info("Mounting Partitions")
+        filesystems = []
+        for i in range(0, len(self.imageData)):
+            if self.imageData[i][BoardTemplateParser.PTYPE] != "extended":
+                filesystems.append("filesystem-" + self.imageData[i][BoardTemplateParser.INDEX])
+        self.addStage("mount", ["loopdevice"] + filesystems, ["rootfs"], rerun=True)
         self.rbfScript.write("mkdir -p " + self.workDir + "\n")
         for i in range(0, len(self.imageData)):
                 index = self.imageData[i][BoardTemplateParser.INDEX]
@@ -366,10 +1190,96 @@ class BoardTemplateParser():
         self.rbfScript.write("mkdir " + self.workDir + "/proc " + self.workDir + "/sys\n")
         self.rbfScript.write("mount -t proc proc " + self.workDir + "/proc\n")
         
+    def prepareInstallRoot(self):
+        """Chooses where packages are installed. Fast installs stage the installroot on tmpfs if there is enough memory for it.
+        Otherwise fsync is suppressed with eatmydata"""
+        if self.fastInstall == "":
+            return
+        if self.fastInstall == "tmpfs":
+            tmpfsBytes = self.getTmpfsBytes()
+            availableBytes = self.getAvailableMemory()
+            if availableBytes >= tmpfsBytes:
+                self.stageOnTmpfs(tmpfsBytes)
+                return
+            logging.info("Not Enough Memory To Stage Installroot On tmpfs: " + str(tmpfsBytes//(1024*1024)) + "M Needed, " + str(availableBytes//(1024*1024)) + "M Available")
+        for path in os.environ["PATH"].split(":"):
+            if os.access(path + "/eatmydata", os.X_OK):
+                self.noSync = True
+                logging.info("Installing Packages Without fsync Using eatmydata. Rootfs Is Synced Once After Installation")
+                return
+        logging.info("eatmydata Not Found. Installing Packages Directly Into Rootfs")
+
+    def getTmpfsBytes(self):
+        """Returns size of tmpfs for installroot. Defaults to the size of all partitions holding files"""
+        if self.tmpfsSize != "":
+            return self.rbfUtils.getSizeInSectors(self.tmpfsSize)*int(RbfUtils.SECTOR_SIZE)
+        sectors = 0
+        for d in self.imageData:
+            if d[BoardTemplateParser.PTYPE] != "extended" and d[BoardTemplateParser.MOUNTPOINT] != "swap":
+                sectors = sectors + self.rbfUtils.getSizeInSectors(d[BoardTemplateParser.SIZE])
+        return sectors*int(RbfUtils.SECTOR_SIZE)
+
+    def getAvailableMemory(self):
+        """Returns MemAvailable of /proc/meminfo in bytes. 0 if it cannot be read"""
+        try:
+            meminfo = open("/proc/meminfo")
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    meminfo.close()
+                    return int(line.split()[1])*1024
+            meminfo.close()
+        except (IOError, ValueError, IndexError):
+            pass
+        return 0
+
+    def stageOnTmpfs(self, tmpfsBytes):
+        """Mounts tmpfs as installroot. Repos, packages & snapshots use it until it is committed into the rootfs"""
+        self.tmpfsInstall = True
+        self.installRoot = self.workDir + "-install"
+        self.installRootStage = "installroot"
+        self.backend.setInstallRoot(self.installRoot)
+        logging.info("Staging Installroot On tmpfs: " + self.installRoot + " " + str(tmpfsBytes//(1024*1024)) + "M")
+        if self.resume and "commit" not in self.executor.resumeFingerprints:
+            # Packages staged on tmpfs never reached the rootfs. Install them again
+            for name in BoardTemplateParser.TMPFS_STAGES:
+                self.executor.resumeFingerprints.pop(name, None)
+        self.addStage("tmpfs", ["rootfs"], ["installroot"], rerun=True)
+        self.rbfScript.write("mkdir -p " + self.installRoot + " && mount -t tmpfs -o size=" + str(tmpfsBytes//1024) + "k,mode=0755 rbf-install " + self.installRoot + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INSTALLROOT_ERROR))
+        if not self.loopFree:
+            self.rbfScript.write("mkdir -p " + self.installRoot + "/proc && mount -t proc proc " + self.installRoot + "/proc\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INSTALLROOT_ERROR))
+
+    def commitInstallRoot(self):
+        """Copies installroot from tmpfs into the rootfs in one sequential pass & syncs it once. nosync installs are synced once"""
+        if self.noSync:
+            self.rbfScript.write("echo [INFO ]  $0 Syncing Rootfs\n")
+            self.rbfScript.write("sync -f " + self.workDir + "\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INSTALLROOT_ERROR))
+        if not self.tmpfsInstall:
+            return
+        self.addStage("commit", ["installed"], ["packages"])
+        self.rbfScript.write("echo [INFO ]  $0 Copying Installroot From tmpfs To Rootfs\n")
+        self.rbfScript.write("tar --numeric-owner --xattrs --exclude=./proc/* --exclude=." + RbfCache.INSTALLROOT_CACHE_DIR + "/* -cpf - -C " + self.installRoot + " . 2>> " + self.scriptLog + " | tar --numeric-owner --xattrs -xpf - -C " + self.workDir + " 2>> " + self.scriptLog + "\n")
+        self.rbfScript.write("if [ \"${PIPESTATUS[*]}\" != \"0 0\" ]; then exit " + str(BoardTemplateParser.INSTALLROOT_ERROR) + "; fi\n\n")
+        self.unmountInstallRoot(self.rbfScript)
+        self.rbfScript.write("sync -f " + self.workDir + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INSTALLROOT_ERROR))
+
+    def unmountInstallRoot(self, script):
+        """Unmounts package cache, proc & tmpfs of installroot staged on tmpfs"""
+        if self.packageCacheMounted and not self.loopFree:
+            for name in self.repoNames:
+                script.write("umount " + self.installRoot + RbfCache.INSTALLROOT_CACHE_DIR + "/" + self.backend.getCacheDirName(name, self.repoPaths[name]) + " 2>> " + self.scriptLog + "\n")
+        if not self.loopFree:
+            script.write("umount " + self.installRoot + "/proc 2>> " + self.scriptLog + "\n")
+        script.write("umount " + self.installRoot + " 2>> " + self.scriptLog + " && rmdir " + self.installRoot + "\n")
+
     def writeRepos(self):
         """Writes Repos to /etc/yum.repos.d"""
-        self.rbfScript.write("rm -rf " + self.workDir + "/etc/yum.repos.d\n")
-        self.rbfScript.write("mkdir -p " + self.workDir + "/etc/yum.repos.d\n")
+        self.addStage("repos", [self.installRootStage], ["repos"])
+        self.rbfScript.write("rm -rf " + self.installRoot + "/etc/yum.repos.d\n")
+        self.rbfScript.write("mkdir -p " + self.installRoot + "/etc/yum.repos.d\n")
         try:            
             self.reposDom = self.boardDom.getElementsByTagName("repos")
             for repos in self.reposDom:
@@ -378,8 +1288,9 @@ class BoardTemplateParser():
                     name = r.getAttribute("name")
                     path = r.getAttribute("path")
                     self.repoNames.append(name)
+                    self.repoPaths[name] = path
                     logging.info("Found Repo: " + name + " " + path)
-                    repoString = "cat > " + self.workDir + "/etc/yum.repos.d/" + name + ".repo << EOF\n"
+                    repoString = "cat > " + self.installRoot + "/etc/yum.repos.d/" + name + ".repo << EOF\n"
                     repoString = repoString + "["+name+"]\n"
                     repoString = repoString + "name="+name+"\n"
                     repoString = repoString + "baseurl="+path+"\n"
@@ -428,27 +1339,139 @@ class BoardTemplateParser():
         logging.info("Installing Package Groups: " + packageGroupsString)        
         logging.info("Installing Packages: " + packagesString)
         
-        repoEnableString = "--disablerepo=* --enablerepo="
-        for r in self.repoNames:
-            repoEnableString = repoEnableString + r + ","
-        self.rbfScript.write("rpm --root " + self.workDir + " --initdb\n")
+        emulatorInputs = self.installEmulator()
+        packagesOutputs = ["packages"]
+        if self.tmpfsInstall:
+            packagesOutputs = ["installed"]
+        snapshotKey = self.getSnapshotKey()
+        if snapshotKey != None and self.cache.hasSnapshot(snapshotKey):
+            self.addStage("packages", ["repos"] + emulatorInputs, packagesOutputs)
+            snapshotPath = self.cache.getSnapshotPath(snapshotKey)
+            logging.info("Restoring Rootfs Snapshot: " + snapshotPath)
+            self.rbfScript.write("echo [INFO ]  $0 Restoring Rootfs Snapshot. Skipping Package Installation\n")
+            self.rbfScript.write("tar --numeric-owner --xattrs --use-compress-program=" + self.getCompressProgram() + " -xpf " + snapshotPath + " -C " + self.installRoot + " &>> " + self.scriptLog + "\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.SNAPSHOT_ERROR))
+            self.commitInstallRoot()
+            return
+
+        self.backend.setRepos(self.repoNames)
+        self.backend.setCacheOptions(self.mountPackageCache())
+        groupsInputs = ["repos"] + emulatorInputs
+        if self.packageCacheMounted:
+            groupsInputs.append("packagecache")
+        groupsSpecs = packageGroupsString.split()
+        packagesSpecs = packagesString.split()
+        if self.prefetchConnections != 0:
+            self.prefetchPackages(groupsSpecs + packagesSpecs)
+            groupsInputs.append("prefetch")
+            self.backend.setCacheOptions(self.backend.cacheOptions + " -C")
+        installCommands = self.backend.getInstallCommands(groupsSpecs, packagesSpecs)
+        if self.noSync:
+            installCommands = [(kind, "eatmydata " + command) for kind, command in installCommands]
+        self.addStage("groups", groupsInputs, ["groups"], True)
+        self.rbfScript.write("rpm --root " + self.installRoot + " --initdb\n")
         self.rbfScript.write(self.getShellExitString(BoardTemplateParser.RPMDB_INIT_ERROR))
-        if len(packageGroupsString) > 0:
-           self.rbfScript.write("echo [INFO ]  $0 Installing Package Groups. Please Wait\n")
-           self.rbfScript.write("yum "+ repoEnableString[0:-1] + " --installroot=" + self.workDir + " groupinstall " + packageGroupsString+" 2>> rbf.log\n")
-           self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.GROUP_INSTALL_ERROR))
+        for kind, command in installCommands:
+            if kind == RbfPackageBackend.GROUPS:
+                self.rbfScript.write("echo [INFO ]  $0 Installing Package Groups. Please Wait\n")
+                self.rbfScript.write(command + " 2>> " + self.scriptLog + "\n")
+                self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.GROUP_INSTALL_ERROR))
            
-        if len(packagesString) > 0:
-            self.rbfScript.write("echo [INFO ]  $0 Installing Packages. Please Wait\n")
-            self.rbfScript.write("yum "+ repoEnableString[0:-1] + " --installroot=" + self.workDir + " install " + packagesString+" 2>> rbf.log\n")
-            self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.PACKAGE_INSTALL_ERROR))
+        self.addStage("packages", ["groups"], packagesOutputs, True)
+        for kind, command in installCommands:
+            if kind == RbfPackageBackend.PACKAGES:
+                self.rbfScript.write("echo [INFO ]  $0 Installing Packages. Please Wait\n")
+                self.rbfScript.write(command + " 2>> " + self.scriptLog + "\n")
+                self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.PACKAGE_INSTALL_ERROR))
+
+        if snapshotKey != None:
+            snapshotPath = self.cache.getSnapshotPath(snapshotKey)
+            logging.info("Rootfs Snapshot Will Be Saved As: " + snapshotPath)
+            self.rbfScript.write("echo [INFO ]  $0 Saving Rootfs Snapshot\n")
+            self.rbfScript.write("tar --numeric-owner --xattrs --use-compress-program=" + self.getCompressProgram() + " --exclude=./proc/* --exclude=./sys/* --exclude=." + RbfCache.INSTALLROOT_CACHE_DIR + "/* -cpf " + snapshotPath + ".tmp -C " + self.installRoot + " . &>> " + self.scriptLog + " && mv " + snapshotPath + ".tmp " + snapshotPath + " || rm -f " + snapshotPath + ".tmp\n")
+        self.commitInstallRoot()
     
-    def installKernel(self):
-        """Installing Kernel"""
+    def prefetchPackages(self, specs):
+        """Resolves the transaction & downloads all packages concurrently into the package cache.
+        groups & packages are then installed offline from the cache"""
+        self.addStage("prefetch", ["repos", "packagecache"], ["prefetch"])
+        urlsPath = os.path.join(os.path.abspath(self.workspace), "prefetch.urls")
+        self.rbfScript.write("echo [INFO ]  $0 Resolving Packages\n")
+        self.rbfScript.write("rpm --root " + self.installRoot + " --initdb\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.RPMDB_INIT_ERROR))
+        self.rbfScript.write(self.backend.getPrefetchCommand(specs, urlsPath) + " 2>> " + self.scriptLog + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.DOWNLOAD_ERROR))
+        repoDirs = ""
+        for name in self.repoNames:
+            repoDirs = repoDirs + " " + self.repoPaths[name] + "=" + os.path.join(self.cache.getRepoCacheDir(self.repoPaths[name]), "packages")
+        self.rbfScript.write("echo [INFO ]  $0 Downloading Packages With " + str(self.prefetchConnections) + " Connections\n")
+        self.rbfScript.write(sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfprefetch.py") + " " + urlsPath + " " + os.path.abspath(self.prefetchReportPath) + " " + str(self.prefetchConnections) + " " + str(self.prefetchRetries) + repoDirs + " 2>> " + self.scriptLog + " | tee -a " + self.scriptLog + "\n")
+        self.rbfScript.write("if [ ${PIPESTATUS[0]} != 0 ]; then exit " + str(BoardTemplateParser.DOWNLOAD_ERROR) + "; fi\n\n")
+
+    def getCompressProgram(self):
+        """Returns pigz if available for faster snapshots, gzip otherwise"""
+        for path in os.environ["PATH"].split(":"):
+            if os.access(path + "/pigz", os.X_OK):
+                return "pigz"
+        return "gzip"
+
+    def getSnapshotKey(self):
+        """Hashes inputs of package installation. Returns None if snapshots cannot be used.
+        Only builds use snapshots, so parse neither locks the cache nor fetches repo metadata"""
+        if self.cache == None or not self.useSnapshots or self.action != "build":
+            return None
+        snapshotInputs = [self.linuxDistro, self.kernelType, self.targetArch, self.backend.COMMAND, self.backend.getTransactionOptions()]
+        for name in self.repoNames:
+            revision = self.cache.getRepoRevision(self.repoPaths[name])
+            if revision == None:
+                logging.info("Could Not Fetch Metadata For Repo " + name + ". Not Using Rootfs Snapshots")
+                return None
+            snapshotInputs.append(name + " " + self.repoPaths[name] + " " + revision)
+        snapshotInputs.append(" ".join(sorted(self.packageGroups)))
+        snapshotInputs.append(" ".join(sorted(self.packages)))
+        snapshotKey = hashlib.sha1("\n".join(snapshotInputs).encode("utf-8")).hexdigest()
+        logging.info("Rootfs Snapshot Key: " + snapshotKey)
+        return snapshotKey
+
+    def mountPackageCache(self):
+        """Bind mounts (symlinks in loop free builds) host package cache for each repo. Returns package manager options to use it"""
+        if self.cache == None:
+            return ""
+        self.packageCacheMounted = True
+        if self.action == "build":
+            self.cache.beginBuild(self.backend.getMetadataPath())
+        self.addStage("packagecache", [self.installRootStage], ["packagecache"], rerun=True)
+        for name in self.repoNames:
+            repoCacheDir = self.cache.getRepoCacheDir(self.repoPaths[name])
+            cacheDirName = self.backend.getCacheDirName(name, self.repoPaths[name])
+            logging.info("Using Package Cache For Repo " + name + ": " + repoCacheDir)
+            if self.loopFree:
+                self.rbfScript.write("mkdir -p " + self.installRoot + RbfCache.INSTALLROOT_CACHE_DIR + "\n")
+                self.rbfScript.write("ln -sfn " + repoCacheDir + " " + self.installRoot + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+            else:
+                self.rbfScript.write("mkdir -p " + self.installRoot + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+                self.rbfScript.write("mount --bind " + repoCacheDir + " " + self.installRoot + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.MOUNTING_ERROR))
+        cacheString = " --setopt=cachedir=" + RbfCache.INSTALLROOT_CACHE_DIR + " --setopt=keepcache=1"
+        if self.metadataExpire != "":
+            cacheString = cacheString + " --setopt=metadata_expire=" + self.metadataExpire
+        return cacheString
+
+    def updatePackageCache(self):
+        """Updates package cache stats & evicts least recently used packages"""
+        if not self.packageCacheMounted or len(self.repoNames) == 0:
+            return
+        try:
+            installed = subprocess.check_output(["rpm", "--root", self.workDir, "-qa", "--qf", "%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm\n"]).decode("utf-8").split()
+        except (subprocess.CalledProcessError, OSError):
+            installed = []
+        self.cache.endBuild(installed, self.repoPaths)
+
+    def parseKernel(self):
+        """Parses kernel type & custom kernel paths. Stock kernels are added to the packages"""
         if self.ubootPath != "none" and not os.path.exists(self.ubootPath):
             logging.error("Could Not Find uboot in:" + self.ubootPath)
             sys.exit(BoardTemplateParser.NO_UBOOT)
-        logging.info("Installing Kernel")
         kernelDom = self.boardDom.getElementsByTagName("kernel")
         for k in kernelDom:
             if k.hasAttribute("type"):
@@ -464,50 +1487,127 @@ class BoardTemplateParser():
                 self.initrdPath = k.getElementsByTagName('initrd')[0].childNodes[0].data
                 self.dtbDir = k.getElementsByTagName('dtbdir')[0].childNodes[0].data
                 self.dtbFile = k.getElementsByTagName('dtb')[0].childNodes[0].data
-                modulesPath = k.getElementsByTagName('modules')[0].childNodes[0].data
+                self.modulesPath = k.getElementsByTagName('modules')[0].childNodes[0].data
                 logging.info("Using Custom Kernel: " + self.kernelPath)
                 logging.info("Using Initrd: " + self.initrdPath)
-                logging.info("Using Modules: " + modulesPath)
+                logging.info("Using Modules: " + self.modulesPath)
                 logging.info("Using DTP Dir: " + self.dtbDir)
                 logging.info("Using DTB: " + self.dtbFile)
-                self.rbfScript.write("cp -rv " + self.kernelPath + " " + self.initrdPath + " " + self.dtbDir + " " + self.workDir + "/boot &>> rbf.log \n")
-                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
-                self.rbfScript.write("mkdir -p " + self.workDir + "/lib/modules &>> rbf.log \n")
-                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
-                self.rbfScript.write("cp -rv " + modulesPath + " " + self.workDir + "/lib/modules/" + " &>> rbf.log \n")
-                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
         elif self.kernelType == "stock":
-            for k in kernelDom:                
-                logging.info("Using Stock Kernel")
-                self.packages.append('kernel')
-                #Required for generation of generic initramfs
-                self.packages.append('dracut-config-generic')
+            logging.info("Using Stock Kernel")
+            self.packages.append('kernel')
+            #Required for generation of generic initramfs
+            self.packages.append('dracut-config-generic')
+            if self.initramfsCompress != "none":
+                self.packages.append(self.initramfsCompress)
         elif self.kernelType == "none":
             logging.info("Not Installing Any Kernel")
         
         if self.firmwareDir != "none" and not os.path.exists(self.firmwareDir):
             logging.error("Could Not Find Firmware in:" + self.firmwareDir)
             sys.exit(BoardTemplateParser.NO_FIRMWARE_FOUND)
+
+    def installKernel(self):
+        """Installing Custom Kernel & Firmware. Runs after packages so rootfs snapshots stay board independent"""
+        logging.info("Installing Kernel")
+        self.addStage("kernel", ["packages"], ["kernel"])
+        if self.kernelType == "custom":
+            modulesPath = self.modulesPath
+            for path in [self.kernelPath, self.initrdPath, self.dtbDir, modulesPath]:
+                self.rbfScript.addPath(path)
+            self.rbfScript.write("cp -rv " + self.kernelPath + " " + self.initrdPath + " " + self.dtbDir + " " + self.workDir + "/boot &>> " + self.scriptLog + " \n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
+            self.rbfScript.write("mkdir -p " + self.workDir + "/lib/modules &>> " + self.scriptLog + " \n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
+            self.rbfScript.write("cp -rv " + modulesPath + " " + self.workDir + "/lib/modules/" + " &>> " + self.scriptLog + " \n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_KERNEL_ERROR))
             
+        self.addStage("firmware", ["packages"], ["firmware"])
         if self.firmwareDir != "none":
-            self.rbfScript.write("mkdir -p " + self.workDir + "/lib/firmware &>> rbf.log \n")
+            self.rbfScript.addPath(self.firmwareDir)
+            self.rbfScript.write("mkdir -p " + self.workDir + "/lib/firmware &>> " + self.scriptLog + " \n")
             self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_FIRMWARE_ERROR))
-            self.rbfScript.write("cp -rv " + self.firmwareDir + "/* " + self.workDir + "/lib/firmware &>> rbf.log \n")
+            self.rbfScript.write("cp -rv " + self.firmwareDir + "/* " + self.workDir + "/lib/firmware &>> " + self.scriptLog + " \n")
             self.rbfScript.write(self.getShellExitString(BoardTemplateParser.COPY_FIRMWARE_ERROR))
             
     def createInitramfs(self):
-        """Creates Initramfs for stock kernel"""
-        self.initramfsScript = open("initramfs.sh","w")
+        """Creates Initramfs for stock kernels. One stage per kernel, so they are created concurrently.
+        Initramfs images are reused from the cache if kernel, modules, dracut configuration & packages are unchanged"""
+        initramfsOutputs = []
         if self.kernelType == "stock":
             logging.info("Creating Initramfs")
             if not os.path.exists(self.workDir+"/lib/modules"):
                 logging.info("No Kernels Found")
                 self.stockKernels = []
-                return
-            self.stockKernels = os.listdir(self.workDir+"/lib/modules")
+            else:
+                self.stockKernels = sorted(os.listdir(self.workDir+"/lib/modules"))
+            installedPackages = ""
+            if self.cache != None and self.action == "build" and len(self.stockKernels) != 0:
+                try:
+                    installedPackages = subprocess.check_output(["rpm", "--root", self.workDir, "-qa"]).decode("utf-8")
+                except (subprocess.CalledProcessError, OSError):
+                    logging.info("Could Not List Installed Packages. Not Caching Initramfs")
             for kernelVer in self.stockKernels:
-                self.initramfsScript.write("echo [INFO ]  $0 Creating Initramfs\n")                
-                self.initramfsScript.write("chroot "+ self.workDir + " /usr/bin/dracut --no-compress -f /boot/initramfs-" + kernelVer + ".img " + kernelVer + " &>> rbf.log\n")
+                initramfsPath = self.workDir + "/boot/initramfs-" + kernelVer + ".img"
+                self.addStage("initramfs-" + kernelVer, ["finalize"], ["initramfs-" + kernelVer])
+                initramfsOutputs.append("initramfs-" + kernelVer)
+                initramfsKey = None
+                if installedPackages != "":
+                    initramfsKey = self.getInitramfsKey(kernelVer, installedPackages)
+                if initramfsKey != None and self.cache.hasInitramfs(initramfsKey):
+                    logging.info("Reusing Cached Initramfs For Kernel " + kernelVer + ": " + self.cache.getInitramfsPath(initramfsKey))
+                    self.rbfScript.write("echo [INFO ]  $0 Reusing Cached Initramfs For Kernel " + kernelVer + "\n")
+                    self.rbfScript.write("cp " + self.cache.getInitramfsPath(initramfsKey) + " " + initramfsPath + "\n")
+                    self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INITRAMFS_ERROR))
+                    continue
+                self.rbfScript.write("echo [INFO ]  $0 Creating Initramfs For Kernel " + kernelVer + "\n")
+                self.rbfScript.write("chroot "+ self.workDir + " /usr/bin/dracut " + self.getDracutCompressOptions() + " -f /boot/initramfs-" + kernelVer + ".img " + kernelVer + " &>> " + self.scriptLog + "\n")
+                self.rbfScript.write(self.getShellExitString(BoardTemplateParser.INITRAMFS_ERROR))
+                if initramfsKey != None:
+                    cachePath = self.cache.getInitramfsPath(initramfsKey)
+                    logging.info("Initramfs For Kernel " + kernelVer + " Will Be Cached As: " + cachePath)
+                    self.rbfScript.write("cp " + initramfsPath + " " + cachePath + ".tmp && mv " + cachePath + ".tmp " + cachePath + " || rm -f " + cachePath + ".tmp\n")
+        self.addStage("initramfs", ["finalize"] + initramfsOutputs, ["initramfs"])
+        self.initramfsStages = initramfsOutputs + ["initramfs"]
+
+    def getDracutCompressOptions(self):
+        """Returns dracut options for initramfs compression. zstd & xz use threads, 0 uses all cores"""
+        level = ""
+        if self.initramfsLevel != "":
+            level = " -" + self.initramfsLevel
+        if self.initramfsCompress == "zstd":
+            return "--compress \"zstd -q -T" + self.initramfsThreads + level + "\""
+        if self.initramfsCompress == "xz":
+            # Kernels only unpack xz with crc32 checks
+            return "--compress \"xz --check=crc32 --lzma2=dict=1MiB -T" + self.initramfsThreads + level + "\""
+        return "--no-compress"
+
+    def getInitramfsKey(self, kernelVer, installedPackages):
+        """Hashes kernel version, module set, dracut configuration, installed packages & compression of initramfs"""
+        digest = hashlib.sha1((self.targetArch + "\n" + kernelVer + "\n" + self.getDracutCompressOptions() + "\n").encode("utf-8"))
+        digest.update("\n".join(sorted(installedPackages.split())).encode("utf-8"))
+        modulesDir = self.workDir + "/lib/modules/" + kernelVer
+        for root, dirs, files in os.walk(modulesDir):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                try:
+                    digest.update((os.path.relpath(path, modulesDir) + " " + str(os.lstat(path).st_size) + "\n").encode("utf-8"))
+                except OSError:
+                    pass
+        for confPath in BoardTemplateParser.DRACUT_CONF_PATHS:
+            confFiles = [self.workDir + confPath]
+            if os.path.isdir(self.workDir + confPath):
+                confFiles = sorted(glob.glob(self.workDir + confPath + "/*.conf"))
+            for confFile in confFiles:
+                if os.path.isfile(confFile):
+                    digest.update(confFile[len(self.workDir):].encode("utf-8"))
+                    conf = open(confFile, "rb")
+                    digest.update(conf.read())
+                    conf.close()
+        initramfsKey = digest.hexdigest()
+        logging.info("Initramfs Key For Kernel " + kernelVer + ": " + initramfsKey)
+        return initramfsKey
     
     def finalActions(self):
         """Sets Hostname, Root Pass, SELinux Status & runs Board Script & Finalize Script"""
@@ -516,30 +1616,75 @@ class BoardTemplateParser():
         hostnameConfig.close()
         
         logging.info("Copying Etc Overlay: " + self.etcOverlay)
-        self.rbfScript.write("cp -rpv "+ self.etcOverlay + " " + self.workDir+" &>> rbf.log \n")
+        self.addStage("overlay", ["packages", "kernel", "firmware"], ["overlay"])
+        self.rbfScript.addPath(self.etcOverlay)
+        self.rbfScript.write("cp -rpv "+ self.etcOverlay + " " + self.workDir+" &>> " + self.scriptLog + " \n")
         self.rbfScript.write(self.getShellExitString(BoardTemplateParser.ETC_OVERLAY_ERROR))
+        if self.autoSize:
+            self.installGrowService()
         
         logging.info("Setting empty root pass")
-        self.rbfScript.write("sed -i 's/root:x:/root::/' " + self.workDir + "/etc/passwd  &>> rbf.log \n")
+        self.addStage("rootpass", ["overlay"], ["rootpass"], True)
+        self.rbfScript.write("sed -i 's/root:x:/root::/' " + self.workDir + "/etc/passwd  &>> " + self.scriptLog + " \n")
         self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.ROOT_PASS_ERROR))
         
         logging.info("Setting SELinux status to " + self.selinuxConf)
-        self.rbfScript.write("sed -i 's/SELINUX=enforcing/SELINUX=" + self.selinuxConf + "/' " + self.workDir + "/etc/selinux/config  &>> rbf.log \n")
+        self.addStage("selinux", ["rootpass"], ["selinux"], True)
+        self.rbfScript.write("sed -i 's/SELINUX=enforcing/SELINUX=" + self.selinuxConf + "/' " + self.workDir + "/etc/selinux/config  &>> " + self.scriptLog + " \n")
         self.rbfScript.write(self.getShellErrorString(BoardTemplateParser.SELINUX_ERROR))
         
+        self.addStage("board", ["selinux"], ["board"])
         if os.path.isfile("boards.d/"+self.boardName+".sh"):
+            self.rbfScript.addPath("boards.d/"+self.boardName+".sh")
             logging.info("Board Script: " + "boards.d/"+self.boardName+".sh")
             self.rbfScript.write("echo [INFO ]  $0 Running Board Script: " + "boards.d/"+self.boardName+".sh\n")
             self.rbfScript.write("./boards.d/" + self.boardName + ".sh " + self.imagePath + " " + self.ubootPath  + " " + self.workDir + " " + self.rootFiles + "\n")
             self.rbfScript.write(self.getShellExitString(BoardTemplateParser.BOARD_SCRIPT_ERROR))
         
         logging.info("Finalize Script: " + self.finalizeScript)
+        self.addStage("finalize", ["board"], ["finalize"])
+        if os.path.isfile(self.finalizeScript.split()[0]):
+            self.rbfScript.addPath(self.finalizeScript.split()[0])
         self.rbfScript.write("echo [INFO ]  $0 Running Finalize Script: " + self.finalizeScript +"\n")
         self.rbfScript.write(self.finalizeScript+"\n")
         self.rbfScript.write(self.getShellExitString(BoardTemplateParser.FINALIZE_SCRIPT_ERROR))
-        self.rbfScript.write("exit 0\n")
-        self.rbfScript.close()
+        self.executor.writeScript(self.rbfScriptPath, self.getScriptHeader())
     
+    def installGrowService(self):
+        """Installs a service growing the last partition & its filesystem to fill the disk on first boot"""
+        logging.info("Installing First Boot Service Growing Partition " + self.imageData[-1][BoardTemplateParser.INDEX] + " To Fill The Disk")
+        partitionNumbers = [self.imageData[-1][BoardTemplateParser.INDEX]]
+        if self.imageData[-1][BoardTemplateParser.PTYPE] == "logical":
+            partitionNumbers = [d[BoardTemplateParser.INDEX] for d in self.imageData if d[BoardTemplateParser.PTYPE] == "extended"] + partitionNumbers
+        growScript = "#!/bin/sh\n"
+        growScript = growScript + "# Generated by RootFS Build Factory. Grows partition " + partitionNumbers[-1] + " & its filesystem to fill the disk once\n"
+        growScript = growScript + "DISK=/dev/$(lsblk -n -o PKNAME $(findmnt -n -o SOURCE /) | head -n 1)\n"
+        if self.partitionTable.table == RbfPartitionTable.GPT:
+            growScript = growScript + "sfdisk --relocate gpt-bak-std $DISK\n"
+        for number in partitionNumbers:
+            growScript = growScript + "echo \", +\" | sfdisk --force --no-reread -N " + number + " $DISK || exit 1\n"
+        growScript = growScript + "partx -u $DISK\n"
+        growScript = growScript + "for P in /sys/block/$(basename $DISK)/*/partition; do\n"
+        growScript = growScript + "    if [ \"$(cat $P)\" = \"" + partitionNumbers[-1] + "\" ]; then PARTITION=/dev/$(basename $(dirname $P)); fi\n"
+        growScript = growScript + "done\n"
+        growScript = growScript + "resize2fs $PARTITION || exit 1\n"
+        growScript = growScript + "systemctl disable " + BoardTemplateParser.GROWFS_SERVICE + "\n"
+        growService = "[Unit]\nDescription=Grow Last Partition To Fill The Disk\nAfter=local-fs.target\n\n"
+        growService = growService + "[Service]\nType=oneshot\nExecStart=" + BoardTemplateParser.GROWFS_SCRIPT + "\n\n"
+        growService = growService + "[Install]\nWantedBy=multi-user.target\n"
+        self.rbfScript.write("mkdir -p " + self.workDir + os.path.dirname(BoardTemplateParser.GROWFS_SCRIPT) + " " + self.workDir + "/etc/systemd/system/multi-user.target.wants\n")
+        self.rbfScript.write("cat > " + self.workDir + BoardTemplateParser.GROWFS_SCRIPT + " << 'EOF'\n" + growScript + "EOF\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.ETC_OVERLAY_ERROR))
+        self.rbfScript.write("chmod 755 " + self.workDir + BoardTemplateParser.GROWFS_SCRIPT + "\n")
+        self.rbfScript.write("cat > " + self.workDir + "/etc/systemd/system/" + BoardTemplateParser.GROWFS_SERVICE + " << 'EOF'\n" + growService + "EOF\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.ETC_OVERLAY_ERROR))
+        self.rbfScript.write("ln -sf ../" + BoardTemplateParser.GROWFS_SERVICE + " " + self.workDir + "/etc/systemd/system/multi-user.target.wants/" + BoardTemplateParser.GROWFS_SERVICE + "\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.ETC_OVERLAY_ERROR))
+
+    def getResizeCommand(self, fsPath):
+        """Returns command shrinking the last partition in fsPath & truncating the image"""
+        return sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfresize.py") + " " + self.imagePath + " " + fsPath + " " + self.headroom + " " + " ".join(self.partitionTable.getCommandArgs()) + " &>> " + self.scriptLog
+
     def getPartition(self,mountpoint):
         """Gets Partition UUID/LABEL From Dict"""
         for i in range(0,len(self.imageData)):
@@ -559,12 +1704,13 @@ class BoardTemplateParser():
             
     def extLinuxConf(self):
         """Creating extlinux.conf"""
-        if self.extLinuxConf == "false":
-            self.initramfsScript.close()
+        self.addStage("extlinux", ["initramfs"], ["extlinux"])
+        if self.extlinuxConf == "false":
+            self.executor.writeScript(self.initramfsScriptPath, self.getScriptHeader(), self.initramfsStages + ["extlinux"])
             return
 
-        self.initramfsScript.write("mkdir " + self.workDir +"/boot/extlinux\n")
-        self.initramfsScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
+        self.rbfScript.write("mkdir " + self.workDir +"/boot/extlinux\n")
+        self.rbfScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
         
         extlinuxContents = "#Created by RootFS Build Factory\nui menu.c32\nmenu autoboot " + self.linuxDistro + "\nmenu title " + self.linuxDistro +" Options\n#menu hidden\ntimeout 60\ntotaltimeout 600\n"
         if self.kernelType == "custom":
@@ -579,15 +1725,15 @@ class BoardTemplateParser():
             extlinuxContents = extlinuxContents + "label " + self.linuxDistro + "\n\t" + "kernel " + bootKernelPath +"\n\tappend enforcing=0 root=" + self.getPartition("/") +"\n\t" + "fdtdir " + bootFdtdir +"\n"
             if bootInitrdPath != "none":
                 extlinuxContents = extlinuxContents + "\tinitrd " + bootInitrdPath + "\n"
-            self.initramfsScript.write ("cat > " + self.workDir +"/boot/extlinux/extlinux.conf << EOF\n" + extlinuxContents + "EOF\n")
-            self.initramfsScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
+            self.rbfScript.write ("cat > " + self.workDir +"/boot/extlinux/extlinux.conf << EOF\n" + extlinuxContents + "EOF\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
         elif self.kernelType == "stock":
             for kernelVer in self.stockKernels:
                 extlinuxContents = extlinuxContents + "label " + self.linuxDistro + "\n\t" + "kernel /vmlinuz-" + kernelVer + "\n\tappend enforcing=0 root=" + self.getPartition("/") + "\n\tfdtdir /dtb-" + kernelVer + "\n\tinitrd /initramfs-" + kernelVer + ".img\n\n"
-            self.initramfsScript.write ("cat > " + self.workDir +"/boot/extlinux/extlinux.conf << EOF\n" + extlinuxContents + "EOF\n")
-            self.initramfsScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
+            self.rbfScript.write ("cat > " + self.workDir +"/boot/extlinux/extlinux.conf << EOF\n" + extlinuxContents + "EOF\n")
+            self.rbfScript.write(self.getShellExitString(BoardTemplateParser.EXTLINUXCONF_ERROR))
             
-        self.initramfsScript.close()
+        self.executor.writeScript(self.initramfsScriptPath, self.getScriptHeader(), self.initramfsStages + ["extlinux"])
             
     def makeBootable(self):
         """Creates /etc/fstab"""
@@ -654,10 +1800,36 @@ class BoardTemplateParser():
                     ifcfg.write("DEVICE=" + name + "\nBOOTPROTO=dhcp\nNM_CONTROLLED=no\nONBOOT=yes\n")
                     ifcfg.close()
         
-    def cleanUp(self):
-        """CleanUp Steps"""
+    def cleanUp(self, exitCode=0):
+        """CleanUp Steps. exitCode of the build is recorded in the report"""
         logging.info("Clean Up")
-        self.cleanupScript = open("cleanup.sh","w")
+        self.cleanupScript = open(self.cleanupScriptPath,"w")
+        self.cleanupScript.write(self.getScriptHeader())
+        self.cleanupScript.write("LOOPDEVICE=$(cat " + self.loopDeviceFile + " 2> /dev/null)\n")
+        if self.action == "build":
+            self.updatePackageCache()
+        if self.tmpfsInstall:
+            self.unmountInstallRoot(self.cleanupScript)
+        if self.packageCacheMounted:
+            # Package caches of an installroot staged on tmpfs are unmounted with it
+            for name in [n for n in self.repoNames if not self.tmpfsInstall]:
+                cacheDirName = self.backend.getCacheDirName(name, self.repoPaths[name])
+                if self.loopFree:
+                    self.cleanupScript.write("rm -f " + self.workDir + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+                else:
+                    self.cleanupScript.write("umount " + self.workDir + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+                    self.cleanupScript.write("rmdir " + self.workDir + RbfCache.INSTALLROOT_CACHE_DIR + "/" + cacheDirName + "\n")
+            self.cleanupScript.write("rmdir " + self.workDir + RbfCache.INSTALLROOT_CACHE_DIR + "\n")
+        if self.loopFree:
+            if exitCode != 0:
+                logging.info("Keeping Staging Directory For --resume: " + self.workDir)
+            else:
+                self.cleanupScript.write("rm -rf --one-file-system " + self.workDir + " " + os.path.join(os.path.abspath(self.workspace), "partitions") + "\n")
+            self.cleanupScript.write("exit 0\n")
+            self.cleanupScript.close()
+            self.runCleanupScript(exitCode)
+            return
+        self.removeEmulator(self.cleanupScript)
         for i in range(0,len(self.imageData)):
             if self.imageData[i][BoardTemplateParser.PTYPE] == "extended":
                 continue
@@ -666,82 +1838,183 @@ class BoardTemplateParser():
 
         self.cleanupScript.write("umount " + self.workDir + "/proc\n")
         self.cleanupScript.write("umount " + self.workDir + "\n")
+        resizeRet = "0"
+        if self.autoSize and exitCode == 0 and self.action == "build":
+            logging.info("Shrinking Partition " + self.imageData[-1][BoardTemplateParser.INDEX] + " To Its Content Plus " + self.headroom)
+            self.cleanupScript.write(self.getResizeCommand(self.loopDevice + "p" + self.imageData[-1][BoardTemplateParser.INDEX]) + "\n")
+            self.cleanupScript.write("RESIZERET=$?; if [ $RESIZERET != 0 ]; then RESIZERET=" + str(BoardTemplateParser.RESIZE_ERROR) + "; fi\n")
+            resizeRet = "$RESIZERET"
         self.cleanupScript.write(self.delDeviceIfExists(self.loopDevice))
-        self.cleanupScript.write("exit 0\n")
+        self.cleanupScript.write("rm -f " + self.loopDeviceFile + "\n")
+        self.cleanupScript.write("exit " + resizeRet + "\n")
         self.cleanupScript.close()
+        self.runCleanupScript(exitCode)
+
+    def writeOutputs(self):
+        """Writes block map, Android sparse, qcow2 & compressed images & delta of the finished raw image. Returns exit code of output script"""
+        outputScript = open(self.outputScriptPath, "w")
+        outputScript.write(self.getScriptHeader())
+        imageFormats = [f for f in self.outputFormats if f in ["bmap", "sparse"]]
+        if len(imageFormats) != 0:
+            logging.info("Writing " + " & ".join(imageFormats) + " Of " + self.imagePath)
+            outputScript.write("echo [INFO ]  $0 Mapping Blocks Of " + self.imagePath + "\n")
+            outputScript.write(sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfoutput.py") + " " + self.imagePath + " " + " ".join(imageFormats) + " 2>> " + self.scriptLog + " | tee -a " + self.scriptLog + "\n")
+            outputScript.write("if [ ${PIPESTATUS[0]} != 0 ]; then exit " + str(BoardTemplateParser.OUTPUT_ERROR) + "; fi\n\n")
+        if "qcow2" in self.outputFormats:
+            logging.info("Writing qcow2 Image: " + self.imagePath + ".qcow2")
+            outputScript.write("echo [INFO ]  $0 Converting " + self.imagePath + " To qcow2\n")
+            outputScript.write("qemu-img convert -f raw -O qcow2 " + self.imagePath + " " + self.imagePath + ".qcow2 &>> " + self.scriptLog + "\n")
+            outputScript.write(self.getShellExitString(BoardTemplateParser.OUTPUT_ERROR))
+        compressFormats = [f for f in self.outputFormats if f in ["gz", "xz"]]
+        if len(compressFormats) != 0 or "manifest" in self.outputFormats:
+            # Compressed images & manifest are written in one pass over the raw image. Partitions are named after their mountpoints
+            labels = [d[BoardTemplateParser.INDEX] + "=" + d[BoardTemplateParser.MOUNTPOINT] + ":" + d[BoardTemplateParser.FS] for d in self.imageData if d[BoardTemplateParser.PTYPE] != "extended"]
+            logging.info("Writing " + " & ".join(compressFormats + ["manifest"]) + " Of " + self.imagePath)
+            outputScript.write("echo [INFO ]  $0 Compressing " + self.imagePath + "\n")
+            outputScript.write(sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfcompress.py") + " " + self.imagePath + " " + (",".join(compressFormats) or "none") + " " + self.outputThreads + " " + self.outputFrameSize + " " + self.outputLevel + " " + " ".join(labels) + " 2>> " + self.scriptLog + " | tee -a " + self.scriptLog + "\n")
+            outputScript.write("if [ ${PIPESTATUS[0]} != 0 ]; then exit " + str(BoardTemplateParser.OUTPUT_ERROR) + "; fi\n\n")
+        if self.outputDelta != "":
+            logging.info("Writing Delta From " + self.outputDelta + ": " + self.imagePath + ".delta")
+            outputScript.write("echo [INFO ]  $0 Writing Delta From " + self.outputDelta + " To " + self.imagePath + "\n")
+            outputScript.write(sys.executable + " " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rbfdelta.py") + " create " + self.outputDelta + " " + self.imagePath + " " + self.imagePath + ".delta 2>> " + self.scriptLog + " | tee -a " + self.scriptLog + "\n")
+            outputScript.write("if [ ${PIPESTATUS[0]} != 0 ]; then exit " + str(BoardTemplateParser.OUTPUT_ERROR) + "; fi\n\n")
+        outputScript.write("exit 0\n")
+        outputScript.close()
+        return self.executor.runRecorded("output", self.outputScriptPath)
+
+    def runCleanupScript(self, exitCode):
+        """Runs generated cleanup script, writes outputs of successful builds & report"""
         if self.action == "build":
-            cleanupRet = subprocess.call(["/usr/bin/bash", "cleanup.sh"])
+            cleanupRet = self.executor.runRecorded("cleanup", self.cleanupScriptPath)
             if cleanupRet != 0:
-                logging.error (boardParser.RbfScriptErrors[cleanupRet])
+                logging.error (self.RbfScriptErrors.get(cleanupRet, "Clean Up Failed. Log: " + os.path.join(self.executor.stageDir, "cleanup.log")))
+                self.writeReport(BoardTemplateParser.CLEANUP_ERROR)
                 sys.exit(BoardTemplateParser.CLEANUP_ERROR)
-        logging.info("If you need any help, please provide rbf.log rbf.sh initramfs.sh cleanup.sh " + self.xmlTemplate + " and the above output.")
+            if exitCode == 0 and (len(self.outputFormats) != 0 or self.outputDelta != ""):
+                outputRet = self.writeOutputs()
+                if outputRet != 0:
+                    logging.error(self.RbfScriptErrors.get(outputRet, "Output Failed. Log: " + os.path.join(self.executor.stageDir, "output.log")))
+                    self.writeReport(outputRet)
+                    sys.exit(outputRet)
+            self.writeReport(exitCode)
+            if exitCode == 0 and os.path.exists(self.checkpointPath):
+                os.remove(self.checkpointPath)
+        logging.info("If you need any help, please provide " + self.logFile + " " + self.rbfScriptPath + " " + self.initramfsScriptPath + " " + self.cleanupScriptPath + " " + self.outputScriptPath + " " + self.executor.stageDir + " " + self.xmlTemplate + " and the above output.")
 
         
 if ( __name__ == "__main__"): 
-    initLogging()
-    if os.getuid() != 0:
-        logging.error("You need to be root to use RootFS Build Factory")
+    arguments = parseArguments(sys.argv[1:])
+    if arguments == None or len(arguments[0]) < 2:
+        initLogging(".")
+        printUsage()
+        sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)
+    positional, options = arguments
+    if options["--jobs"] != None and (not options["--jobs"].isdigit() or int(options["--jobs"]) < 1):
+        initLogging(None)
+        logging.error("Invalid Number Of Jobs: " + options["--jobs"])
+        sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)
+    if positional[0] == "lint":
+        initLogging(None)
+        sys.exit(lintMany(positional[1:], int(options["--jobs"] or multiprocessing.cpu_count())))
+    if positional[0] == "delta" or positional[0] == "delta-apply":
+        initLogging(None)
+        if len(positional) < 3 or len(positional) > 4 or (positional[0] == "delta-apply" and len(positional) != 4):
+            printUsage()
+            sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)
+        sys.exit(deltaImages(positional[0], positional[1:]))
+    if positional[0] == "flash":
+        initLogging(None)
+        if len(positional) < 3:
+            printUsage()
+            sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)
+        sys.exit(flashImage(positional[1], positional[2:], options["--board"], options["--uboot"], options["--allow-file"]))
+    workspace = options["--workspace"]
+    if workspace == None and positional[0] == "build-many":
+        workspace = "builds"
+    elif workspace == None:
+        workspace = getDefaultWorkspace(positional[1])
+    initLogging(workspace)
+    if os.getuid() != 0 and not options["--loopfree"]:
+        logging.error("You need to be root to use RootFS Build Factory. Use --loopfree to build without root")
         sys.exit(BoardTemplateParser.NOT_ROOT)
+    if os.getuid() != 0:
+        logging.info("Not Running As Root. Package installation needs a user namespace with mapped ids, Eg. podman unshare")
         
-    if len(sys.argv) != 3:
+    action = positional[0]
+    xmlTemplates = positional[1:]
+    if action != "build-many" and len(xmlTemplates) != 1:
         printUsage()
         sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)
-          
-    action = sys.argv[1]
-    xmlTemplate = sys.argv[2]
     
-    if not os.path.exists(xmlTemplate):
-        logging.error("XML Template Not Found: " + xmlTemplate)
-        sys.exit(BoardTemplateParser.TEMPLATE_NOT_FOUND)
-        
-    if action == "build" and not platform.uname()[5].startswith("arm"):
-        logging.error("This script is not meant to be run on " + platform.uname()[5])
+    for xmlTemplate in xmlTemplates:
+        if not os.path.exists(xmlTemplate):
+            logging.error("XML Template Not Found: " + xmlTemplate)
+            sys.exit(BoardTemplateParser.TEMPLATE_NOT_FOUND)
         
     
         
-    if checkCommandExistsAccess(['echo', 'fallocate','parted','read','losetup','mount','mkdir','rm','cat','cp','rpm','yum','sed','chroot','partprobe']):
+    requiredCommands = ['echo', 'fallocate','read','mkdir','rm','cat','cp','rpm','sed','chroot']
+    if options["--loopfree"]:
+        requiredCommands = requiredCommands + ['truncate', 'dd', 'mv', 'ln']
+    else:
+        requiredCommands = requiredCommands + ['losetup', 'mount']
+    if checkCommandExistsAccess(requiredCommands):
         logging.info("All Commands Found. Continuing")
     else:
         logging.error("Cannot Continue")
         sys.exit(BoardTemplateParser.COMMANDS_NOT_FOUND)
     
-    if sys.argv[1] == "parse" or sys.argv[1] == "build":
+    if action == "parse" or action == "build" or action == "build-many":
         logging.info("Arguments Correct. Continuing")
     else:
         printUsage()
         sys.exit(BoardTemplateParser.INCORRECT_ARGUMENTS)    
+
+    if action == "build-many":
+        flags = [flag for flag in ["--loopfree", "--resume", "--non-interactive"] if options[flag]]
+        sys.exit(buildMany(xmlTemplates, int(options["--jobs"] or "1"), flags))
     
-    boardParser = BoardTemplateParser(action, xmlTemplate)
+    xmlTemplate = xmlTemplates[0]
+    boardParser = BoardTemplateParser(action, xmlTemplate, workspace, options["--loopfree"], options["--resume"], options["--non-interactive"])
     boardParser.parseTemplate()
     boardParser.createImage()
     boardParser.createPartitions()
     boardParser.createFilesystems()
     boardParser.mountPartitions()
+    boardParser.prepareInstallRoot()
     boardParser.writeRepos()
-    boardParser.installKernel()
+    boardParser.parseKernel()
     boardParser.installPackages()
+    boardParser.installKernel()
     boardParser.makeBootable()
     #boardParser.configureNetwork()
     boardParser.finalActions()    
     
     if action == "build":
-        logging.info("Running RootFS Build Factory script")
-        rbfRet = subprocess.call(["/usr/bin/bash", "rbf.sh"])
+        logging.info("Running RootFS Build Factory stages")
+        rbfRet = boardParser.executor.run()
         if rbfRet == 0:
-            logging.info("Successfully Executed rbf.sh")
+            logging.info("Successfully Executed All Stages")
         else:
-            logging.info("rbf Exit Code: " + str(rbfRet))
-            logging.error (boardParser.RbfScriptErrors[rbfRet])
-            boardParser.cleanUp()
+            logging.info("rbf Exit Code: " + str(rbfRet) + " Failed Stage: " + str(boardParser.executor.failedStage))
+            logging.error (boardParser.RbfScriptErrors.get(rbfRet, "Stage Failed: " + str(boardParser.executor.failedStage)))
+            boardParser.cleanUp(rbfRet)
             sys.exit(rbfRet)
             
         boardParser.createInitramfs()    
         boardParser.extLinuxConf()
-        initramfsRet = subprocess.call(["/usr/bin/bash", "initramfs.sh"])
+        initramfsRet = boardParser.executor.run()
         if initramfsRet != 0:                    
-            logging.error(boardParser.RbfScriptErrors[initramfsRet])
-            boardParser.cleanUp()
-            sys.exit(rbfRet)
+            logging.error(boardParser.RbfScriptErrors.get(initramfsRet, "Stage Failed: " + str(boardParser.executor.failedStage)))
+            boardParser.cleanUp(initramfsRet)
+            sys.exit(initramfsRet)
+
+        if boardParser.loopFree:
+            assembleRet = boardParser.assembleImage()
+            if assembleRet != 0:
+                logging.error(boardParser.RbfScriptErrors.get(assembleRet, "Stage Failed: " + str(boardParser.executor.failedStage)))
+                boardParser.cleanUp(assembleRet)
+                sys.exit(assembleRet)
         
     boardParser.cleanUp()
     sys.exit(0)
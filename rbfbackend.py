@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+"""@package rbfbackend
+Package Manager Backends For RootFS Build Factory
+
+Generate the shell commands that install packages into the rootfs with yum or dnf
+"""
+
+import os
+import hashlib
+
+class RbfPackageBackend():
+    """RbfPackageBackend Class.
+
+    Base class of package manager backends. Commands are generated for an installroot & a list of repos.
+    Subclasses set COMMAND & PREFETCH_COMMAND and implement
+    getInstallCommands(groups, packages) returning List of (GROUPS or PACKAGES, command) installing groups & packages, and
+    getPrefetchCommand(specs, urlsPath) returning a command resolving specs, writing package URLs to urlsPath if the backend lists URLs
+    """
+    COMMAND = None
+    PREFETCH_COMMAND = None
+    GROUPS, PACKAGES = ("groups", "packages")
+
+    def __init__(self, installRoot, nonInteractive):
+        """Constructor for RbfPackageBackend"""
+        self.installRoot = installRoot
+        self.nonInteractive = nonInteractive
+        self.repoNames = []
+        self.cacheOptions = ""
+
+    def setInstallRoot(self, installRoot):
+        """Packages are installed into installRoot"""
+        self.installRoot = installRoot
+
+    def setRepos(self, repoNames):
+        """Only repoNames are enabled"""
+        self.repoNames = repoNames
+
+    def setCacheOptions(self, cacheOptions):
+        """Options pointing the backend to the package cache"""
+        self.cacheOptions = cacheOptions
+
+    def getCacheDirName(self, name, baseurl):
+        """Returns name of directory the backend keeps packages & metadata of repo in, below its cachedir"""
+        return name
+
+    def getMetadataPath(self):
+        """Returns path of repomd.xml relative to the cache directory of a repo"""
+        return "repomd.xml"
+
+    def getOptions(self):
+        """Returns options common to all commands of the backend"""
+        options = "--disablerepo=* --enablerepo=" + ",".join(self.repoNames) + self.cacheOptions + " --installroot=" + self.installRoot
+        if self.nonInteractive:
+            options = "-y " + options
+        return options
+
+    def getTransactionOptions(self):
+        """Returns options that change what gets installed, leaving out -y, the installroot & the package cache"""
+        cacheOptions = self.cacheOptions.split()
+        return " ".join([o for o in self.getOptions().split() if o != "-y" and not o.startswith("--installroot=") and o not in cacheOptions])
+
+class RbfYumBackend(RbfPackageBackend):
+    """RbfYumBackend Class.
+
+    Installs groups & packages in two yum transactions. Prefetch lists URLs with yumdownloader
+    """
+    COMMAND = "yum"
+    PREFETCH_COMMAND = "yumdownloader"
+
+    def getInstallCommands(self, groups, packages):
+        """Returns groupinstall & install commands"""
+        commands = []
+        if len(groups) != 0:
+            commands.append((RbfPackageBackend.GROUPS, "yum " + self.getOptions() + " groupinstall " + " ".join(groups)))
+        if len(packages) != 0:
+            commands.append((RbfPackageBackend.PACKAGES, "yum " + self.getOptions() + " install " + " ".join(packages)))
+        return commands
+
+    def getPrefetchCommand(self, specs, urlsPath):
+        """Returns yumdownloader command writing URLs of all packages of the transaction to urlsPath"""
+        options = self.getOptions()
+        if options.startswith("-y "):
+            options = options[3:]
+        return "yumdownloader " + options + " --resolve --urls " + " ".join(specs) + " > " + urlsPath
+
+class RbfDnfBackend(RbfPackageBackend):
+    """RbfDnfBackend Class.
+
+    Installs groups & packages in a single dnf transaction. Prefetch lists URLs with dnf download
+    """
+    COMMAND = "dnf"
+    PREFETCH_COMMAND = "dnf"
+
+    def __init__(self, installRoot, nonInteractive, parallelDownloads="", installWeakDeps="", releaseVer="", forceArch=""):
+        """Constructor for RbfDnfBackend. Empty settings keep the dnf defaults. forceArch installs packages of another architecture"""
+        RbfPackageBackend.__init__(self, installRoot, nonInteractive)
+        self.parallelDownloads = parallelDownloads
+        self.installWeakDeps = installWeakDeps
+        self.releaseVer = releaseVer
+        self.forceArch = forceArch
+
+    def getCacheDirName(self, name, baseurl):
+        """dnf keeps each repo in <repo id>-<first 16 hex digits of sha256 of baseurl>"""
+        return name + "-" + hashlib.sha256(baseurl.encode("utf-8")).hexdigest()[0:16]
+
+    def getMetadataPath(self):
+        """dnf keeps repomd.xml in repodata/ of the repo's cache directory"""
+        return os.path.join("repodata", "repomd.xml")
+
+    def getOptions(self):
+        """Adds parallel downloads, weak deps, release version & architecture to common options"""
+        options = RbfPackageBackend.getOptions(self)
+        if self.parallelDownloads != "":
+            options = options + " --setopt=max_parallel_downloads=" + self.parallelDownloads
+        if self.installWeakDeps != "":
+            options = options + " --setopt=install_weak_deps=" + str(self.installWeakDeps == "true")
+        if self.releaseVer != "":
+            options = options + " --releasever=" + self.releaseVer
+        if self.forceArch != "":
+            options = options + " --forcearch=" + self.forceArch
+        return options
+
+    def getInstallCommands(self, groups, packages):
+        """Returns one install command for groups & packages"""
+        specs = list(groups) + list(packages)
+        if len(specs) == 0:
+            return []
+        return [(RbfPackageBackend.PACKAGES, "dnf " + self.getOptions() + " install " + " ".join(specs))]
+
+    def getPrefetchCommand(self, specs, urlsPath):
+        """Returns dnf download command writing URLs of all packages of the transaction to urlsPath. Needs the download plugin"""
+        options = self.getOptions()
+        if options.startswith("-y "):
+            options = options[3:]
+        return "dnf " + options + " download --resolve --urls " + " ".join(specs) + " > " + urlsPath
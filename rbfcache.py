@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""@package rbfcache
+Host Level Cache For RootFS Build Factory
+
+Keeps downloaded RPMs and repo metadata across builds
+"""
+
+import os
+import logging
+import hashlib
+import fcntl
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+class RbfCache():
+    """RbfCache Class.
+
+    Cache directory shared between builds. Package caches are keyed by repo baseurl
+    """
+    DEFAULT_CACHE_DIR = "/var/cache/rbf"
+    DEFAULT_MAX_SIZE = "10G"
+    PACKAGES_DIR = "packages"
+    SNAPSHOTS_DIR = "snapshots"
+    INITRAMFS_DIR = "initramfs"
+    INSTALLROOT_CACHE_DIR = "/var/cache/rbf"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, cacheDir, maxSize):
+        """Constructor for RbfCache. maxSize is in M"""
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxSize = int(maxSize)
+        self.packagesBefore = set()
+        self.metadataBefore = set()
+        self.metadataPath = "repomd.xml"
+        self.buildLock = None
+
+    def getRepoKey(self, baseurl):
+        """Returns Cache Key For Repo baseurl"""
+        return hashlib.sha1(baseurl.strip().rstrip("/").encode("utf-8")).hexdigest()[0:16]
+
+    def getRepoCacheDir(self, baseurl):
+        """Returns Cache Directory For Repo, Creating It If Required"""
+        repoCacheDir = os.path.join(self.cacheDir, RbfCache.PACKAGES_DIR, self.getRepoKey(baseurl))
+        if not os.path.isdir(repoCacheDir):
+            os.makedirs(repoCacheDir)
+            baseurlFile = open(os.path.join(repoCacheDir, "baseurl"), "w")
+            baseurlFile.write(baseurl + "\n")
+            baseurlFile.close()
+        return repoCacheDir
+
+    def listPackages(self):
+        """Returns Dict of RPM file name -> full path for all cached packages"""
+        packages = {}
+        for root, dirs, files in os.walk(os.path.join(self.cacheDir, RbfCache.PACKAGES_DIR)):
+            for f in files:
+                if f.endswith(".rpm"):
+                    packages[f] = os.path.join(root, f)
+        return packages
+
+    def listMetadata(self):
+        """Returns Set of Repo Keys with cached repomd.xml. metadataPath is where the backend keeps it in the repo's cache directory"""
+        metadata = set()
+        packagesDir = os.path.join(self.cacheDir, RbfCache.PACKAGES_DIR)
+        if not os.path.isdir(packagesDir):
+            return metadata
+        for repoKey in os.listdir(packagesDir):
+            if os.path.exists(os.path.join(packagesDir, repoKey, self.metadataPath)):
+                metadata.add(repoKey)
+        return metadata
+
+    def getRepoRevision(self, baseurl):
+        """Returns checksum of repo's repomd.xml. None if it cannot be fetched"""
+        try:
+            repomd = urlopen(baseurl.rstrip("/") + "/repodata/repomd.xml", timeout=30)
+            revision = hashlib.sha1(repomd.read()).hexdigest()
+            repomd.close()
+        except Exception:
+            return None
+        return revision
+
+    def getSnapshotPath(self, key):
+        """Returns path of rootfs snapshot for key"""
+        snapshotsDir = os.path.join(self.cacheDir, RbfCache.SNAPSHOTS_DIR)
+        if not os.path.isdir(snapshotsDir):
+            os.makedirs(snapshotsDir)
+        return os.path.join(snapshotsDir, key + ".tar.gz")
+
+    def hasSnapshot(self, key):
+        """Checks if rootfs snapshot exists for key. Marks it as recently used"""
+        self.lockBuild()
+        snapshotPath = self.getSnapshotPath(key)
+        if not os.path.exists(snapshotPath):
+            return False
+        os.utime(snapshotPath, None)
+        return True
+
+    def getInitramfsPath(self, key):
+        """Returns path of cached initramfs for key"""
+        initramfsDir = os.path.join(self.cacheDir, RbfCache.INITRAMFS_DIR)
+        if not os.path.isdir(initramfsDir):
+            os.makedirs(initramfsDir)
+        return os.path.join(initramfsDir, key + ".img")
+
+    def hasInitramfs(self, key):
+        """Checks if initramfs is cached for key. Marks it as recently used"""
+        self.lockBuild()
+        initramfsPath = self.getInitramfsPath(key)
+        if not os.path.exists(initramfsPath):
+            return False
+        os.utime(initramfsPath, None)
+        return True
+
+    def listCachedFiles(self):
+        """Returns list of all evictable files. Packages, rootfs snapshots & initramfs images"""
+        cachedFiles = list(self.listPackages().values())
+        for cachedDir, suffix in [(RbfCache.SNAPSHOTS_DIR, ".tar.gz"), (RbfCache.INITRAMFS_DIR, ".img")]:
+            cachedDir = os.path.join(self.cacheDir, cachedDir)
+            if os.path.isdir(cachedDir):
+                for f in os.listdir(cachedDir):
+                    if f.endswith(suffix):
+                        cachedFiles.append(os.path.join(cachedDir, f))
+        return cachedFiles
+
+    def lockBuild(self):
+        """Takes a shared lock held till endBuild. Files handed out to a running build are never evicted"""
+        if self.buildLock != None:
+            return
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        self.buildLock = open(os.path.join(self.cacheDir, RbfCache.LOCK_FILE), "a")
+        fcntl.flock(self.buildLock, fcntl.LOCK_SH)
+
+    def unlockBuild(self):
+        """Releases the shared lock of the build"""
+        if self.buildLock == None:
+            return
+        fcntl.flock(self.buildLock, fcntl.LOCK_UN)
+        self.buildLock.close()
+        self.buildLock = None
+
+    def beginBuild(self, metadataPath):
+        """Locks the cache for the build & records its state before package installation"""
+        self.lockBuild()
+        self.metadataPath = metadataPath
+        self.packagesBefore = set(self.listPackages().keys())
+        self.metadataBefore = self.listMetadata()
+
+    def endBuild(self, installedPackages, repoPaths):
+        """Logs hit/miss stats, marks hits as recently used & evicts old packages"""
+        cachedPackages = self.listPackages()
+        hits = 0
+        misses = 0
+        downloaded = 0
+        for rpm in installedPackages:
+            if rpm in self.packagesBefore:
+                hits = hits + 1
+                try:
+                    os.utime(cachedPackages[rpm], None)
+                except (KeyError, OSError):
+                    pass
+            else:
+                misses = misses + 1
+                if rpm in cachedPackages:
+                    downloaded = downloaded + os.path.getsize(cachedPackages[rpm])
+
+        for name in repoPaths:
+            repoKey = self.getRepoKey(repoPaths[name])
+            if repoKey in self.metadataBefore:
+                logging.info("Package Cache: Metadata Reused For Repo: " + name)
+            else:
+                logging.info("Package Cache: Metadata Fetched For Repo: " + name)
+        logging.info("Package Cache: " + str(hits) + " Hits " + str(misses) + " Misses " + str(downloaded//(1024*1024)) + "M Downloaded")
+        self.unlockBuild()
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used packages & snapshots till cache size is below maxSize.
+        Skipped while other builds hold their shared lock. The last build to finish evicts"""
+        if not os.path.isdir(self.cacheDir):
+            return
+        lockFile = open(os.path.join(self.cacheDir, RbfCache.LOCK_FILE), "a")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lockFile.close()
+            logging.info("Package Cache: Other Builds Running. Eviction Skipped")
+            return
+        try:
+            packages = []
+            totalSize = 0
+            for path in self.listCachedFiles():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                packages.append((stat.st_mtime, stat.st_size, path))
+                totalSize = totalSize + stat.st_size
+
+            maxSize = self.maxSize*1024*1024
+            evicted = 0
+            packages.sort()
+            for mtime, size, path in packages:
+                if totalSize <= maxSize:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                totalSize = totalSize - size
+                evicted = evicted + 1
+            if evicted != 0:
+                logging.info("Package Cache: Evicted " + str(evicted) + " Files")
+            logging.info("Package Cache: Size " + str(totalSize//(1024*1024)) + "M of " + str(self.maxSize) + "M")
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+"""@package rbfcompress
+Compressed Artifacts For RootFS Build Factory
+
+Compresses an image into seekable multi frame gzip & xz files on all cores & writes a checksum manifest
+"""
+
+import os
+import sys
+import logging
+import time
+import json
+import zlib
+import struct
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class RbfCompressor():
+    """RbfCompressor Class.
+
+    The image is read once in frames. Every frame is compressed on its own, as a gzip member or an xz stream,
+    so gzip -d & xz -d read the files as usual and a reader can start at any frame using the seek index.
+    Checksums of the image, its partitions & the compressed files are calculated in the same pass
+    """
+    FORMATS = {"gz": ".gz", "xz": ".xz"}
+    DEFAULT_FRAME_SIZE = 4*1024*1024
+    DEFAULT_LEVEL = 6
+    SECTOR_SIZE = 512
+    GPT_SIGNATURE = b"EFI PART"
+    EXTENDED_TYPES = [0x05, 0x0f, 0x85]
+
+    def __init__(self, imagePath, formats, threads=0, frameSize=DEFAULT_FRAME_SIZE, level=DEFAULT_LEVEL):
+        """Constructor for RbfCompressor. threads 0 uses all cores"""
+        for f in formats:
+            if f not in RbfCompressor.FORMATS:
+                raise ValueError("Unknown Compression Format: " + f + ". Use gz or xz")
+        if "xz" in formats and lzma == None:
+            raise ValueError("xz Compression Needs lzma Module")
+        self.imagePath = imagePath
+        self.formats = formats
+        self.threads = threads or multiprocessing.cpu_count()
+        self.frameSize = frameSize
+        self.level = level
+        self.labels = {}
+
+    def setLabel(self, number, label):
+        """Names partition number in the manifest. Eg. its mountpoint & filesystem"""
+        self.labels[number] = label
+
+    def readPartitions(self, image):
+        """Returns List of (number, first byte, size in bytes) from the msdos or gpt table of image"""
+        image.seek(0)
+        mbr = image.read(RbfCompressor.SECTOR_SIZE)
+        if len(mbr) < RbfCompressor.SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+            return []
+        image.seek(RbfCompressor.SECTOR_SIZE)
+        gptHeader = image.read(92)
+        partitions = []
+        if gptHeader[0:8] == RbfCompressor.GPT_SIGNATURE:
+            entriesLba, entries, entrySize = struct.unpack("<QII", gptHeader[72:88])
+            image.seek(entriesLba*RbfCompressor.SECTOR_SIZE)
+            table = image.read(entries*entrySize)
+            for i in range(0, entries):
+                entry = table[i*entrySize:(i + 1)*entrySize]
+                first, last = struct.unpack("<QQ", entry[32:48])
+                if entry[0:16] != b"\0"*16:
+                    partitions.append((i + 1, first*RbfCompressor.SECTOR_SIZE, (last - first + 1)*RbfCompressor.SECTOR_SIZE))
+            return partitions
+        extendedBegin = None
+        for i in range(0, 4):
+            ptype, begin, sectors = struct.unpack("<xxxxB3xII", mbr[446 + i*16:462 + i*16])
+            if ptype in RbfCompressor.EXTENDED_TYPES:
+                # The extended partition only holds logical ones
+                extendedBegin = begin
+            elif ptype != 0 and sectors != 0:
+                partitions.append((i + 1, begin*RbfCompressor.SECTOR_SIZE, sectors*RbfCompressor.SECTOR_SIZE))
+        # Logical partitions are chained through EBRs, relative to the start of the extended partition
+        ebr = extendedBegin
+        number = 5
+        while ebr != None:
+            image.seek(ebr*RbfCompressor.SECTOR_SIZE)
+            sector = image.read(RbfCompressor.SECTOR_SIZE)
+            if len(sector) < RbfCompressor.SECTOR_SIZE or sector[510:512] != b"\x55\xaa":
+                break
+            ptype, begin, sectors = struct.unpack("<xxxxB3xII", sector[446:462])
+            if ptype != 0 and sectors != 0:
+                partitions.append((number, (ebr + begin)*RbfCompressor.SECTOR_SIZE, sectors*RbfCompressor.SECTOR_SIZE))
+                number = number + 1
+            nextType, nextBegin = struct.unpack("<xxxxB3xI4x", sector[462:478])
+            ebr = None
+            if nextType in RbfCompressor.EXTENDED_TYPES and nextBegin != 0:
+                ebr = extendedBegin + nextBegin
+        return partitions
+
+    def compressFrame(self, task):
+        """Compresses frame data into one gzip member or xz stream"""
+        compressFormat, data = task
+        if compressFormat == "gz":
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.level)
+
+    def readFrames(self, image, count):
+        """Returns up to count frames read from image"""
+        frames = []
+        for i in range(0, count):
+            data = image.read(self.frameSize)
+            if len(data) == 0:
+                break
+            frames.append(data)
+        return frames
+
+    def run(self, manifestPath):
+        """Writes compressed files & manifest. Returns manifest"""
+        startTime = time.time()
+        imageSize = os.path.getsize(self.imagePath)
+        image = open(self.imagePath, "rb")
+        partitions = self.readPartitions(image)
+        image.seek(0)
+        imageDigest = hashlib.sha256()
+        partitionDigests = [hashlib.sha256() for p in partitions]
+        outputs = {}
+        for f in self.formats:
+            outputs[f] = {"file": open(self.imagePath + RbfCompressor.FORMATS[f], "wb"), "digest": hashlib.sha256(), "frames": [], "size": 0}
+        zeroFrame = b"\0"*self.frameSize
+        zeroCompressed = {}
+        pool = ThreadPool(self.threads)
+        offset = 0
+        try:
+            while True:
+                # Read a few frames per thread at a time, so memory use does not grow with the image
+                frames = self.readFrames(image, self.threads*2)
+                if len(frames) == 0:
+                    break
+                tasks = []
+                for f in self.formats:
+                    for data in frames:
+                        if data != zeroFrame:
+                            tasks.append((f, data))
+                compressed = iter(pool.map(self.compressFrame, tasks))
+                for data in frames:
+                    imageDigest.update(data)
+                    for i in range(0, len(partitions)):
+                        number, begin, size = partitions[i]
+                        overlapBegin = max(begin, offset)
+                        overlapEnd = min(begin + size, offset + len(data))
+                        if overlapBegin < overlapEnd:
+                            partitionDigests[i].update(data[overlapBegin - offset:overlapEnd - offset])
+                    offset = offset + len(data)
+                for f in self.formats:
+                    frameOffset = offset - sum([len(d) for d in frames])
+                    for data in frames:
+                        if data == zeroFrame:
+                            if f not in zeroCompressed:
+                                zeroCompressed[f] = self.compressFrame((f, zeroFrame))
+                            frame = zeroCompressed[f]
+                        else:
+                            frame = next(compressed)
+                        output = outputs[f]
+                        output["frames"].append([frameOffset, output["size"], len(frame)])
+                        output["file"].write(frame)
+                        output["digest"].update(frame)
+                        output["size"] = output["size"] + len(frame)
+                        frameOffset = frameOffset + len(data)
+        finally:
+            pool.close()
+            pool.join()
+            image.close()
+            for f in self.formats:
+                outputs[f]["file"].close()
+        duration = time.time() - startTime
+
+        manifest = {"image": os.path.basename(self.imagePath), "size": imageSize, "sha256": imageDigest.hexdigest(), "partitions": [], "artifacts": []}
+        for i in range(0, len(partitions)):
+            number, begin, size = partitions[i]
+            manifest["partitions"].append({"number": number, "label": self.labels.get(number, ""), "offset": begin, "size": size, "sha256": partitionDigests[i].hexdigest()})
+        for f in self.formats:
+            output = outputs[f]
+            manifest["artifacts"].append({"file": os.path.basename(self.imagePath) + RbfCompressor.FORMATS[f], "format": f, "size": output["size"], "sha256": output["digest"].hexdigest(), "frameSize": self.frameSize, "frames": output["frames"]})
+            logging.info("Compressed " + self.imagePath + " To " + self.imagePath + RbfCompressor.FORMATS[f] + ": " + str(output["size"]//(1024*1024)) + "M In " + str(len(output["frames"])) + " Frames")
+        logging.info("Compressed " + str(imageSize//(1024*1024)) + "M In " + str(round(duration, 1)) + "s " + str(round(imageSize/max(duration, 0.001)/(1024*1024), 1)) + "M/s With " + str(self.threads) + " Threads")
+        manifestFile = open(manifestPath, "w")
+        json.dump(manifest, manifestFile, indent=2, sort_keys=True)
+        manifestFile.write("\n")
+        manifestFile.close()
+        logging.info("Manifest: " + manifestPath)
+        return manifest
+
+    def readFrame(self, compressedPath, manifest, imageOffset):
+        """Returns uncompressed frame of artifact compressedPath holding byte imageOffset of the image"""
+        artifact = [a for a in manifest["artifacts"] if a["file"] == os.path.basename(compressedPath)][0]
+        frameOffset, compressedOffset, compressedSize = artifact["frames"][imageOffset//artifact["frameSize"]]
+        compressed = open(compressedPath, "rb")
+        compressed.seek(compressedOffset)
+        frame = compressed.read(compressedSize)
+        compressed.close()
+        if artifact["format"] == "gz":
+            return zlib.decompress(frame, 31)
+        return lzma.decompress(frame, format=lzma.FORMAT_XZ)
+
+if __name__ == "__main__":
+    # rbfcompress.py <image> <gz,xz|none> <threads> <frame size in M> <level> [<partition number>=<label>...]. Writes <image>.manifest.json
+    if len(sys.argv) < 6 or not sys.argv[3].isdigit() or not sys.argv[4].isdigit() or not sys.argv[5].isdigit():
+        sys.stderr.write("Usage: rbfcompress.py <image> <gz,xz|none> <threads> <frame size in M> <level> [<partition number>=<label>...]\n")
+        sys.exit(1)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    formats = [f for f in sys.argv[2].split(",") if f != "none"]
+    try:
+        compressor = RbfCompressor(sys.argv[1], formats, int(sys.argv[3]), int(sys.argv[4])*1024*1024, int(sys.argv[5]))
+        for label in sys.argv[6:]:
+            number, name = label.split("=", 1)
+            compressor.setLabel(int(number), name)
+        compressor.run(sys.argv[1] + ".manifest.json")
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+"""@package rbfdelta
+Delta Images For RootFS Build Factory
+
+Writes block level deltas between two builds of an image, partition by partition, & rebuilds the new image from the old one
+"""
+
+import os
+import sys
+import logging
+import time
+import json
+import zlib
+import struct
+import hashlib
+from rbfcompress import RbfCompressor
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class RbfDelta():
+    """RbfDelta Class.
+
+    Every partition of the new image is compared block by block with the same partition of the old image, found by
+    its number in the partition table, so partitions that moved or grew still match. Space outside partitions is
+    compared at the same offsets. Blocks are taken from the same place in the old partition, from anywhere else in it,
+    written as zeros or stored. Operations & stored blocks are compressed into one stream followed by a trailer holding
+    the layout & sha256 checksums of both images & of every partition of the new image
+    """
+    MAGIC = b"RBFDELTA"
+    VERSION = 1
+    BLOCK_SIZE = 4096
+    READ_BLOCKS = 256
+    MAX_DATA_BLOCKS = 256
+    OP_FORMAT = "<BQQ"
+    TRAILER_FORMAT = "<Q"
+    OP_SAME, OP_MOVE, OP_ZERO, OP_DATA = range(0, 4)
+
+    def __init__(self, oldPath, newPath, blockSize=BLOCK_SIZE):
+        """Constructor for RbfDelta"""
+        self.oldPath = oldPath
+        self.newPath = newPath
+        self.blockSize = blockSize
+
+    def hashFile(self, path):
+        """Returns sha256 of file"""
+        digest = hashlib.sha256()
+        f = open(path, "rb")
+        data = f.read(self.blockSize*RbfDelta.READ_BLOCKS)
+        while len(data) != 0:
+            digest.update(data)
+            data = f.read(self.blockSize*RbfDelta.READ_BLOCKS)
+        f.close()
+        return digest.hexdigest()
+
+    def getRegions(self, oldImage, newImage, oldSize, newSize):
+        """Returns List of regions of the new image, each with the matching region of the old image. Number 0 is space outside partitions"""
+        oldPartitions = {}
+        for number, begin, size in RbfCompressor(self.oldPath, []).readPartitions(oldImage):
+            oldPartitions[number] = (begin, size)
+        regions = []
+        offset = 0
+        for number, begin, size in sorted(RbfCompressor(self.newPath, []).readPartitions(newImage), key=lambda p: p[1]):
+            if begin > offset:
+                regions.append({"number": 0, "offset": offset, "size": begin - offset, "oldOffset": offset, "oldSize": begin - offset})
+            oldBegin, oldPartitionSize = oldPartitions.get(number, (begin, 0))
+            regions.append({"number": number, "offset": begin, "size": min(size, newSize - begin), "oldOffset": oldBegin, "oldSize": oldPartitionSize})
+            offset = begin + size
+        if offset < newSize:
+            regions.append({"number": 0, "offset": offset, "size": newSize - offset, "oldOffset": offset, "oldSize": newSize - offset})
+        for region in regions:
+            # Images shrunk by size auto may end before the old partition does
+            region["oldSize"] = max(0, min(region["oldSize"], oldSize - region["oldOffset"]))
+        return regions
+
+    def indexBlocks(self, oldImage, region):
+        """Returns Dictionary of sha1 of every full non zero block of the old region to its first block number"""
+        index = {}
+        zeroBlock = b"\0"*self.blockSize
+        oldImage.seek(region["oldOffset"])
+        block = 0
+        remaining = region["oldSize"]
+        while remaining >= self.blockSize:
+            data = oldImage.read(min(remaining, self.blockSize*RbfDelta.READ_BLOCKS))
+            if len(data) == 0:
+                break
+            for i in range(0, len(data) - self.blockSize + 1, self.blockSize):
+                blockData = data[i:i + self.blockSize]
+                if blockData != zeroBlock:
+                    index.setdefault(hashlib.sha1(blockData).digest(), block)
+                block = block + 1
+            remaining = remaining - len(data)
+        return index
+
+    def getCompressor(self):
+        """Returns compression name & compressor for the operations stream. xz if available"""
+        if lzma != None:
+            return "xz", lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=9)
+        return "zlib", zlib.compressobj(9)
+
+    def create(self, deltaPath):
+        """Writes delta from old image to new image. Returns trailer"""
+        startTime = time.time()
+        oldSize = os.path.getsize(self.oldPath)
+        newSize = os.path.getsize(self.newPath)
+        oldImage = open(self.oldPath, "rb")
+        moveImage = open(self.oldPath, "rb")
+        newImage = open(self.newPath, "rb")
+        delta = open(deltaPath, "wb")
+        compressionName, compressor = self.getCompressor()
+        delta.write(RbfDelta.MAGIC + struct.pack("<I", RbfDelta.VERSION))
+        newDigest = hashlib.sha256()
+        zeroBlock = b"\0"*self.blockSize
+        counts = [0, 0, 0, 0]
+        pending = []
+
+        def flush():
+            """Writes pending operation"""
+            if len(pending) == 0:
+                return
+            op, count, oldBlock, data = pending
+            delta.write(compressor.compress(struct.pack(RbfDelta.OP_FORMAT, op, count, oldBlock) + b"".join(data)))
+            del pending[:]
+
+        def add(op, oldBlock, data):
+            """Adds one block to pending operation or starts a new one"""
+            if len(pending) != 0 and pending[0] == op and (op != RbfDelta.OP_MOVE or pending[2] + pending[1] == oldBlock) and (op != RbfDelta.OP_DATA or pending[1] < RbfDelta.MAX_DATA_BLOCKS):
+                pending[1] = pending[1] + 1
+                if data != None:
+                    pending[3].append(data)
+            else:
+                flush()
+                pending.extend([op, 1, oldBlock, [data] if data != None else []])
+            counts[op] = counts[op] + 1
+
+        try:
+            regions = self.getRegions(oldImage, newImage, oldSize, newSize)
+            for region in regions:
+                regionDigest = hashlib.sha256()
+                index = None
+                newImage.seek(region["offset"])
+                oldImage.seek(region["oldOffset"])
+                block = 0
+                remaining = region["size"]
+                while remaining > 0:
+                    data = newImage.read(min(remaining, self.blockSize*RbfDelta.READ_BLOCKS))
+                    if len(data) == 0:
+                        raise IOError("Unexpected End Of " + self.newPath)
+                    oldData = b""
+                    if block*self.blockSize < region["oldSize"]:
+                        oldData = oldImage.read(min(len(data), region["oldSize"] - block*self.blockSize))
+                    newDigest.update(data)
+                    regionDigest.update(data)
+                    for i in range(0, len(data), self.blockSize):
+                        blockData = data[i:i + self.blockSize]
+                        if blockData == oldData[i:i + self.blockSize]:
+                            add(RbfDelta.OP_SAME, 0, None)
+                        elif blockData == zeroBlock[0:len(blockData)]:
+                            add(RbfDelta.OP_ZERO, 0, None)
+                        else:
+                            oldBlock = None
+                            if len(blockData) == self.blockSize and region["oldSize"] >= self.blockSize:
+                                if index == None:
+                                    # Index the old region only once a block differs
+                                    index = self.indexBlocks(moveImage, region)
+                                oldBlock = index.get(hashlib.sha1(blockData).digest())
+                            if oldBlock != None:
+                                moveImage.seek(region["oldOffset"] + oldBlock*self.blockSize)
+                                if moveImage.read(self.blockSize) != blockData:
+                                    oldBlock = None
+                            if oldBlock != None:
+                                add(RbfDelta.OP_MOVE, oldBlock, None)
+                            else:
+                                add(RbfDelta.OP_DATA, 0, blockData)
+                    block = block + (len(data) + self.blockSize - 1)//self.blockSize
+                    remaining = remaining - len(data)
+                flush()
+                region["sha256"] = regionDigest.hexdigest()
+            delta.write(compressor.flush())
+            trailer = {"oldSize": oldSize, "oldSha256": self.hashFile(self.oldPath), "newSize": newSize, "newSha256": newDigest.hexdigest(), "blockSize": self.blockSize, "compression": compressionName, "regions": regions}
+            trailerData = json.dumps(trailer, sort_keys=True).encode("utf-8")
+            delta.write(trailerData + struct.pack(RbfDelta.TRAILER_FORMAT, len(trailerData)) + RbfDelta.MAGIC)
+        finally:
+            delta.close()
+            newImage.close()
+            moveImage.close()
+            oldImage.close()
+        deltaSize = os.path.getsize(deltaPath)
+        for region in regions:
+            logging.info("Region " + str(region["number"]) + " At " + str(region["offset"]) + ": " + str(region["size"]//(1024*1024)) + "M")
+        logging.info("Blocks: " + str(counts[RbfDelta.OP_SAME]) + " Unchanged, " + str(counts[RbfDelta.OP_MOVE]) + " Moved, " + str(counts[RbfDelta.OP_ZERO]) + " Zero, " + str(counts[RbfDelta.OP_DATA]) + " Stored")
+        logging.info("Delta " + deltaPath + ": " + str(deltaSize//1024) + "K For " + str(newSize//(1024*1024)) + "M Image (" + str(round(100.0*deltaSize/max(newSize, 1), 2)) + "%) In " + str(round(time.time() - startTime, 1)) + "s")
+        return trailer
+
+    def readTrailer(self, delta):
+        """Returns trailer & end of operations stream of open delta file"""
+        delta.seek(0)
+        if delta.read(len(RbfDelta.MAGIC)) != RbfDelta.MAGIC or struct.unpack("<I", delta.read(4))[0] != RbfDelta.VERSION:
+            raise ValueError("Not A Delta Of This Version: " + delta.name)
+        tailSize = struct.calcsize(RbfDelta.TRAILER_FORMAT) + len(RbfDelta.MAGIC)
+        delta.seek(-tailSize, os.SEEK_END)
+        tail = delta.read(tailSize)
+        if tail[-len(RbfDelta.MAGIC):] != RbfDelta.MAGIC:
+            raise ValueError("Delta Is Truncated: " + delta.name)
+        trailerSize = struct.unpack(RbfDelta.TRAILER_FORMAT, tail[0:struct.calcsize(RbfDelta.TRAILER_FORMAT)])[0]
+        delta.seek(-tailSize - trailerSize, os.SEEK_END)
+        streamEnd = delta.tell()
+        return json.loads(delta.read(trailerSize).decode("utf-8")), streamEnd
+
+    def apply(self, deltaPath, checkOld=True):
+        """Rebuilds new image, which may be a device, from old image & delta. Verifies every region & the whole image"""
+        startTime = time.time()
+        if os.path.exists(self.newPath) and os.path.realpath(self.newPath) == os.path.realpath(self.oldPath):
+            raise ValueError("New Image Cannot Replace Old Image In Place: " + self.newPath)
+        delta = open(deltaPath, "rb")
+        trailer, streamEnd = self.readTrailer(delta)
+        if trailer["compression"] == "xz" and lzma == None:
+            raise ValueError("Delta Is Compressed With xz. Needs lzma Module")
+        if checkOld and (os.path.getsize(self.oldPath) != trailer["oldSize"] or self.hashFile(self.oldPath) != trailer["oldSha256"]):
+            raise ValueError("Old Image " + self.oldPath + " Is Not The Image This Delta Was Made From")
+        blockSize = trailer["blockSize"]
+        decompressor = zlib.decompressobj()
+        if trailer["compression"] == "xz":
+            decompressor = lzma.LZMADecompressor()
+        delta.seek(len(RbfDelta.MAGIC) + 4)
+        streamData = [b"", delta.tell()]
+
+        def read(size):
+            """Returns next size bytes of operations stream"""
+            while len(streamData[0]) < size:
+                chunk = delta.read(min(blockSize*RbfDelta.READ_BLOCKS, streamEnd - streamData[1]))
+                if len(chunk) == 0:
+                    raise ValueError("Delta Is Corrupted: " + deltaPath)
+                streamData[1] = streamData[1] + len(chunk)
+                streamData[0] = streamData[0] + decompressor.decompress(chunk)
+            data = streamData[0][0:size]
+            streamData[0] = streamData[0][size:]
+            return data
+
+        oldImage = open(self.oldPath, "rb")
+        newImage = os.open(self.newPath, os.O_WRONLY | os.O_CREAT)
+        regularFile = os.path.isfile(self.newPath)
+        newDigest = hashlib.sha256()
+        try:
+            if regularFile:
+                os.ftruncate(newImage, 0)
+                os.ftruncate(newImage, trailer["newSize"])
+            for region in trailer["regions"]:
+                regionDigest = hashlib.sha256()
+                os.lseek(newImage, region["offset"], os.SEEK_SET)
+                block = 0
+                blocks = (region["size"] + blockSize - 1)//blockSize
+                while block < blocks:
+                    op, count, oldBlock = struct.unpack(RbfDelta.OP_FORMAT, read(struct.calcsize(RbfDelta.OP_FORMAT)))
+                    if op not in [RbfDelta.OP_SAME, RbfDelta.OP_MOVE, RbfDelta.OP_ZERO, RbfDelta.OP_DATA]:
+                        raise ValueError("Delta Is Corrupted: " + deltaPath)
+                    if op == RbfDelta.OP_SAME:
+                        oldBlock = block
+                    offset = 0
+                    length = min(count*blockSize, region["size"] - block*blockSize)
+                    while offset < length:
+                        # Long runs of unchanged blocks are copied a chunk at a time
+                        chunkSize = min(length - offset, blockSize*RbfDelta.READ_BLOCKS)
+                        if op == RbfDelta.OP_ZERO:
+                            data = b"\0"*chunkSize
+                        elif op == RbfDelta.OP_DATA:
+                            data = read(chunkSize)
+                        else:
+                            oldImage.seek(region["oldOffset"] + oldBlock*blockSize + offset)
+                            data = oldImage.read(chunkSize)
+                        if len(data) != chunkSize:
+                            raise ValueError("Old Image " + self.oldPath + " Is Too Short For Delta")
+                        regionDigest.update(data)
+                        newDigest.update(data)
+                        if regularFile and (op == RbfDelta.OP_ZERO or data == b"\0"*chunkSize):
+                            # Zeros stay holes in image files
+                            os.lseek(newImage, chunkSize, os.SEEK_CUR)
+                        else:
+                            written = 0
+                            while written < len(data):
+                                written = written + os.write(newImage, data[written:])
+                        offset = offset + chunkSize
+                    block = block + count
+                if regionDigest.hexdigest() != region["sha256"]:
+                    raise ValueError("Checksum Mismatch In Region " + str(region["number"]) + " At " + str(region["offset"]))
+            os.fsync(newImage)
+        finally:
+            os.close(newImage)
+            oldImage.close()
+            delta.close()
+        if newDigest.hexdigest() != trailer["newSha256"]:
+            raise ValueError("Checksum Mismatch Of " + self.newPath)
+        logging.info("Rebuilt & Verified " + self.newPath + ": " + str(trailer["newSize"]//(1024*1024)) + "M In " + str(round(time.time() - startTime, 1)) + "s")
+        return trailer
+
+if __name__ == "__main__":
+    # rbfdelta.py create <old image> <new image> [delta] | rbfdelta.py apply <old image> <delta> <new image>. delta defaults to <new image>.delta
+    if len(sys.argv) < 4 or sys.argv[1] not in ["create", "apply"] or len(sys.argv) > 5 or (sys.argv[1] == "apply" and len(sys.argv) != 5):
+        sys.stderr.write("Usage: rbfdelta.py create <old image> <new image> [delta]\n       rbfdelta.py apply <old image> <delta> <new image>\n")
+        sys.exit(1)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    try:
+        if sys.argv[1] == "create":
+            deltaPath = sys.argv[3] + ".delta"
+            if len(sys.argv) == 5:
+                deltaPath = sys.argv[4]
+            RbfDelta(sys.argv[2], sys.argv[3]).create(deltaPath)
+        else:
+            RbfDelta(sys.argv[2], sys.argv[4]).apply(sys.argv[3])
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+"""@package rbfexecutor
+Stage Executor For RootFS Build Factory
+
+Runs build stages concurrently as soon as their inputs are available
+"""
+
+import os
+import subprocess
+import logging
+import time
+import threading
+import json
+import hashlib
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+class RbfStage():
+    """RbfStage Class.
+
+    Shell commands for one build step. Declares the inputs it needs & the outputs it provides.
+    Interactive stages may prompt the user, they run alone with the console attached.
+    Rerun stages, like attaching & mounting the image, are never restored from a checkpoint.
+    The failure policy decides if a failed stage aborts the build, only warns or is retried with backoff.
+    Emulated stages run target binaries through qemu-user in cross builds
+    """
+    ABORT, WARN, RETRY = "abort", "warn", "retry"
+
+    def __init__(self, name, inputs, outputs, interactive=False, rerun=False):
+        """Constructor for RbfStage"""
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.interactive = interactive
+        self.rerun = rerun
+        self.commands = []
+        self.paths = []
+        self.policy = RbfStage.ABORT
+        self.retries = 0
+        self.backoff = 0
+        self.emulated = False
+
+    def write(self, command):
+        """Appends shell commands to stage"""
+        self.commands.append(command)
+
+    def getScript(self):
+        """Returns shell commands of stage"""
+        return "".join(self.commands)
+
+    def setPolicy(self, policy, retries=0, backoff=0):
+        """Sets failure policy. Retried stages wait backoff seconds, doubled after every attempt"""
+        if policy not in [RbfStage.ABORT, RbfStage.WARN, RbfStage.RETRY]:
+            raise ValueError("Unknown Failure Policy " + policy + " For Stage " + self.name)
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+
+    def addPath(self, path):
+        """Adds file or directory used by stage. Its contents are part of the stage fingerprint"""
+        self.paths.append(path)
+
+class RbfExecutor():
+    """RbfExecutor Class.
+
+    Runs stages on a worker pool. Each stage gets its own script & log in stageDir.
+    Wall time, CPU time & bytes written by its processes are recorded for each stage.
+    Metrics are global counters, so their change is only recorded for stages that ran alone.
+    Stages overlapping others are marked overlapped instead. Costly metrics can be limited to the stages they matter for
+    """
+    def __init__(self, stageDir, jobs, prelude, metrics=None, metricStages=None):
+        """Constructor for RbfExecutor. prelude is prepended to every stage script.
+        metrics is a Dict of name -> function returning a counter, sampled before & after each stage.
+        metricStages is a Dict of metric name -> names of the only stages it is sampled for"""
+        self.stageDir = stageDir
+        self.jobs = jobs
+        self.prelude = prelude
+        self.metrics = metrics or {}
+        self.metricStages = metricStages or {}
+        self.stages = []
+        self.completed = set()
+        self.failedStage = None
+        self.warnings = []
+        self.report = []
+        self.checkpointPath = None
+        self.checkpointData = {}
+        self.resumeFingerprints = {}
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.starts = 0
+
+    def addStage(self, stage):
+        """Adds stage. Inputs must be provided by previously added stages"""
+        producers = self.getProducers()
+        for i in stage.inputs:
+            if i not in producers:
+                raise ValueError("Stage " + stage.name + " needs " + i + " which no stage provides")
+        self.stages.append(stage)
+        return stage
+
+    def getProducers(self):
+        """Returns Dict of output -> stage name"""
+        producers = {}
+        for stage in self.stages:
+            for o in stage.outputs:
+                producers[o] = stage.name
+        return producers
+
+    def getDependencies(self, stage):
+        """Returns names of stages that stage depends on"""
+        producers = self.getProducers()
+        dependencies = set()
+        for i in stage.inputs:
+            dependencies.add(producers[i])
+        return dependencies
+
+    def hashPath(self, path, digest):
+        """Adds names & contents of files under path to digest"""
+        if os.path.isfile(path):
+            digest.update(path.encode("utf-8"))
+            pathFile = open(path, "rb")
+            for block in iter(lambda: pathFile.read(1024*1024), b""):
+                digest.update(block)
+            pathFile.close()
+            return
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                self.hashPath(os.path.join(root, f), digest)
+
+    def getFingerprint(self, stage):
+        """Returns hash of stage script, used files & fingerprints of stages it depends on"""
+        if stage.name in self.fingerprints:
+            return self.fingerprints[stage.name]
+        digest = hashlib.sha1((stage.name + "\n" + stage.getScript()).encode("utf-8"))
+        for path in stage.paths:
+            self.hashPath(path, digest)
+        stagesByName = dict((s.name, s) for s in self.stages)
+        for dependency in sorted(self.getDependencies(stage)):
+            digest.update(self.getFingerprint(stagesByName[dependency]).encode("utf-8"))
+        self.fingerprints[stage.name] = digest.hexdigest()
+        return self.fingerprints[stage.name]
+
+    def setCheckpoint(self, checkpointPath, data):
+        """Saves completed stages & data to checkpointPath after every stage"""
+        self.checkpointPath = checkpointPath
+        self.checkpointData = data
+
+    def loadCheckpoint(self, checkpointPath):
+        """Loads fingerprints of stages completed by an earlier build. Returns data saved with them, None if there is no checkpoint"""
+        try:
+            checkpointFile = open(checkpointPath)
+            checkpoint = json.load(checkpointFile)
+            checkpointFile.close()
+        except (IOError, ValueError):
+            return None
+        self.resumeFingerprints = checkpoint.get("stages", {})
+        return checkpoint.get("data", {})
+
+    def writeCheckpoint(self):
+        """Writes fingerprints of completed stages. Stages that only warned are left out, so a resumed build runs them again.
+        Replaces checkpoint atomically"""
+        if self.checkpointPath == None:
+            return
+        stagesByName = dict((s.name, s) for s in self.stages)
+        warned = set([w["stage"] for w in self.warnings])
+        stages = {}
+        for name in self.completed:
+            if name not in warned:
+                stages[name] = self.getFingerprint(stagesByName[name])
+        checkpointFile = open(self.checkpointPath + ".tmp", "w")
+        json.dump({"stages": stages, "data": self.checkpointData}, checkpointFile, indent=2, sort_keys=True)
+        checkpointFile.close()
+        os.rename(self.checkpointPath + ".tmp", self.checkpointPath)
+
+    def restoreCompleted(self):
+        """Marks stages unchanged since the checkpoint as completed"""
+        for stage in self.stages:
+            if stage.name in self.completed or stage.rerun:
+                continue
+            if self.resumeFingerprints.get(stage.name) == self.getFingerprint(stage):
+                logging.info("Stage Already Completed: " + stage.name)
+                self.completed.add(stage.name)
+
+    def writeScript(self, scriptPath, header, stageNames=None):
+        """Writes all stages, or stages in stageNames, as one equivalent linear shell script"""
+        script = open(scriptPath, "w")
+        script.write(header)
+        for stage in self.stages:
+            if stageNames != None and stage.name not in stageNames:
+                continue
+            script.write("#Stage: " + stage.name + "\n")
+            script.write(stage.getScript())
+        script.write("exit 0\n")
+        script.close()
+
+    def hasScriptCommand(self):
+        """Checks if script from util-linux is available to record interactive stages"""
+        for path in os.environ["PATH"].split(":"):
+            if os.access(path + "/script", os.X_OK):
+                return True
+        return False
+
+    def runScript(self, name, scriptPath, interactive=False):
+        """Runs script with RBFLOG set to its log in stageDir. Returns exit code & resource usage.
+        Interactive scripts keep the console. Their output is also copied to the log if script is available"""
+        if not os.path.isdir(self.stageDir):
+            os.makedirs(self.stageDir)
+        stageLogPath = os.path.join(self.stageDir, name + ".log")
+        env = dict(os.environ)
+        env["RBFLOG"] = os.path.abspath(stageLogPath)
+        stageLog = open(stageLogPath, "w")
+        if interactive and self.hasScriptCommand():
+            # script runs the stage on a pty, so prompts still work, & appends everything shown to the log
+            process = subprocess.Popen(["script", "-q", "-e", "-f", "-a", "-c", "bash " + quote(scriptPath), stageLogPath], env=env)
+        elif interactive:
+            logging.info("script Not Found. Console Output Of Stage " + name + " Is Not Logged")
+            process = subprocess.Popen(["bash", scriptPath], env=env)
+        else:
+            process = subprocess.Popen(["bash", scriptPath], stdout=stageLog, stderr=subprocess.STDOUT, env=env)
+        # wait4 also accounts for CPU time of the commands the script waited for
+        pid, status, rusage = os.wait4(process.pid, 0)
+        stageLog.close()
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return process.returncode, rusage
+
+    def runStage(self, stage):
+        """Runs a single stage. Returns exit code & resource usage"""
+        if not os.path.isdir(self.stageDir):
+            os.makedirs(self.stageDir)
+        stageScriptPath = os.path.join(self.stageDir, stage.name + ".sh")
+        stageScript = open(stageScriptPath, "w")
+        stageScript.write(self.prelude + stage.getScript() + "exit 0\n")
+        stageScript.close()
+        return self.runScript(stage.name, stageScriptPath, stage.interactive)
+
+    def getMeasuredMetrics(self, stageName):
+        """Returns names of metrics sampled for stage"""
+        return [m for m in self.metrics if m not in self.metricStages or stageName in self.metricStages[m]]
+
+    def sampleMetrics(self, names):
+        """Returns Dict of metric name -> current value for metrics in names. Metrics that fail are 0"""
+        sample = {}
+        for name in names:
+            try:
+                sample[name] = self.metrics[name]()
+            except Exception:
+                sample[name] = 0
+        return sample
+
+    def beginMeasure(self, stageName):
+        """Samples metrics of stage before it runs. Returns the sample, the number of stages started so far & if others are running"""
+        with self.lock:
+            overlapped = self.active != 0
+            self.active = self.active + 1
+            self.starts = self.starts + 1
+            starts = self.starts
+        return self.sampleMetrics(self.getMeasuredMetrics(stageName)), starts, overlapped
+
+    def endMeasure(self, measure):
+        """Samples metrics after a stage ran. Returns the sample & if the stage overlapped another stage"""
+        before, starts, overlapped = measure
+        after = self.sampleMetrics(before.keys())
+        with self.lock:
+            self.active = self.active - 1
+            return after, overlapped or starts != self.starts
+
+    def recordStage(self, name, stageRet, startTime, rusage, measure):
+        """Adds stage to report. Written bytes come from the stage's own processes. Sampled metrics only if the stage ran alone"""
+        after, overlapped = self.endMeasure(measure)
+        before = measure[0]
+        entry = {"stage": name, "exitCode": stageRet, "start": round(startTime, 3), "wallTime": round(time.time() - startTime, 3)}
+        if rusage != None:
+            entry["userTime"] = round(rusage.ru_utime, 3)
+            entry["systemTime"] = round(rusage.ru_stime, 3)
+            entry["cpuTime"] = round(rusage.ru_utime + rusage.ru_stime, 3)
+            # ru_oublock counts 512 byte blocks written to filesystems
+            entry["writtenBytes"] = rusage.ru_oublock*512
+        if overlapped:
+            entry["overlapped"] = True
+        else:
+            for metric in before:
+                entry[metric] = max(after[metric] - before[metric], 0)
+        if len([s for s in self.stages if s.name == name and s.emulated]) != 0:
+            entry["emulated"] = True
+        self.report.append(entry)
+        return entry
+
+    def runRecorded(self, name, scriptPath, interactive=False):
+        """Runs script outside of the stage graph & records it like a stage. Returns exit code"""
+        measure = self.beginMeasure(name)
+        startTime = time.time()
+        try:
+            scriptRet, rusage = self.runScript(name, scriptPath, interactive)
+        except OSError:
+            scriptRet, rusage = -1, None
+        self.recordStage(name, scriptRet, startTime, rusage, measure)
+        return scriptRet
+
+    def worker(self, stage, results):
+        """Runs stage, retrying it if its policy says so & reports result on queue.
+        Errors fail the stage, a result is always reported so run never waits forever"""
+        attempt = 1
+        stageRet = -1
+        wallTime = 0.0
+        try:
+            while True:
+                measure = self.beginMeasure(stage.name)
+                startTime = time.time()
+                try:
+                    stageRet, rusage = self.runStage(stage)
+                except Exception as e:
+                    logging.error("Could Not Run Stage " + stage.name + ": " + str(e))
+                    stageRet, rusage = -1, None
+                entry = self.recordStage(stage.name, stageRet, startTime, rusage, measure)
+                entry["attempt"] = attempt
+                wallTime = entry["wallTime"]
+                if stageRet == 0 or stage.policy != RbfStage.RETRY or attempt > stage.retries:
+                    break
+                delay = stage.backoff*2**(attempt - 1)
+                logging.info("Stage Failed: " + stage.name + " Exit Code: " + str(stageRet) + ". Retrying In " + str(delay) + "s (" + str(attempt) + "/" + str(stage.retries) + ")")
+                time.sleep(delay)
+                attempt = attempt + 1
+        except Exception as e:
+            logging.error("Could Not Record Stage " + stage.name + ": " + str(e))
+            stageRet = -1
+        results.put((stage, stageRet, wallTime))
+
+    def getSummary(self):
+        """Returns report as lines of text. Stages sorted by wall time. Emulated stages are marked with *.
+        Image & download bytes of overlapped stages & stages they are not sampled for are shown as -"""
+        lines = ["Stage".ljust(16) + "Wall".rjust(9) + "CPU".rjust(9) + "Written".rjust(10) + "Image".rjust(10) + "Download".rjust(10) + "  Exit"]
+        totalWall = 0.0
+        totalCpu = 0.0
+        for entry in sorted(self.report, key=lambda e: e["wallTime"], reverse=True):
+            totalWall = totalWall + entry["wallTime"]
+            totalCpu = totalCpu + entry.get("cpuTime", 0)
+            name = entry["stage"]
+            if entry.get("emulated", False):
+                name = name + " *"
+            megabytes = [(str(entry[m]//(1024*1024)) + "M" if m in entry else "-").rjust(10) for m in ["writtenBytes", "imageBytes", "downloadedBytes"]]
+            lines.append(name.ljust(16) + (str(round(entry["wallTime"], 1)) + "s").rjust(9) + (str(round(entry.get("cpuTime", 0), 1)) + "s").rjust(9) + "".join(megabytes) + "  " + str(entry["exitCode"]))
+        lines.append("Sum Of Stages".ljust(16) + (str(round(totalWall, 1)) + "s").rjust(9) + (str(round(totalCpu, 1)) + "s").rjust(9))
+        emulated = [e for e in self.report if e.get("emulated", False)]
+        if len(emulated) != 0:
+            lines.append("* Emulated".ljust(16) + (str(round(sum([e["wallTime"] for e in emulated]), 1)) + "s").rjust(9) + (str(round(sum([e.get("cpuTime", 0) for e in emulated]), 1)) + "s").rjust(9))
+        return lines
+
+    def writeReport(self, reportPath, info):
+        """Writes report as JSON. info is added at top level"""
+        report = dict(info)
+        report["stages"] = self.report
+        reportFile = open(reportPath, "w")
+        json.dump(report, reportFile, indent=2, sort_keys=True)
+        reportFile.write("\n")
+        reportFile.close()
+
+    def run(self):
+        """Runs all stages not completed by an earlier run. Returns 0 or exit code of first failed stage"""
+        if not os.path.isdir(self.stageDir):
+            os.makedirs(self.stageDir)
+        dependencies = {}
+        for stage in self.stages:
+            dependencies[stage.name] = self.getDependencies(stage)
+
+        self.fingerprints = {}
+        self.restoreCompleted()
+        results = Queue()
+        completed = self.completed
+        pending = [stage for stage in self.stages if stage.name not in completed]
+        running = 0
+        interactiveRunning = False
+        exitCode = 0
+        while True:
+            if exitCode == 0 and not interactiveRunning:
+                ready = [stage for stage in pending if dependencies[stage.name].issubset(completed)]
+                interactiveReady = [stage for stage in ready if stage.interactive]
+                if len(interactiveReady) != 0:
+                    # Start nothing else until the ready interactive stage has run alone
+                    ready = []
+                    if running == 0:
+                        ready = interactiveReady[0:1]
+                for stage in ready:
+                    if running == self.jobs:
+                        break
+                    interactiveRunning = stage.interactive
+                    pending.remove(stage)
+                    logging.info("Stage Started: " + stage.name)
+                    thread = threading.Thread(target=self.worker, args=(stage, results))
+                    thread.daemon = True
+                    thread.start()
+                    running = running + 1
+            if running == 0:
+                break
+            stage, stageRet, duration = results.get()
+            running = running - 1
+            interactiveRunning = False
+            if stageRet == 0:
+                completed.add(stage.name)
+                self.writeCheckpoint()
+                logging.info("Stage Finished: " + stage.name + " " + str(round(duration, 1)) + "s")
+            elif stage.policy == RbfStage.WARN:
+                logging.error("Stage Failed: " + stage.name + " Exit Code: " + str(stageRet) + " Log: " + os.path.join(self.stageDir, stage.name + ".log") + ". Continuing")
+                self.warnings.append({"stage": stage.name, "exitCode": stageRet})
+                completed.add(stage.name)
+                self.writeCheckpoint()
+            else:
+                logging.error("Stage Failed: " + stage.name + " Exit Code: " + str(stageRet) + " Log: " + os.path.join(self.stageDir, stage.name + ".log"))
+                if exitCode == 0:
+                    exitCode = stageRet
+                    self.failedStage = stage.name
+        return exitCode
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+
+"""@package rbfflash
+Flasher For RootFS Build Factory
+
+Writes only the blocks of an image listed in its block map to one or many devices at once & verifies them
+"""
+
+import os
+import sys
+import logging
+import stat
+import time
+import hashlib
+import threading
+import subprocess
+from rbfoutput import RbfBlockMap
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+class RbfFlasher():
+    """RbfFlasher Class.
+
+    Copies mapped ranges of the image, checking them against the block map, syncs the device once
+    & reads the ranges back from the device to verify them
+    """
+    COPY_SIZE = 1024*1024
+
+    def __init__(self, imagePath, devicePath, bmapPath, blockMap=None, allowFile=False):
+        """Constructor for RbfFlasher. A loaded blockMap is used instead of reading bmapPath.
+        devicePath must be an existing block device, or an existing regular file with allowFile"""
+        self.imagePath = imagePath
+        self.devicePath = devicePath
+        self.allowFile = allowFile
+        self.blockMap = blockMap
+        if blockMap == None:
+            self.blockMap = RbfBlockMap(imagePath)
+            self.blockMap.load(bmapPath)
+
+    def checkDevice(self):
+        """Refuses missing devices, anything but block devices unless files are allowed & devices that are mounted or smaller than the image"""
+        if not os.path.exists(self.devicePath):
+            raise ValueError("Device Not Found: " + self.devicePath)
+        mode = os.stat(self.devicePath).st_mode
+        if stat.S_ISREG(mode) and self.allowFile:
+            return
+        if not stat.S_ISBLK(mode):
+            raise ValueError("Not A Block Device: " + self.devicePath + ". Use --allow-file To Flash Into An Existing File")
+        devicePath = os.path.realpath(self.devicePath)
+        mounts = open("/proc/mounts")
+        for line in mounts:
+            source = line.split()[0]
+            if source == devicePath or (source.startswith(devicePath) and source[len(devicePath):].lstrip("p").isdigit()):
+                mounts.close()
+                raise ValueError("Device Is Mounted: " + source)
+        mounts.close()
+        device = open(self.devicePath, "rb")
+        device.seek(0, os.SEEK_END)
+        deviceSize = device.tell()
+        device.close()
+        if deviceSize < self.blockMap.imageSize:
+            raise ValueError("Device " + self.devicePath + " Is Smaller Than Image: " + str(deviceSize//(1024*1024)) + "M")
+
+    def copyRanges(self, source, target, verifyOnly=False):
+        """Reads every range from source, checks its checksum & writes it to target unless verifyOnly"""
+        blockSize = self.blockMap.blockSize
+        for first, last, checksum in self.blockMap.ranges:
+            digest = hashlib.new(RbfBlockMap.CHECKSUM_TYPE)
+            offset = first*blockSize
+            end = min((last + 1)*blockSize, self.blockMap.imageSize)
+            os.lseek(source, offset, os.SEEK_SET)
+            if not verifyOnly:
+                os.lseek(target, offset, os.SEEK_SET)
+            while offset < end:
+                data = os.read(source, min(RbfFlasher.COPY_SIZE, end - offset))
+                if len(data) == 0:
+                    raise IOError("Unexpected End Of " + self.imagePath + " At Byte " + str(offset))
+                digest.update(data)
+                if not verifyOnly:
+                    written = 0
+                    while written < len(data):
+                        written = written + os.write(target, data[written:])
+                offset = offset + len(data)
+            if digest.hexdigest() != checksum:
+                raise ValueError("Checksum Mismatch In Blocks " + str(first) + "-" + str(last) + " Of " + ["Image", "Device"][verifyOnly])
+
+    def verify(self):
+        """Reads mapped ranges back from the device, not from the page cache, & checks them"""
+        device = os.open(self.devicePath, os.O_RDONLY)
+        try:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(device, 0, 0, os.POSIX_FADV_DONTNEED)
+            self.copyRanges(device, None, True)
+        finally:
+            os.close(device)
+
+    def flash(self):
+        """Writes & verifies mapped ranges. Returns seconds taken"""
+        self.checkDevice()
+        mappedBytes = self.blockMap.getMappedBlocksCount()*self.blockMap.blockSize
+        logging.info("Flashing " + self.imagePath + " To " + self.devicePath + ": " + str(mappedBytes//(1024*1024)) + "M Of " + str(self.blockMap.imageSize//(1024*1024)) + "M Mapped")
+        startTime = time.time()
+        image = os.open(self.imagePath, os.O_RDONLY)
+        device = os.open(self.devicePath, os.O_WRONLY)
+        try:
+            self.copyRanges(image, device)
+            if os.path.isfile(self.devicePath) and os.fstat(device).st_size < self.blockMap.imageSize:
+                # Image files flashed to files keep their size
+                os.ftruncate(device, self.blockMap.imageSize)
+            os.fsync(device)
+        finally:
+            os.close(device)
+            os.close(image)
+        writeTime = time.time() - startTime
+        logging.info("Written In " + str(round(writeTime, 1)) + "s " + str(round(mappedBytes/max(writeTime, 0.001)/(1024*1024), 1)) + "M/s. Verifying")
+        self.verify()
+        duration = time.time() - startTime
+        logging.info("Flashed & Verified In " + str(round(duration, 1)) + "s")
+        return duration
+
+class RbfMultiFlasher():
+    """RbfMultiFlasher Class.
+
+    Reads the mapped ranges of the image once & hands every chunk to one writer thread per device, so all devices are
+    written at the same time & the slowest device sets the pace. Devices that fail are dropped without stopping the
+    others. Every device is then verified by read back concurrently & the board flash hook, Eg. writing u-boot, runs
+    for each verified device
+    """
+    QUEUE_CHUNKS = 16
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, imagePath, devicePaths, bmapPath=None, hook=None, allowFile=False):
+        """Constructor for RbfMultiFlasher. Without bmapPath the image is mapped first. hook is a command run with the device appended.
+        Devices may be existing regular files with allowFile"""
+        if len(set([os.path.realpath(d) for d in devicePaths])) != len(devicePaths):
+            raise ValueError("Devices Given More Than Once")
+        self.imagePath = imagePath
+        self.devicePaths = devicePaths
+        self.hook = hook
+        self.blockMap = RbfBlockMap(imagePath)
+        if bmapPath != None:
+            self.blockMap.load(bmapPath)
+            if self.blockMap.imageSize != os.path.getsize(imagePath):
+                raise ValueError("Block Map " + bmapPath + " Does Not Belong To " + imagePath)
+        else:
+            self.blockMap.map()
+        self.flashers = [RbfFlasher(imagePath, d, None, self.blockMap, allowFile) for d in devicePaths]
+        self.results = {}
+        for d in devicePaths:
+            self.results[d] = {"written": 0, "writeTime": 0.0, "verifyTime": 0.0, "error": None}
+
+    def readImage(self, queues):
+        """Reads mapped ranges once, checks them against the block map & queues every chunk for all devices"""
+        blockSize = self.blockMap.blockSize
+        image = os.open(self.imagePath, os.O_RDONLY)
+        lastProgress = time.time()
+        try:
+            for first, last, checksum in self.blockMap.ranges:
+                digest = hashlib.new(RbfBlockMap.CHECKSUM_TYPE)
+                offset = first*blockSize
+                end = min((last + 1)*blockSize, self.blockMap.imageSize)
+                os.lseek(image, offset, os.SEEK_SET)
+                while offset < end:
+                    data = os.read(image, min(RbfFlasher.COPY_SIZE, end - offset))
+                    if len(data) == 0:
+                        raise IOError("Unexpected End Of " + self.imagePath + " At Byte " + str(offset))
+                    digest.update(data)
+                    for queue in queues:
+                        queue.put((offset, data))
+                    offset = offset + len(data)
+                    if time.time() - lastProgress > RbfMultiFlasher.PROGRESS_INTERVAL:
+                        self.printProgress()
+                        lastProgress = time.time()
+                if digest.hexdigest() != checksum:
+                    raise ValueError("Checksum Mismatch In Blocks " + str(first) + "-" + str(last) + " Of Image")
+        finally:
+            os.close(image)
+            for queue in queues:
+                queue.put(None)
+
+    def writeDevice(self, devicePath, queue):
+        """Writes queued chunks to devicePath & syncs it. Keeps draining the queue after an error so the reader never blocks"""
+        result = self.results[devicePath]
+        startTime = time.time()
+        device = None
+        try:
+            device = os.open(devicePath, os.O_WRONLY)
+        except OSError as e:
+            result["error"] = str(e)
+        chunk = queue.get()
+        while chunk != None:
+            if result["error"] == None:
+                offset, data = chunk
+                try:
+                    os.lseek(device, offset, os.SEEK_SET)
+                    written = 0
+                    while written < len(data):
+                        written = written + os.write(device, data[written:])
+                    result["written"] = result["written"] + len(data)
+                    result["writeTime"] = time.time() - startTime
+                except OSError as e:
+                    result["error"] = "Write Failed At Byte " + str(offset) + ": " + str(e)
+            chunk = queue.get()
+        if device == None:
+            return
+        try:
+            if result["error"] == None:
+                if os.path.isfile(devicePath) and os.fstat(device).st_size < self.blockMap.imageSize:
+                    os.ftruncate(device, self.blockMap.imageSize)
+                os.fsync(device)
+        except OSError as e:
+            result["error"] = "Sync Failed: " + str(e)
+        os.close(device)
+        result["writeTime"] = time.time() - startTime
+
+    def verifyDevice(self, flasher):
+        """Verifies device by read back & runs the flash hook for it"""
+        result = self.results[flasher.devicePath]
+        startTime = time.time()
+        try:
+            flasher.verify()
+        except (ValueError, IOError, OSError) as e:
+            result["error"] = "Verify Failed: " + str(e)
+        result["verifyTime"] = time.time() - startTime
+        if result["error"] == None and self.hook != None:
+            if subprocess.call(self.hook + [flasher.devicePath]) != 0:
+                result["error"] = "Flash Hook Failed: " + " ".join(self.hook)
+
+    def printProgress(self):
+        """Prints bytes written & throughput of every device"""
+        for d in self.devicePaths:
+            result = self.results[d]
+            logging.info("  " + d + ": " + str(result["written"]//(1024*1024)) + "M " + str(round(result["written"]/max(result["writeTime"], 0.001)/(1024*1024), 1)) + "M/s")
+
+    def runThreads(self, target, arguments):
+        """Runs target once per arguments tuple in its own thread & waits for all"""
+        threads = [threading.Thread(target=target, args=a) for a in arguments]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def flash(self):
+        """Writes image to all devices at once, verifies them & runs the hook. Returns Dictionary of results by device"""
+        for flasher in self.flashers:
+            try:
+                flasher.checkDevice()
+            except (ValueError, IOError, OSError) as e:
+                self.results[flasher.devicePath]["error"] = str(e)
+        devices = [d for d in self.devicePaths if self.results[d]["error"] == None]
+        mappedBytes = self.blockMap.getMappedBlocksCount()*self.blockMap.blockSize
+        logging.info("Flashing " + self.imagePath + " To " + str(len(devices)) + " Devices: " + str(mappedBytes//(1024*1024)) + "M Of " + str(self.blockMap.imageSize//(1024*1024)) + "M Mapped")
+        startTime = time.time()
+        queues = [Queue(RbfMultiFlasher.QUEUE_CHUNKS) for d in devices]
+        writers = [threading.Thread(target=self.writeDevice, args=(devices[i], queues[i])) for i in range(0, len(devices))]
+        for w in writers:
+            w.start()
+        try:
+            self.readImage(queues)
+        finally:
+            for w in writers:
+                w.join()
+        logging.info("Written In " + str(round(time.time() - startTime, 1)) + "s. Verifying")
+        self.runThreads(self.verifyDevice, [(f,) for f in self.flashers if self.results[f.devicePath]["error"] == None])
+        for d in self.devicePaths:
+            result = self.results[d]
+            if result["error"] != None:
+                logging.error("  " + d + ": FAILED " + result["error"])
+                continue
+            logging.info("  " + d + ": OK " + str(result["written"]//(1024*1024)) + "M Written In " + str(round(result["writeTime"], 1)) + "s " + str(round(result["written"]/max(result["writeTime"], 0.001)/(1024*1024), 1)) + "M/s, Verified In " + str(round(result["verifyTime"], 1)) + "s")
+        logging.info("Flashed " + str(len([r for r in self.results.values() if r["error"] == None])) + " Of " + str(len(self.devicePaths)) + " Devices In " + str(round(time.time() - startTime, 1)) + "s")
+        return self.results
+
+if __name__ == "__main__":
+    # rbfflash.py [--allow-file] <image> <device> [bmap] | rbfflash.py [--allow-file] <image> <device>... --many. bmap defaults to <image>.bmap
+    allowFile = "--allow-file" in sys.argv
+    if allowFile:
+        sys.argv.remove("--allow-file")
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    if len(sys.argv) > 3 and sys.argv[-1] == "--many":
+        bmapPath = None
+        if os.path.exists(sys.argv[1] + ".bmap"):
+            bmapPath = sys.argv[1] + ".bmap"
+        try:
+            results = RbfMultiFlasher(sys.argv[1], sys.argv[2:-1], bmapPath, None, allowFile).flash()
+        except (ValueError, IOError, OSError) as e:
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        sys.exit(int(len([r for r in results.values() if r["error"] != None]) != 0))
+    if len(sys.argv) < 3 or len(sys.argv) > 4:
+        sys.stderr.write("Usage: rbfflash.py [--allow-file] <image> <device> [bmap]\n       rbfflash.py [--allow-file] <image> <device>... --many\n")
+        sys.exit(1)
+    bmapPath = sys.argv[1] + ".bmap"
+    if len(sys.argv) == 4:
+        bmapPath = sys.argv[3]
+    try:
+        RbfFlasher(sys.argv[1], sys.argv[2], bmapPath, None, allowFile).flash()
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
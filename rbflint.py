@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""@package rbflint
+Template Linter For RootFS Build Factory
+
+Validates board templates without root & without writing any files
+"""
+
+import os
+import xml.dom.minidom
+from rbfutils import RbfUtils, RbfPartitionTable
+from rbfexecutor import RbfStage
+
+class RbfTemplateLinter():
+    """RbfTemplateLinter Class.
+
+    Checks a template against the schema below & collects every error instead of stopping at the first one
+    """
+    TEXT_TAGS = ["board", "workdir", "uboot", "rootfiles", "firmware", "hostname", "selinux", "etcoverlay", "finalizescript", "distro", "extlinuxconf"]
+    ELEMENT_TAGS = ["image", "partitions", "packages", "kernel", "repos"]
+    IMAGE_ATTRIBUTES = ["size", "type", "path"]
+    PARTITION_ATTRIBUTES = ["index", "size", "type", "fs", "mountpoint"]
+    PARTITION_TYPES = ["primary", "extended", "logical"]
+    FILESYSTEMS = ["ext2", "ext3", "ext4", "vfat", "swap", "extended"]
+    KERNEL_TYPES = ["custom", "stock", "none"]
+    CUSTOM_KERNEL_TAGS = ["image", "initrd", "modules", "dtbdir", "dtb"]
+    SELINUX_STATES = ["enforcing", "permissive", "disabled"]
+    INIT_VALUES = ["", "lazy", "eager"]
+    REPO_SCHEMES = ["http://", "https://", "ftp://", "file://"]
+    PACKAGE_MANAGERS = ["", "yum", "dnf"]
+
+    def __init__(self, xmlTemplate, boardDom=None):
+        """Constructor for RbfTemplateLinter. boardDom is used instead of parsing xmlTemplate if given"""
+        self.xmlTemplate = xmlTemplate
+        self.rbfUtils = RbfUtils()
+        self.boardDom = boardDom
+        self.errors = []
+
+    def error(self, message):
+        """Records an error"""
+        self.errors.append(message)
+
+    def getTagValue(self, domTag):
+        """Returns text of first domTag. None if missing or empty"""
+        for x in self.boardDom.getElementsByTagName(domTag):
+            if len(x.childNodes) != 0 and x.childNodes[0].nodeType == x.TEXT_NODE and x.childNodes[0].data.strip() != "":
+                return x.childNodes[0].data.strip()
+        return None
+
+    def isSize(self, size):
+        """Checks if size is an integer with suffix M or G"""
+        return (size[-1:] == "M" or size[-1:] == "G") and self.rbfUtils.isSizeInt(size[0:-1])
+
+    def checkPath(self, description, path):
+        """Checks that path exists unless it is none"""
+        if path != None and path != "none" and not os.path.exists(path):
+            self.error(description + " Not Found: " + path)
+
+    def lint(self):
+        """Validates template. Returns List of errors"""
+        if self.boardDom == None:
+            try:
+                self.boardDom = self.rbfUtils.loadTemplate(self.xmlTemplate)
+            except Exception as e:
+                self.error("Error Parsing XML Template File: " + str(e))
+                return self.errors
+
+        for tag in RbfTemplateLinter.TEXT_TAGS:
+            if self.getTagValue(tag) == None:
+                self.error("Missing Or Empty Tag: " + tag)
+        for tag in RbfTemplateLinter.ELEMENT_TAGS:
+            if len(self.boardDom.getElementsByTagName(tag)) == 0:
+                self.error("Missing Tag: " + tag)
+
+        self.lintImage()
+        self.lintPartitions()
+        self.lintKernel()
+        self.lintRepos()
+        self.lintPaths()
+        self.lintOptions()
+        return self.errors
+
+    def lintImage(self):
+        """Checks image size, headroom, type, path & device timeout"""
+        images = self.boardDom.getElementsByTagName("image")
+        if len(images) == 0:
+            return
+        imageDom = images[0]
+        for attribute in RbfTemplateLinter.IMAGE_ATTRIBUTES:
+            if not imageDom.hasAttribute(attribute):
+                self.error("Image Tag Has No " + attribute + " Attribute")
+        if imageDom.hasAttribute("size") and imageDom.getAttribute("size") != "auto" and not self.isSize(imageDom.getAttribute("size")):
+            self.error("Invalid Image Size: " + imageDom.getAttribute("size") + ". Only Integers with suffix G or M or auto allowed")
+        if imageDom.hasAttribute("headroom") and not self.isSize(imageDom.getAttribute("headroom")):
+            self.error("Invalid Headroom: " + imageDom.getAttribute("headroom") + ". Only Integers with suffix G or M allowed")
+        if imageDom.getAttribute("size") == "auto":
+            partitions = [p for p in self.boardDom.getElementsByTagName("partition") if p.getAttribute("type") != "extended"]
+            if len(partitions) != 0 and partitions[-1].getAttribute("fs") not in ["ext2", "ext3", "ext4"]:
+                self.error("size=\"auto\" Needs An ext2, ext3 Or ext4 Last Partition")
+        if imageDom.hasAttribute("devicetimeout") and not imageDom.getAttribute("devicetimeout").isdigit():
+            self.error("Invalid Device Timeout: " + imageDom.getAttribute("devicetimeout"))
+
+    def lintPartitions(self):
+        """Checks partition attributes, ordering, sizes against image size & layout"""
+        partitionsDom = self.boardDom.getElementsByTagName("partitions")
+        if len(partitionsDom) == 0:
+            return
+        table = partitionsDom[0].getAttribute("table") or RbfPartitionTable.MSDOS
+        align = partitionsDom[0].getAttribute("align") or RbfUtils.PARTITION_BEGIN
+        if partitionsDom[0].getAttribute("init") not in RbfTemplateLinter.INIT_VALUES:
+            self.error("Invalid Filesystem Init: " + partitionsDom[0].getAttribute("init") + ". Use lazy or eager")
+
+        partitions = []
+        for p in partitionsDom[0].getElementsByTagName("partition"):
+            index = p.getAttribute("index") or "?"
+            missing = [a for a in RbfTemplateLinter.PARTITION_ATTRIBUTES if not p.hasAttribute(a)]
+            if len(missing) != 0:
+                self.error("Partition " + index + " Has No " + ", ".join(missing) + " Attribute")
+                continue
+            valid = True
+            if not self.isSize(p.getAttribute("size")):
+                self.error("Partition " + index + " Size Error. Only Integers with suffix G or M allowed. You Specified " + p.getAttribute("size"))
+                valid = False
+            if p.getAttribute("type") not in RbfTemplateLinter.PARTITION_TYPES:
+                self.error("Partition " + index + " Has Invalid Type: " + p.getAttribute("type"))
+                valid = False
+            if p.getAttribute("fs") not in RbfTemplateLinter.FILESYSTEMS:
+                self.error("Partition " + index + " Has Unsupported Filesystem: " + p.getAttribute("fs"))
+            if p.getAttribute("init") not in RbfTemplateLinter.INIT_VALUES:
+                self.error("Partition " + index + " Has Invalid Filesystem Init: " + p.getAttribute("init") + ". Use lazy or eager")
+            if valid:
+                partitions.append(p)
+
+        mountpoints = [p.getAttribute("mountpoint") for p in partitions if p.getAttribute("type") != "extended"]
+        if mountpoints.count("/") != 1:
+            self.error("Exactly One Partition Must Be Mounted On /. Found " + str(mountpoints.count("/")))
+        for mountpoint in set(mountpoints):
+            if mountpoint != "swap" and mountpoints.count(mountpoint) > 1:
+                self.error("Mountpoint Used By More Than One Partition: " + mountpoint)
+
+        extendedStart = False
+        primaryCount = 0
+        for p in partitions:
+            ptype = p.getAttribute("type")
+            if ptype == "logical" and not extendedStart:
+                self.error("Cannot Create Logical Partition " + p.getAttribute("index") + " Before Extended")
+            if ptype == "primary" and extendedStart:
+                self.error("Cannot Create Primary Partition " + p.getAttribute("index") + " After Extended")
+            if ptype == "extended":
+                extendedStart = True
+            if ptype == "primary" or ptype == "extended":
+                primaryCount = primaryCount + 1
+        if extendedStart and table == RbfPartitionTable.MSDOS and primaryCount > 4:
+            self.error("Cannot Have More Than 4 Primary Partitions")
+
+        images = self.boardDom.getElementsByTagName("image")
+        if len(images) == 0 or not self.isSize(images[0].getAttribute("size")):
+            return
+        imageSize = self.rbfUtils.getImageSizeInM(images[0].getAttribute("size"))
+        partitionSizeSum = 0
+        for p in partitions:
+            if p.getAttribute("type") != "extended":
+                partitionSizeSum = partitionSizeSum + int(self.rbfUtils.getImageSizeInM(p.getAttribute("size"))[0:-1])
+        if partitionSizeSum > int(imageSize[0:-1]):
+            self.error("Partition Sizes Exceed Image Size. Image Size: " + imageSize + " Partition Size Sum: " + str(partitionSizeSum) + "M")
+            return
+        try:
+            partitionTable = RbfPartitionTable(imageSize, table, align)
+            for p in partitions:
+                partitionTable.addPartition(self.rbfUtils.getImageSizeInM(p.getAttribute("size")), p.getAttribute("fs"), p.getAttribute("type"))
+            partitionTable.plan()
+        except ValueError as e:
+            self.error("Partition Layout: " + str(e))
+
+    def lintKernel(self):
+        """Checks kernel type & custom kernel files"""
+        kernelDom = self.boardDom.getElementsByTagName("kernel")
+        if len(kernelDom) == 0:
+            return
+        kernelType = kernelDom[0].getAttribute("type")
+        if kernelType not in RbfTemplateLinter.KERNEL_TYPES:
+            self.error("Invalid Kernel Type: " + kernelType + ". Use custom, stock or none")
+        if kernelType != "custom":
+            return
+        for tag in RbfTemplateLinter.CUSTOM_KERNEL_TAGS:
+            tagDom = kernelDom[0].getElementsByTagName(tag)
+            if len(tagDom) == 0 or len(tagDom[0].childNodes) == 0:
+                self.error("Custom Kernel Has No " + tag + " Tag")
+                continue
+            if tag != "dtb":
+                self.checkPath("Custom Kernel " + tag, tagDom[0].childNodes[0].data.strip())
+
+    def lintRepos(self):
+        """Checks that there is at least one repo & every repo has a unique name & a usable path"""
+        repos = self.boardDom.getElementsByTagName("repo")
+        if len(self.boardDom.getElementsByTagName("repos")) != 0 and len(repos) == 0:
+            self.error("No Repos Found")
+        names = []
+        for r in repos:
+            name = r.getAttribute("name")
+            path = r.getAttribute("path")
+            if name == "":
+                self.error("Repo Has No Name")
+            elif name in names:
+                self.error("Duplicate Repo Name: " + name)
+            names.append(name)
+            if path == "":
+                self.error("Repo " + name + " Has No Path")
+            elif not os.path.isabs(path) and len([s for s in RbfTemplateLinter.REPO_SCHEMES if path.startswith(s)]) == 0:
+                self.error("Repo " + name + " Path Is Not A URL Or Absolute Path: " + path)
+
+    def lintPaths(self):
+        """Checks that uboot, firmware, etc overlay & finalize script exist"""
+        self.checkPath("uboot", self.getTagValue("uboot"))
+        self.checkPath("Firmware", self.getTagValue("firmware"))
+        self.checkPath("Etc Overlay", self.getTagValue("etcoverlay"))
+        finalizeScript = self.getTagValue("finalizescript")
+        if finalizeScript != None and "/" in finalizeScript.split()[0]:
+            self.checkPath("Finalize Script", finalizeScript.split()[0])
+
+    def lintOptions(self):
+        """Checks selinux, extlinuxconf, arch, cache, package manager, prefetch, fast install, initramfs, outputs & failure policies"""
+        selinux = self.getTagValue("selinux")
+        if selinux != None and selinux not in RbfTemplateLinter.SELINUX_STATES:
+            self.error("Invalid SELinux State: " + selinux)
+        extlinuxConf = self.getTagValue("extlinuxconf")
+        if extlinuxConf != None and extlinuxConf not in ["true", "false"]:
+            self.error("Invalid extlinuxconf: " + extlinuxConf + ". Use true or false")
+        for c in self.boardDom.getElementsByTagName("cache"):
+            if c.hasAttribute("size") and not self.isSize(c.getAttribute("size")):
+                self.error("Cache Size Error. Only Integers with suffix G or M allowed. You Specified " + c.getAttribute("size"))
+        arch = self.getTagValue("arch")
+        if arch != None and arch not in RbfUtils.QEMU_ARCHES:
+            self.error("Unknown Architecture: " + arch + ". Use one of " + ", ".join(sorted(RbfUtils.QEMU_ARCHES)))
+        for p in self.boardDom.getElementsByTagName("packagemanager"):
+            if p.getAttribute("type") not in RbfTemplateLinter.PACKAGE_MANAGERS:
+                self.error("Invalid Package Manager: " + p.getAttribute("type") + ". Use yum or dnf")
+            if p.hasAttribute("paralleldownloads") and not p.getAttribute("paralleldownloads").isdigit():
+                self.error("Invalid paralleldownloads: " + p.getAttribute("paralleldownloads"))
+            if p.getAttribute("installweakdeps") not in ["", "true", "false"]:
+                self.error("Invalid installweakdeps: " + p.getAttribute("installweakdeps") + ". Use true or false")
+        for p in self.boardDom.getElementsByTagName("prefetch"):
+            for attribute in ["connections", "retries"]:
+                if p.hasAttribute(attribute) and not p.getAttribute(attribute).isdigit():
+                    self.error("Invalid Prefetch " + attribute + ": " + p.getAttribute(attribute))
+            if p.getAttribute("connections") == "0":
+                self.error("Prefetch Needs At Least One Connection")
+            if len([c for c in self.boardDom.getElementsByTagName("cache") if c.getAttribute("path") == "none"]) != 0:
+                self.error("Prefetch Needs The Package Cache")
+        for f in self.boardDom.getElementsByTagName("fastinstall"):
+            if f.getAttribute("mode") not in ["", "tmpfs", "nosync"]:
+                self.error("Invalid Fast Install Mode: " + f.getAttribute("mode") + ". Use tmpfs or nosync")
+            if f.hasAttribute("size") and not self.isSize(f.getAttribute("size")):
+                self.error("Fast Install Size Error. Only Integers with suffix G or M allowed. You Specified " + f.getAttribute("size"))
+        for i in self.boardDom.getElementsByTagName("initramfs"):
+            if i.getAttribute("compress") not in ["", "none", "zstd", "xz"]:
+                self.error("Invalid Initramfs Compression: " + i.getAttribute("compress") + ". Use none, zstd or xz")
+            for attribute in ["threads", "level"]:
+                if i.hasAttribute(attribute) and not i.getAttribute(attribute).isdigit():
+                    self.error("Invalid Initramfs " + attribute + ": " + i.getAttribute(attribute))
+        for o in self.boardDom.getElementsByTagName("output"):
+            for outputFormat in [f.strip() for f in o.getAttribute("formats").split(",") if f.strip() != ""]:
+                if outputFormat not in ["bmap", "sparse", "qcow2", "gz", "xz", "manifest"]:
+                    self.error("Unknown Output Format: " + outputFormat + ". Use bmap, sparse, qcow2, gz, xz or manifest")
+            for attribute in ["threads", "level", "framesize"]:
+                if o.hasAttribute(attribute) and not o.getAttribute(attribute).isdigit():
+                    self.error("Invalid Output " + attribute + ": " + o.getAttribute(attribute))
+            if o.hasAttribute("delta") and o.getAttribute("delta") == "":
+                self.error("Output Delta Needs Path Of Previous Image")
+        for p in self.boardDom.getElementsByTagName("policy"):
+            if p.getAttribute("stage") == "":
+                self.error("Failure Policy Has No Stage")
+            if p.getAttribute("onfailure") not in [RbfStage.ABORT, RbfStage.WARN, RbfStage.RETRY]:
+                self.error("Invalid Failure Policy For Stage " + p.getAttribute("stage") + ": " + p.getAttribute("onfailure"))
+            for attribute in ["retries", "backoff"]:
+                if p.hasAttribute(attribute) and not p.getAttribute(attribute).isdigit():
+                    self.error("Invalid " + attribute + " For Stage " + p.getAttribute("stage") + ": " + p.getAttribute(attribute))
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+"""@package rbfoutput
+Output Formats For RootFS Build Factory
+
+Writes a block map of the blocks holding data in a raw image & an Android sparse image built from it
+"""
+
+import os
+import sys
+import logging
+import errno
+import struct
+import hashlib
+import xml.dom.minidom
+
+class RbfBlockMap():
+    """RbfBlockMap Class.
+
+    Ranges of blocks of the image holding data, with a sha256 checksum each. Holes & blocks of zeros are not mapped.
+    The bmap file uses the format of bmaptool, so it can also be flashed with bmaptool copy
+    """
+    BLOCK_SIZE = 4096
+    READ_BLOCKS = 256
+    CHECKSUM_TYPE = "sha256"
+    BMAP_VERSION = "2.0"
+
+    def __init__(self, imagePath, blockSize=BLOCK_SIZE):
+        """Constructor for RbfBlockMap"""
+        self.imagePath = imagePath
+        self.blockSize = blockSize
+        self.imageSize = 0
+        self.ranges = []
+
+    def getBlocksCount(self):
+        """Returns number of blocks of the image. The last block may be partial"""
+        return (self.imageSize + self.blockSize - 1)//self.blockSize
+
+    def getMappedBlocksCount(self):
+        """Returns number of blocks holding data"""
+        return sum([last - first + 1 for first, last, checksum in self.ranges])
+
+    def getDataExtents(self, image):
+        """Returns List of (begin, end) byte offsets the filesystem holds data for. Whole image if holes cannot be found"""
+        if not hasattr(os, "SEEK_DATA"):
+            return [(0, self.imageSize)]
+        extents = []
+        offset = 0
+        while offset < self.imageSize:
+            try:
+                begin = os.lseek(image.fileno(), offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                return [(0, self.imageSize)]
+            end = os.lseek(image.fileno(), begin, os.SEEK_HOLE)
+            extents.append((begin - begin % self.blockSize, end))
+            offset = end
+        return extents
+
+    def map(self):
+        """Maps every data extent the filesystem reports as is, like bmaptool. Allocated blocks of zeros are mapped too,
+        so flashing overwrites whatever the card held there. Only holes are left out"""
+        self.imageSize = os.path.getsize(self.imagePath)
+        self.ranges = []
+        image = open(self.imagePath, "rb")
+        extents = []
+        block = 0
+        for begin, end in self.getDataExtents(image):
+            # Extents of filesystems with smaller blocks may share a block. Map every block once
+            first = max(begin//self.blockSize, block)
+            block = (min(end, self.imageSize) + self.blockSize - 1)//self.blockSize
+            if first >= block:
+                continue
+            if len(extents) != 0 and extents[-1][1] == first:
+                first = extents.pop()[0]
+            extents.append((first, block))
+        for first, end in extents:
+            digest = hashlib.new(RbfBlockMap.CHECKSUM_TYPE)
+            image.seek(first*self.blockSize)
+            remaining = min(end*self.blockSize, self.imageSize) - first*self.blockSize
+            while remaining > 0:
+                data = image.read(min(remaining, self.blockSize*RbfBlockMap.READ_BLOCKS))
+                if len(data) == 0:
+                    break
+                digest.update(data)
+                remaining = remaining - len(data)
+            self.ranges.append((first, end - 1, digest.hexdigest()))
+        image.close()
+        logging.info("Image " + self.imagePath + ": " + str(self.imageSize//(1024*1024)) + "M, " + str(self.getMappedBlocksCount()*self.blockSize//(1024*1024)) + "M Mapped In " + str(len(self.ranges)) + " Ranges")
+
+    def getBmap(self, fileChecksum):
+        """Returns bmap file contents"""
+        bmap = "<?xml version=\"1.0\" ?>\n"
+        bmap = bmap + "<!-- Generated by RootFS Build Factory. Flash with rbfflash.py or bmaptool copy -->\n"
+        bmap = bmap + "<bmap version=\"" + RbfBlockMap.BMAP_VERSION + "\">\n"
+        bmap = bmap + "    <ImageSize> " + str(self.imageSize) + " </ImageSize>\n"
+        bmap = bmap + "    <BlockSize> " + str(self.blockSize) + " </BlockSize>\n"
+        bmap = bmap + "    <BlocksCount> " + str(self.getBlocksCount()) + " </BlocksCount>\n"
+        bmap = bmap + "    <MappedBlocksCount> " + str(self.getMappedBlocksCount()) + " </MappedBlocksCount>\n"
+        bmap = bmap + "    <ChecksumType> " + RbfBlockMap.CHECKSUM_TYPE + " </ChecksumType>\n"
+        bmap = bmap + "    <BmapFileChecksum> " + fileChecksum + " </BmapFileChecksum>\n"
+        bmap = bmap + "    <BlockMap>\n"
+        for first, last, checksum in self.ranges:
+            blocks = str(first)
+            if last != first:
+                blocks = blocks + "-" + str(last)
+            bmap = bmap + "        <Range chksum=\"" + checksum + "\"> " + blocks + " </Range>\n"
+        bmap = bmap + "    </BlockMap>\n</bmap>\n"
+        return bmap
+
+    def write(self, bmapPath):
+        """Writes bmap file. Its checksum is calculated with the checksum field set to zeros"""
+        zeroChecksum = "0"*len(hashlib.new(RbfBlockMap.CHECKSUM_TYPE).hexdigest())
+        fileChecksum = hashlib.new(RbfBlockMap.CHECKSUM_TYPE, self.getBmap(zeroChecksum).encode("utf-8")).hexdigest()
+        bmapFile = open(bmapPath, "w")
+        bmapFile.write(self.getBmap(fileChecksum))
+        bmapFile.close()
+        logging.info("Block Map: " + bmapPath)
+
+    def load(self, bmapPath):
+        """Reads bmap file & checks its checksum"""
+        bmapFile = open(bmapPath, "rb")
+        contents = bmapFile.read()
+        bmapFile.close()
+        dom = xml.dom.minidom.parseString(contents)
+        getValue = lambda tag: dom.getElementsByTagName(tag)[0].childNodes[0].data.strip()
+        if getValue("ChecksumType") != RbfBlockMap.CHECKSUM_TYPE:
+            raise ValueError("Unsupported Checksum Type In " + bmapPath + ": " + getValue("ChecksumType"))
+        fileChecksum = getValue("BmapFileChecksum")
+        zeroed = contents.replace(fileChecksum.encode("utf-8"), b"0"*len(fileChecksum), 1)
+        if hashlib.new(RbfBlockMap.CHECKSUM_TYPE, zeroed).hexdigest() != fileChecksum:
+            raise ValueError("Block Map Is Corrupted: " + bmapPath)
+        self.imageSize = int(getValue("ImageSize"))
+        self.blockSize = int(getValue("BlockSize"))
+        self.ranges = []
+        for r in dom.getElementsByTagName("Range"):
+            blocks = r.childNodes[0].data.strip().split("-")
+            self.ranges.append((int(blocks[0]), int(blocks[-1]), r.getAttribute("chksum")))
+
+    def writeSparse(self, sparsePath):
+        """Writes Android sparse image of mapped blocks. Mapped blocks of zeros become fill chunks, so they are still
+        written when flashed. Only unmapped blocks become don't care chunks"""
+        chunkHeaderSize = struct.calcsize(RbfSparseImage.CHUNK_FORMAT)
+        zeroBlock = b"\0"*self.blockSize
+        image = open(self.imagePath, "rb")
+        sparse = open(sparsePath, "wb")
+        sparse.write(b"\0"*struct.calcsize(RbfSparseImage.HEADER_FORMAT))
+        run = {"type": None, "blocks": 0, "header": 0, "chunks": 0}
+
+        def endRun():
+            # Raw chunks are streamed, their header is written once their size is known
+            if run["type"] == RbfSparseImage.CHUNK_RAW:
+                end = sparse.tell()
+                sparse.seek(run["header"])
+                sparse.write(struct.pack(RbfSparseImage.CHUNK_FORMAT, RbfSparseImage.CHUNK_RAW, 0, run["blocks"], chunkHeaderSize + run["blocks"]*self.blockSize))
+                sparse.seek(end)
+            elif run["type"] == RbfSparseImage.CHUNK_FILL:
+                sparse.write(struct.pack(RbfSparseImage.CHUNK_FORMAT, RbfSparseImage.CHUNK_FILL, 0, run["blocks"], chunkHeaderSize + 4) + struct.pack("<I", 0))
+            elif run["type"] == RbfSparseImage.CHUNK_DONT_CARE:
+                sparse.write(struct.pack(RbfSparseImage.CHUNK_FORMAT, RbfSparseImage.CHUNK_DONT_CARE, 0, run["blocks"], chunkHeaderSize))
+            if run["type"] != None:
+                run["chunks"] = run["chunks"] + 1
+            run["type"] = None
+            run["blocks"] = 0
+
+        def addBlocks(chunkType, blocks, data=b""):
+            if run["type"] != chunkType:
+                endRun()
+                run["type"] = chunkType
+                if chunkType == RbfSparseImage.CHUNK_RAW:
+                    run["header"] = sparse.tell()
+                    sparse.write(b"\0"*chunkHeaderSize)
+            run["blocks"] = run["blocks"] + blocks
+            sparse.write(data)
+
+        nextBlock = 0
+        for first, last, checksum in self.ranges:
+            if first > nextBlock:
+                addBlocks(RbfSparseImage.CHUNK_DONT_CARE, first - nextBlock)
+            image.seek(first*self.blockSize)
+            block = first
+            while block <= last:
+                data = image.read(min(last + 1 - block, RbfBlockMap.READ_BLOCKS)*self.blockSize)
+                if len(data) % self.blockSize != 0 or len(data) == 0:
+                    # Pad partial last block
+                    data = data + b"\0"*(self.blockSize - len(data) % self.blockSize)
+                for i in range(0, len(data), self.blockSize):
+                    blockData = data[i:i + self.blockSize]
+                    if blockData == zeroBlock:
+                        addBlocks(RbfSparseImage.CHUNK_FILL, 1)
+                    else:
+                        addBlocks(RbfSparseImage.CHUNK_RAW, 1, blockData)
+                block = block + len(data)//self.blockSize
+            nextBlock = last + 1
+        if nextBlock < self.getBlocksCount():
+            addBlocks(RbfSparseImage.CHUNK_DONT_CARE, self.getBlocksCount() - nextBlock)
+        endRun()
+        sparse.seek(0)
+        sparse.write(struct.pack(RbfSparseImage.HEADER_FORMAT, RbfSparseImage.MAGIC, 1, 0, struct.calcsize(RbfSparseImage.HEADER_FORMAT), chunkHeaderSize, self.blockSize, self.getBlocksCount(), run["chunks"], 0))
+        sparse.close()
+        image.close()
+        logging.info("Sparse Image: " + sparsePath + " " + str(os.path.getsize(sparsePath)//(1024*1024)) + "M In " + str(run["chunks"]) + " Chunks")
+
+class RbfSparseImage():
+    """RbfSparseImage Class.
+
+    Constants of the Android sparse image format, as written by img2simg & read by fastboot & simg2img
+    """
+    MAGIC = 0xed26ff3a
+    HEADER_FORMAT = "<IHHHHIIII"
+    CHUNK_FORMAT = "<HHII"
+    CHUNK_RAW, CHUNK_FILL, CHUNK_DONT_CARE, CHUNK_CRC32 = (0xCAC1, 0xCAC2, 0xCAC3, 0xCAC4)
+
+if __name__ == "__main__":
+    # rbfoutput.py <image> <bmap|sparse>... Writes <image>.bmap & <image>.simg
+    if len(sys.argv) < 3 or len([f for f in sys.argv[2:] if f not in ["bmap", "sparse"]]) != 0:
+        sys.stderr.write("Usage: rbfoutput.py <image> <bmap|sparse>...\n")
+        sys.exit(1)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    try:
+        blockMap = RbfBlockMap(sys.argv[1])
+        blockMap.map()
+        if "bmap" in sys.argv[2:]:
+            blockMap.write(sys.argv[1] + ".bmap")
+        if "sparse" in sys.argv[2:]:
+            blockMap.writeSparse(sys.argv[1] + ".simg")
+    except (IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""@package rbfprefetch
+Package Prefetcher For RootFS Build Factory
+
+Downloads the RPMs of a resolved transaction concurrently into the package cache before yum runs
+"""
+
+import os
+import sys
+import time
+import logging
+import json
+import gzip
+import bz2
+import hashlib
+import io
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class RbfPrefetcher():
+    """RbfPrefetcher Class.
+
+    Downloads package URLs with a limited number of connections, retries & verifies checksums from repo metadata.
+    Packages are only accepted unverified if the metadata of their repo has no checksums at all
+    """
+    REPO_NAMESPACE = "{http://linux.duke.edu/metadata/repo}"
+    COMMON_NAMESPACE = "{http://linux.duke.edu/metadata/common}"
+    DOWNLOADED, CACHED, FAILED = ("downloaded", "cached", "failed")
+    TIMEOUT = 60
+
+    def __init__(self, connections, retries):
+        """Constructor for RbfPrefetcher"""
+        self.connections = connections
+        self.retries = retries
+        self.repos = {}
+        self.checksums = {}
+        self.checksumRepos = set()
+
+    def addRepo(self, baseurl, packagesDir):
+        """Packages of repo baseurl are downloaded to packagesDir"""
+        baseurl = baseurl.rstrip("/") + "/"
+        if not os.path.isdir(packagesDir):
+            os.makedirs(packagesDir)
+        self.repos[baseurl] = packagesDir
+
+    def fetch(self, url):
+        """Returns contents of url"""
+        response = urlopen(url, timeout=RbfPrefetcher.TIMEOUT)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def decompress(self, data, href):
+        """Decompresses metadata file by extension of href"""
+        if href.endswith(".gz"):
+            return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        if href.endswith(".bz2"):
+            return bz2.decompress(data)
+        if href.endswith(".xz"):
+            if lzma == None:
+                raise ValueError("xz Compressed Metadata Needs lzma Module: " + href)
+            return lzma.decompress(data)
+        return data
+
+    def loadChecksums(self, baseurl):
+        """Reads checksums of all packages of repo from its primary metadata"""
+        repomd = ElementTree.fromstring(self.fetch(baseurl + "repodata/repomd.xml"))
+        for data in repomd.findall(RbfPrefetcher.REPO_NAMESPACE + "data"):
+            if data.get("type") != "primary":
+                continue
+            href = data.find(RbfPrefetcher.REPO_NAMESPACE + "location").get("href")
+            primary = self.decompress(self.fetch(baseurl + href), href)
+            for event, element in ElementTree.iterparse(io.BytesIO(primary)):
+                if element.tag != RbfPrefetcher.COMMON_NAMESPACE + "package":
+                    continue
+                location = element.find(RbfPrefetcher.COMMON_NAMESPACE + "location")
+                checksum = element.find(RbfPrefetcher.COMMON_NAMESPACE + "checksum")
+                if location != None and checksum != None:
+                    self.checksums[baseurl + location.get("href")] = (checksum.get("type"), checksum.text.strip())
+                    self.checksumRepos.add(baseurl)
+                element.clear()
+
+    def getRepo(self, url):
+        """Returns baseurl of repo url belongs to. None if url is not in any repo"""
+        for baseurl in sorted(self.repos, key=len, reverse=True):
+            if url.startswith(baseurl):
+                return baseurl
+        return None
+
+    def verify(self, url, path):
+        """Checks file against checksum of url. Files without known checksum are accepted if their repo has no checksums"""
+        if url not in self.checksums:
+            return self.getRepo(url) not in self.checksumRepos
+        checksumType, checksum = self.checksums[url]
+        if checksumType == "sha":
+            checksumType = "sha1"
+        digest = hashlib.new(checksumType)
+        pathFile = open(path, "rb")
+        for block in iter(lambda: pathFile.read(1024*1024), b""):
+            digest.update(block)
+        pathFile.close()
+        return digest.hexdigest() == checksum
+
+    def download(self, url):
+        """Downloads url unless a verified copy is cached. Returns (url, status, bytes, error)"""
+        baseurl = self.getRepo(url)
+        if baseurl == None:
+            return (url, RbfPrefetcher.FAILED, 0, "Not In Any Repo")
+        if url not in self.checksums and baseurl in self.checksumRepos:
+            return (url, RbfPrefetcher.FAILED, 0, "No Checksum In Repo Metadata")
+        path = os.path.join(self.repos[baseurl], os.path.basename(url))
+        if os.path.exists(path) and self.verify(url, path):
+            return (url, RbfPrefetcher.CACHED, 0, "")
+        error = ""
+        for attempt in range(0, self.retries + 1):
+            if attempt != 0:
+                time.sleep(attempt)
+            response = None
+            partFile = None
+            try:
+                response = urlopen(url, timeout=RbfPrefetcher.TIMEOUT)
+                partFile = open(path + ".part", "wb")
+                size = 0
+                for block in iter(lambda: response.read(1024*1024), b""):
+                    partFile.write(block)
+                    size = size + len(block)
+                partFile.close()
+                partFile = None
+                if not self.verify(url, path + ".part"):
+                    error = "Checksum Mismatch"
+                    continue
+                os.rename(path + ".part", path)
+                return (url, RbfPrefetcher.DOWNLOADED, size, "")
+            except Exception as e:
+                # Interrupted transfers raise more than IOError, eg. IncompleteRead
+                error = str(e) or e.__class__.__name__
+            finally:
+                if partFile != None:
+                    partFile.close()
+                if response != None:
+                    response.close()
+                if os.path.exists(path + ".part"):
+                    os.remove(path + ".part")
+        return (url, RbfPrefetcher.FAILED, 0, error)
+
+    def run(self, urls, reportPath):
+        """Downloads all urls & writes report. Returns True if every package is available"""
+        for baseurl in self.repos:
+            try:
+                self.loadChecksums(baseurl)
+            except Exception as e:
+                logging.error("Could Not Read Checksums Of Repo " + baseurl + ": " + str(e))
+                return False
+        startTime = time.time()
+        pool = ThreadPool(self.connections)
+        results = pool.map(self.download, urls)
+        pool.close()
+        pool.join()
+        duration = time.time() - startTime
+
+        downloaded = [r for r in results if r[1] == RbfPrefetcher.DOWNLOADED]
+        failed = [r for r in results if r[1] == RbfPrefetcher.FAILED]
+        unverified = [r for r in results if r[1] != RbfPrefetcher.FAILED and r[0] not in self.checksums]
+        downloadedBytes = sum([r[2] for r in downloaded])
+        throughput = downloadedBytes/max(duration, 0.001)
+        for url, status, size, error in failed:
+            logging.error("Could Not Download " + url + ": " + error)
+        for url, status, size, error in unverified:
+            logging.warning("No Checksum In Repo Metadata. Not Verified: " + url)
+        logging.info("Prefetched " + str(len(urls)) + " Packages: " + str(len(downloaded)) + " Downloaded " + str(len(results) - len(downloaded) - len(failed)) + " Cached " + str(len(failed)) + " Failed " + str(len(unverified)) + " Unverified. " + str(downloadedBytes//(1024*1024)) + "M In " + str(round(duration, 1)) + "s " + str(round(throughput/(1024*1024), 2)) + "M/s With " + str(self.connections) + " Connections")
+        reportFile = open(reportPath, "w")
+        json.dump({"packages": len(urls), "downloaded": len(downloaded), "cached": len(results) - len(downloaded) - len(failed), "failed": [{"url": r[0], "error": r[3]} for r in failed], "unverified": [r[0] for r in unverified], "bytes": downloadedBytes, "seconds": round(duration, 3), "bytesPerSecond": int(throughput), "connections": self.connections}, reportFile, indent=2, sort_keys=True)
+        reportFile.write("\n")
+        reportFile.close()
+        return len(failed) == 0
+
+if __name__ == "__main__":
+    # rbfprefetch.py <urls file> <report.json> <connections> <retries> <baseurl>=<packages dir>...
+    if len(sys.argv) < 6:
+        sys.stderr.write("Usage: rbfprefetch.py <urls file> <report.json> <connections> <retries> <baseurl>=<packages dir>...\n")
+        sys.exit(1)
+    logging.addLevelName(logging.WARNING, "WARN")
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    prefetcher = RbfPrefetcher(int(sys.argv[3]), int(sys.argv[4]))
+    for repo in sys.argv[5:]:
+        baseurl, packagesDir = repo.rsplit("=", 1)
+        prefetcher.addRepo(baseurl, packagesDir)
+    urlsFile = open(sys.argv[1])
+    urls = sorted(set([line.strip() for line in urlsFile if line.strip().endswith(".rpm") and "://" in line]))
+    urlsFile.close()
+    if not prefetcher.run(urls, sys.argv[2]):
+        sys.exit(1)
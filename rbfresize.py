@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+"""@package rbfresize
+Image Resizer For RootFS Build Factory
+
+Shrinks the last partition of an image to its content plus headroom & truncates the image
+"""
+
+import os
+import sys
+import logging
+import subprocess
+from rbfutils import RbfUtils, RbfPartitionTable
+
+class RbfImageResizer():
+    """RbfImageResizer Class.
+
+    The last partition must hold an ext filesystem. It is shrunk with resize2fs, its partition table entry
+    is rewritten & the image is cut after it
+    """
+    MB = 1024*1024
+
+    def __init__(self, imagePath, partitionTable, headroom):
+        """Constructor for RbfImageResizer. headroom takes suffix s, K, M or G"""
+        self.imagePath = imagePath
+        self.partitionTable = partitionTable
+        self.headroom = RbfUtils().getSizeInSectors(headroom)*int(RbfUtils.SECTOR_SIZE)
+
+    def runCommand(self, command, okCodes=[0]):
+        """Runs command. Returns its output"""
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf-8", "replace")
+        if process.returncode not in okCodes:
+            raise OSError(" ".join(command) + " Failed With Exit Code " + str(process.returncode) + ": " + output.strip())
+        return output
+
+    def getFilesystemBytes(self, fsPath):
+        """Returns size of ext filesystem in bytes"""
+        info = {}
+        for line in self.runCommand(["dumpe2fs", "-h", fsPath]).splitlines():
+            if ":" in line:
+                key, value = line.split(":", 1)
+                info[key.strip()] = value.strip()
+        return int(info["Block count"])*int(info["Block size"])
+
+    def shrinkFilesystem(self, fsPath):
+        """Shrinks filesystem to its minimum size plus headroom. Returns new size in bytes"""
+        # e2fsck exits with 1 or 2 after fixing errors
+        self.runCommand(["e2fsck", "-fy", fsPath], [0, 1, 2])
+        self.runCommand(["resize2fs", "-M", fsPath])
+        minimumBytes = self.getFilesystemBytes(fsPath)
+        targetBytes = (minimumBytes + self.headroom + RbfImageResizer.MB - 1)//RbfImageResizer.MB*RbfImageResizer.MB
+        self.runCommand(["resize2fs", fsPath, str(targetBytes//1024) + "K"])
+        if os.path.isfile(fsPath):
+            fsImage = open(fsPath, "r+b")
+            fsImage.truncate(targetBytes)
+            fsImage.close()
+        logging.info("Filesystem " + fsPath + " Shrunk To " + str(targetBytes//RbfImageResizer.MB) + "M. Minimum " + str(minimumBytes//RbfImageResizer.MB) + "M")
+        return targetBytes
+
+    def fitImage(self, lastBytes):
+        """Resizes last partition to lastBytes, rewrites partition table & truncates image after the last partition"""
+        partitions = self.partitionTable.partitions
+        if len(partitions) == 0 or partitions[-1]["ptype"] == "extended":
+            raise ValueError("Last Partition Must Not Be Extended")
+        partitions[-1]["sectors"] = lastBytes//int(RbfUtils.SECTOR_SIZE)
+        for p in partitions:
+            if p["ptype"] == "extended":
+                p["sectors"] = 0
+        lastEnd = max([end for number, ptype, fs, begin, end in self.partitionTable.plan()])
+        imageSectors = lastEnd + 1
+        if self.partitionTable.table == RbfPartitionTable.GPT:
+            imageSectors = imageSectors + 1 + RbfPartitionTable.GPT_ENTRIES*RbfPartitionTable.GPT_ENTRY_SIZE//int(RbfUtils.SECTOR_SIZE)
+        imageBytes = (imageSectors*int(RbfUtils.SECTOR_SIZE) + RbfImageResizer.MB - 1)//RbfImageResizer.MB*RbfImageResizer.MB
+        self.partitionTable.totalSectors = imageBytes//int(RbfUtils.SECTOR_SIZE)
+        image = open(self.imagePath, "r+b")
+        image.truncate(imageBytes)
+        image.close()
+        self.partitionTable.write(self.imagePath)
+        logging.info("Image " + self.imagePath + " Truncated To " + str(imageBytes//RbfImageResizer.MB) + "M")
+        return imageBytes
+
+if __name__ == "__main__":
+    # rbfresize.py <image> <last partition device or filesystem image> <headroom> <msdos|gpt> <align> <size:fs:ptype>...
+    if len(sys.argv) < 7:
+        sys.stderr.write("Usage: rbfresize.py <image> <last partition device or filesystem image> <headroom> <msdos|gpt> <align> <size:fs:ptype>...\n")
+        sys.exit(1)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(levelname)-5.5s]  %(message)s")
+    try:
+        imageSize = str(os.path.getsize(sys.argv[1])//int(RbfUtils.SECTOR_SIZE)) + "s"
+        partitionTable = RbfPartitionTable(imageSize, sys.argv[4], sys.argv[5])
+        for spec in sys.argv[6:]:
+            size, fs, ptype = spec.split(":")
+            partitionTable.addPartition(size, fs, ptype)
+        resizer = RbfImageResizer(sys.argv[1], partitionTable, sys.argv[3])
+        resizer.fitImage(resizer.shrinkFilesystem(sys.argv[2]))
+    except (ValueError, IOError, OSError, KeyError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
+import os
+import sys
+import struct
+import zlib
+import uuid
+import xml.dom.minidom
+
 class RbfUtils():
     #PARTITION_BEGIN = "2048"
     PARTITION_BEGIN = "1M"
     SECTOR_SIZE = "512"
+    QEMU_ARCHES = {"armv7hl": "arm", "armv7l": "arm", "armhfp": "arm", "aarch64": "aarch64", "x86_64": "x86_64", "i686": "i386", "ppc64le": "ppc64le", "s390x": "s390x"}
     def __init__(self):
         """RootFS Build Factory Utils"""
         
@@ -11,7 +19,7 @@ class RbfUtils():
         """Calculates End Sector when provided with Begin Sector"""
         size = self.getImageSizeInM(size)
         size = size[0:len(size)-1]
-        endSector = int(begin) + int(size)*1024*1024/int(self.SECTOR_SIZE) -1
+        endSector = int(begin) + int(size)*1024*1024//int(self.SECTOR_SIZE) -1
         return str(endSector)
         
     def calcParitionEndSize(self, begin, size):
@@ -25,10 +33,266 @@ class RbfUtils():
             imageSize = str(int(imageSize[0:-1])*1024) + "M"
         return imageSize
         
+    def getSizeInSectors(self, size):
+        """Converts Size with suffix s (sectors), K, M or G to sectors"""
+        multipliers = {"s": int(self.SECTOR_SIZE), "K": 1024, "M": 1024*1024, "G": 1024*1024*1024}
+        if size[-1:] not in multipliers or not self.isSizeInt(size[0:-1]):
+            raise ValueError("Invalid Size: " + size + ". Only Integers with suffix s, K, M or G allowed")
+        return int(size[0:-1])*multipliers[size[-1]]//int(self.SECTOR_SIZE)
+
+    def loadTemplate(self, xmlTemplate, inheritedBy=[]):
+        """Parses XML Template. A template with base="other.xml" on its root tag inherits every top level tag
+        of other.xml it does not set itself. The base path is relative to the template"""
+        templatePath = os.path.abspath(xmlTemplate)
+        if templatePath in inheritedBy:
+            raise ValueError("Template Inherits From Itself: " + xmlTemplate)
+        dom = xml.dom.minidom.parse(xmlTemplate)
+        root = dom.documentElement
+        if not root.hasAttribute("base"):
+            return dom
+        basePath = os.path.join(os.path.dirname(xmlTemplate), root.getAttribute("base"))
+        baseDom = self.loadTemplate(basePath, inheritedBy + [templatePath])
+        return self.mergeTemplates(baseDom, dom)
+
+    def mergeTemplates(self, baseDom, dom):
+        """Replaces top level tags of baseDom by the tags of dom with the same name. Returns baseDom"""
+        baseRoot = baseDom.documentElement
+        elements = [n for n in dom.documentElement.childNodes if n.nodeType == n.ELEMENT_NODE]
+        tagNames = set([e.tagName for e in elements])
+        for n in list(baseRoot.childNodes):
+            if n.nodeType == n.ELEMENT_NODE and n.tagName in tagNames:
+                baseRoot.removeChild(n)
+        for e in elements:
+            baseRoot.appendChild(baseDom.importNode(e, True))
+        return baseDom
+
+    def getMatrixVariants(self, xmlTemplate):
+        """Expands the matrix tag of a template into one template per distro & board. Every variant is the
+        template merged with the distro template & then the board template. Returns List of (name, dom). None if there is no matrix"""
+        dom = self.loadTemplate(xmlTemplate)
+        matrixDom = dom.getElementsByTagName("matrix")
+        if len(matrixDom) == 0:
+            return None
+        templateDir = os.path.dirname(xmlTemplate)
+        boards = [b.getAttribute("template") for b in matrixDom[0].getElementsByTagName("board")]
+        distros = [d.getAttribute("template") for d in matrixDom[0].getElementsByTagName("distro")] or [None]
+        if len(boards) == 0 or "" in boards or "" in distros:
+            raise ValueError("Matrix Needs At Least One Board & A template Attribute On Every Board & Distro")
+        variants = []
+        for distro in distros:
+            for board in boards:
+                variantDom = self.loadTemplate(xmlTemplate)
+                variantMatrix = variantDom.getElementsByTagName("matrix")[0]
+                variantMatrix.parentNode.removeChild(variantMatrix)
+                name = os.path.splitext(os.path.basename(board))[0]
+                if distro != None:
+                    variantDom = self.mergeTemplates(variantDom, self.loadTemplate(os.path.join(templateDir, distro)))
+                    name = os.path.splitext(os.path.basename(distro))[0] + "-" + name
+                variantDom = self.mergeTemplates(variantDom, self.loadTemplate(os.path.join(templateDir, board)))
+                variants.append((name, variantDom))
+        return variants
+
     def isSizeInt(self,size):
        try: 
           int(size)
           return True
        except ValueError:
           return False
+
+class RbfPartitionTable():
+    """RbfPartitionTable Class.
+
+    Plans partitions in sectors aligned to align & writes msdos or gpt tables directly into image files.
+    msdos tables with more than 4 partitions get an extended partition holding logical ones
+    """
+    MSDOS, GPT = "msdos", "gpt"
+    GPT_ENTRIES = 128
+    GPT_ENTRY_SIZE = 128
+    MBR_TYPES = {"swap": 0x82, "vfat": 0x0c, "extended": 0x0f}
+    MBR_LINUX_TYPE = 0x83
+    GPT_TYPES = {"swap": "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f", "vfat": "ebd0a0a2-b9e5-4433-87c0-68b6b72699c7"}
+    GPT_LINUX_TYPE = "0fc63daf-8483-4772-8e79-3d69d8477de4"
+
+    def __init__(self, imageSize, table="msdos", align=RbfUtils.PARTITION_BEGIN):
+        """Constructor for RbfPartitionTable. imageSize & align take suffix s, K, M or G"""
+        self.rbfUtils = RbfUtils()
+        self.sectorSize = int(RbfUtils.SECTOR_SIZE)
+        self.totalSectors = self.rbfUtils.getSizeInSectors(imageSize)
+        self.align = self.rbfUtils.getSizeInSectors(align)
+        if self.align == 0:
+            raise ValueError("Alignment Must Be At Least One Sector")
+        if table not in [RbfPartitionTable.MSDOS, RbfPartitionTable.GPT]:
+            raise ValueError("Unknown Partition Table: " + table + ". Use msdos or gpt")
+        self.table = table
+        self.partitions = []
+
+    def addPartition(self, size, fs, ptype="primary"):
+        """Adds partition. size takes suffix s, K, M or G"""
+        if ptype not in ["primary", "extended", "logical"]:
+            raise ValueError("Unknown Partition Type: " + ptype)
+        self.partitions.append({"sectors": self.rbfUtils.getSizeInSectors(size), "fs": fs, "ptype": ptype})
+
+    def alignUp(self, sector):
+        """Returns first aligned sector at or after sector"""
+        return (sector + self.align - 1)//self.align*self.align
+
+    def plan(self):
+        """Lays out partitions. Returns List of (number, ptype, fs, beginSector, endSector)"""
+        partitions = self.partitions
+        if self.table == RbfPartitionTable.GPT:
+            for p in partitions:
+                if p["ptype"] == "extended":
+                    raise ValueError("Extended Partitions Are Not Supported With gpt")
+            partitions = [dict(p, ptype="primary") for p in partitions]
+        elif len(partitions) > 4 and "extended" not in [p["ptype"] for p in partitions]:
+            partitions = [dict(p) for p in partitions]
+            for p in partitions[3:]:
+                p["ptype"] = "logical"
+            partitions.insert(3, {"sectors": 0, "fs": "extended", "ptype": "extended"})
+
+        layout = []
+        primaryNumber = 0
+        logicalNumber = 4
+        extended = None
+        sector = self.align
+        if self.table == RbfPartitionTable.GPT:
+            # Partitions must not overlap the primary header & entries
+            sector = self.alignUp(max(self.align, 2 + self.GPT_ENTRIES*self.GPT_ENTRY_SIZE//self.sectorSize))
+        for p in partitions:
+            if p["ptype"] == "logical":
+                if extended is None:
+                    raise ValueError("Cannot Create Logical Partition Before Extended")
+                # Each logical partition is preceded by its EBR
+                begin = self.alignUp(sector + 1)
+                logicalNumber = logicalNumber + 1
+                layout.append([logicalNumber, "logical", p["fs"], begin, begin + p["sectors"] - 1])
+                sector = begin + p["sectors"]
+                extended[4] = max(extended[4], sector - 1)
+                continue
+            if extended is not None:
+                raise ValueError("Cannot Create Primary Partition After Extended")
+            primaryNumber = primaryNumber + 1
+            if self.table == RbfPartitionTable.MSDOS and primaryNumber > 4:
+                raise ValueError("Cannot Have More Than 4 Primary Partitions")
+            begin = self.alignUp(sector)
+            if p["ptype"] == "extended":
+                extended = [primaryNumber, "extended", "extended", begin, begin + max(p["sectors"], 1) - 1]
+                layout.append(extended)
+                sector = begin
+            else:
+                layout.append([primaryNumber, p["ptype"], p["fs"], begin, begin + p["sectors"] - 1])
+                sector = begin + p["sectors"]
+
+        lastUsable = self.totalSectors - 1
+        if self.table == RbfPartitionTable.GPT:
+            lastUsable = self.totalSectors - 2 - self.GPT_ENTRIES*self.GPT_ENTRY_SIZE//self.sectorSize
+        for number, ptype, fs, begin, end in layout:
+            if end > lastUsable:
+                raise ValueError("Partition " + str(number) + " Ends At Sector " + str(end) + " Beyond Last Usable Sector " + str(lastUsable))
+        return [tuple(p) for p in layout]
+
+    def getMbrEntry(self, ptype, begin, sectors):
+        """Returns 16 byte MBR partition entry. CHS fields are set to LBA only"""
+        return struct.pack("<B3sB3sII", 0, b"\xfe\xff\xff", ptype, b"\xfe\xff\xff", begin, sectors)
+
+    def writeBootSector(self, image, sector, entries, diskId=None):
+        """Writes up to 4 entries & boot signature to sector. Boot code is left untouched"""
+        image.seek(sector*self.sectorSize)
+        bootSector = bytearray(image.read(self.sectorSize).ljust(self.sectorSize, b"\0"))
+        if diskId is not None:
+            bootSector[440:446] = struct.pack("<IH", diskId, 0)
+        table = b"".join(entries).ljust(64, b"\0")
+        bootSector[446:510] = table
+        bootSector[510:512] = b"\x55\xaa"
+        image.seek(sector*self.sectorSize)
+        image.write(bytes(bootSector))
+
+    def writeMsdos(self, image, layout):
+        """Writes MBR & EBR chain"""
+        entries = []
+        for number, ptype, fs, begin, end in layout:
+            if ptype != "logical":
+                entries.append(self.getMbrEntry(self.MBR_TYPES.get(fs, self.MBR_LINUX_TYPE), begin, end - begin + 1))
+        self.writeBootSector(image, 0, entries, struct.unpack("<I", os.urandom(4))[0])
+
+        extended = [p for p in layout if p[1] == "extended"]
+        logical = [p for p in layout if p[1] == "logical"]
+        # First EBR is the first sector of the extended partition, later ones sit just before their partition
+        ebrs = [p[3] - 1 for p in logical]
+        if len(logical) != 0:
+            ebrs[0] = extended[0][3]
+        for i in range(0, len(logical)):
+            number, ptype, fs, begin, end = logical[i]
+            ebrEntries = [self.getMbrEntry(self.MBR_TYPES.get(fs, self.MBR_LINUX_TYPE), begin - ebrs[i], end - begin + 1)]
+            if i + 1 < len(logical):
+                ebrEntries.append(self.getMbrEntry(0x05, ebrs[i + 1] - extended[0][3], logical[i + 1][4] - ebrs[i + 1] + 1))
+            self.writeBootSector(image, ebrs[i], ebrEntries)
+
+    def getGptHeader(self, currentLba, backupLba, entriesLba, diskGuid, entriesCrc):
+        """Returns GPT header sector"""
+        entriesSectors = self.GPT_ENTRIES*self.GPT_ENTRY_SIZE//self.sectorSize
+        firstUsable = 2 + entriesSectors
+        lastUsable = self.totalSectors - 2 - entriesSectors
+        header = struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x00010000, 92, 0, 0, currentLba, backupLba, firstUsable, lastUsable, diskGuid, entriesLba, self.GPT_ENTRIES, self.GPT_ENTRY_SIZE, entriesCrc)
+        headerCrc = zlib.crc32(header) & 0xffffffff
+        header = header[0:16] + struct.pack("<I", headerCrc) + header[20:]
+        return header.ljust(self.sectorSize, b"\0")
+
+    def writeGpt(self, image, layout):
+        """Writes protective MBR, primary & backup GPT headers and entries"""
+        self.writeBootSector(image, 0, [self.getMbrEntry(0xee, 1, min(self.totalSectors - 1, 0xffffffff))])
+        entries = b""
+        for number, ptype, fs, begin, end in layout:
+            typeGuid = uuid.UUID(self.GPT_TYPES.get(fs, self.GPT_LINUX_TYPE)).bytes_le
+            name = ("rbf" + str(number)).encode("utf-16-le").ljust(72, b"\0")
+            entries = entries + struct.pack("<16s16sQQQ72s", typeGuid, uuid.uuid4().bytes_le, begin, end, 0, name)
+        entries = entries.ljust(self.GPT_ENTRIES*self.GPT_ENTRY_SIZE, b"\0")
+        entriesCrc = zlib.crc32(entries) & 0xffffffff
+        entriesSectors = len(entries)//self.sectorSize
+        diskGuid = uuid.uuid4().bytes_le
+        lastLba = self.totalSectors - 1
+
+        image.seek(1*self.sectorSize)
+        image.write(self.getGptHeader(1, lastLba, 2, diskGuid, entriesCrc))
+        image.write(entries)
+        image.seek((lastLba - entriesSectors)*self.sectorSize)
+        image.write(entries)
+        image.write(self.getGptHeader(lastLba, 1, lastLba - entriesSectors, diskGuid, entriesCrc))
+
+    def write(self, imagePath):
+        """Writes partition table into existing image file"""
+        layout = self.plan()
+        image = open(imagePath, "r+b")
+        try:
+            if self.table == RbfPartitionTable.GPT:
+                self.writeGpt(image, layout)
+            else:
+                self.writeMsdos(image, layout)
+        finally:
+            image.close()
+        return layout
+
+    def getCommandArgs(self):
+        """Returns arguments for rbfutils.py to write this table from a build script"""
+        args = [self.table, str(self.align) + "s"]
+        for p in self.partitions:
+            args.append(str(p["sectors"]) + "s:" + p["fs"] + ":" + p["ptype"])
+        return args
+
+if __name__ == "__main__":
+    # rbfutils.py <image> <msdos|gpt> <align> <size:fs:ptype>... Sizes in s (sectors), K, M or G
+    if len(sys.argv) < 4:
+        sys.stderr.write("Usage: rbfutils.py <image> <msdos|gpt> <align> <size:fs:ptype>...\n")
+        sys.exit(1)
+    try:
+        imageSize = str(os.path.getsize(sys.argv[1])//int(RbfUtils.SECTOR_SIZE)) + "s"
+        partitionTable = RbfPartitionTable(imageSize, sys.argv[2], sys.argv[3])
+        for spec in sys.argv[4:]:
+            size, fs, ptype = spec.split(":")
+            partitionTable.addPartition(size, fs, ptype)
+        for number, ptype, fs, begin, end in partitionTable.write(sys.argv[1]):
+            sys.stdout.write("Partition " + str(number) + " " + ptype + " " + fs + " " + str(begin) + "s - " + str(end) + "s\n")
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
           
@@ -0,0 +1,61 @@
+"""Shared fixtures for the tests of RootFS Build Factory"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbfutils import RbfPartitionTable
+
+class RbfTestCase(unittest.TestCase):
+    """Runs every test in its own temp directory. Progress logged by the module under test is discarded"""
+    BLOCK_SIZE = 4096
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempDir)
+
+    def getPath(self, name):
+        """Returns path of name in the temp directory"""
+        return os.path.join(self.tempDir, name)
+
+    def readFile(self, path):
+        """Returns contents of file"""
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def writeImage(self, path, size, blocks):
+        """Writes sparse image of size. blocks is Dict of block number -> data written there. Returns contents"""
+        image = open(path, "wb")
+        image.truncate(size)
+        for block in blocks:
+            image.seek(block*RbfTestCase.BLOCK_SIZE)
+            image.write(blocks[block])
+        image.close()
+        return self.readFile(path)
+
+    def writePartitionedImage(self, path, size, table, sizes, contents):
+        """Writes image of size with partitions of sizes aligned to 64K. contents are written at the start of the partitions.
+        Returns layout of the partition table"""
+        image = open(path, "wb")
+        image.truncate(size)
+        image.close()
+        partitionTable = RbfPartitionTable(str(size//(1024*1024)) + "M", table, "64K")
+        for partitionSize in sizes:
+            partitionTable.addPartition(partitionSize, "ext4")
+        layout = partitionTable.write(path)
+        image = open(path, "r+b")
+        for i in range(0, len(contents)):
+            image.seek(layout[i][3]*512)
+            image.write(contents[i])
+        image.close()
+        return layout
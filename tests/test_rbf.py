@@ -0,0 +1,66 @@
+"""Tests for BoardTemplateParser"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbf import BoardTemplateParser
+from rbfcache import RbfCache
+from rbfbackend import RbfDnfBackend
+
+class BoardTemplateParserTest(unittest.TestCase):
+    """Checks parser state without building. Repos are local file:// URLs"""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tempDir = tempfile.mkdtemp()
+        self.repoPath = os.path.join(self.tempDir, "repo")
+        os.makedirs(os.path.join(self.repoPath, "repodata"))
+        repomd = open(os.path.join(self.repoPath, "repodata", "repomd.xml"), "w")
+        repomd.write("<repomd></repomd>")
+        repomd.close()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempDir)
+
+    def getParser(self, releaseVer, action="build"):
+        """Returns parser for action set up to install bash from the local repo with dnf"""
+        workspace = os.path.join(self.tempDir, "workspace")
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        parser = BoardTemplateParser(action, "test.xml", workspace)
+        parser.cache = RbfCache(os.path.join(self.tempDir, "cache"), 100)
+        parser.useSnapshots = True
+        parser.linuxDistro = "fedora"
+        parser.kernelType = "stock"
+        parser.repoNames = ["base"]
+        parser.repoPaths = {"base": "file://" + self.repoPath}
+        parser.packages = ["bash"]
+        parser.backend = RbfDnfBackend(parser.workDir, False, "", "", releaseVer)
+        return parser
+
+    def testSnapshotKeyCoversBackendOptions(self):
+        keys = []
+        for releaseVer in ["38", "38", "39"]:
+            parser = self.getParser(releaseVer)
+            keys.append(parser.getSnapshotKey())
+            parser.workspaceLock.close()
+        self.assertNotEqual(None, keys[0])
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+
+    def testParseLeavesCacheAlone(self):
+        parser = self.getParser("38", "parse")
+        parser.repoPaths = {"base": "http://unreachable.invalid/repo"}
+        self.assertEqual(None, parser.getSnapshotKey())
+        self.assertEqual(None, parser.cache.buildLock)
+        self.assertFalse(os.path.exists(parser.cache.cacheDir))
+        parser.workspaceLock.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Tests for package manager backends"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbfbackend import RbfPackageBackend, RbfYumBackend, RbfDnfBackend
+
+class RbfBackendTest(unittest.TestCase):
+    """Checks the generated commands of each backend"""
+
+    def testInterface(self):
+        for backend in [RbfYumBackend("/root", True), RbfDnfBackend("/root", True)]:
+            self.assertTrue(backend.COMMAND != None and backend.PREFETCH_COMMAND != None)
+            self.assertEqual([], backend.getInstallCommands([], []))
+            self.assertTrue(backend.getPrefetchCommand(["bash"], "/urls").startswith(backend.PREFETCH_COMMAND + " "))
+
+    def testYumInstallsGroupsAndPackagesSeparately(self):
+        backend = RbfYumBackend("/root", True)
+        backend.setRepos(["base", "updates"])
+        commands = backend.getInstallCommands(["core"], ["bash"])
+        self.assertEqual([RbfPackageBackend.GROUPS, RbfPackageBackend.PACKAGES], [c[0] for c in commands])
+        self.assertEqual("yum -y --disablerepo=* --enablerepo=base,updates --installroot=/root groupinstall core", commands[0][1])
+        self.assertFalse(" -y " in " " + backend.getPrefetchCommand(["bash"], "/urls"))
+
+    def testDnfInstallsInOneTransaction(self):
+        backend = RbfDnfBackend("/root", False, "10", "false", "7", "aarch64")
+        backend.setRepos(["base"])
+        commands = backend.getInstallCommands(["@core"], ["bash"])
+        self.assertEqual(1, len(commands))
+        self.assertEqual("dnf --disablerepo=* --enablerepo=base --installroot=/root --setopt=max_parallel_downloads=10 --setopt=install_weak_deps=False --releasever=7 --forcearch=aarch64 install @core bash", commands[0][1])
+        self.assertEqual("dnf --disablerepo=* --enablerepo=base --installroot=/root --setopt=max_parallel_downloads=10 --setopt=install_weak_deps=False --releasever=7 --forcearch=aarch64 download --resolve --urls bash > /urls", backend.getPrefetchCommand(["bash"], "/urls"))
+        self.assertFalse(" -y " in " " + RbfDnfBackend("/root", True).getPrefetchCommand(["bash"], "/urls"))
+
+    def testTransactionOptions(self):
+        backend = RbfDnfBackend("/root", True, "10", "", "7")
+        backend.setRepos(["base"])
+        backend.setCacheOptions(" --setopt=cachedir=/var/cache/rbf --setopt=keepcache=1 -C")
+        self.assertEqual("--disablerepo=* --enablerepo=base --setopt=max_parallel_downloads=10 --releasever=7", backend.getTransactionOptions())
+        backend.setInstallRoot("/other")
+        self.assertEqual("--disablerepo=* --enablerepo=base --setopt=max_parallel_downloads=10 --releasever=7", backend.getTransactionOptions())
+
+    def testCacheLayout(self):
+        self.assertEqual(("base", "repomd.xml"), (RbfYumBackend("/", True).getCacheDirName("base", "http://repo"), RbfYumBackend("/", True).getMetadataPath()))
+        dnfBackend = RbfDnfBackend("/", True)
+        self.assertTrue(dnfBackend.getCacheDirName("base", "http://repo").startswith("base-"))
+        self.assertEqual(16, len(dnfBackend.getCacheDirName("base", "http://repo").split("-")[1]))
+        self.assertEqual(os.path.join("repodata", "repomd.xml"), dnfBackend.getMetadataPath())
+
+if __name__ == "__main__":
+    unittest.main()
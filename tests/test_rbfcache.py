@@ -0,0 +1,76 @@
+"""Tests for RbfCache"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbfcache import RbfCache
+from rbfbackend import RbfYumBackend, RbfDnfBackend
+
+class RbfCacheTest(unittest.TestCase):
+    """Fills a cache in a temp directory with small fake packages"""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempDir)
+
+    def addPackage(self, cache, baseurl, name, size, mtime):
+        packagesDir = os.path.join(cache.getRepoCacheDir(baseurl), "packages")
+        if not os.path.isdir(packagesDir):
+            os.makedirs(packagesDir)
+        path = os.path.join(packagesDir, name)
+        package = open(path, "wb")
+        package.write(b"\0"*size)
+        package.close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def testEvictLeastRecentlyUsed(self):
+        cache = RbfCache(self.tempDir, 1)
+        old = self.addPackage(cache, "http://repo", "old.rpm", 600*1024, 1000)
+        new = self.addPackage(cache, "http://repo", "new.rpm", 600*1024, 2000)
+        cache.evict()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def testEvictSkippedWhileBuildRunning(self):
+        running = RbfCache(self.tempDir, 1)
+        finishing = RbfCache(self.tempDir, 1)
+        old = self.addPackage(running, "http://repo", "old.rpm", 600*1024, 1000)
+        self.addPackage(running, "http://repo", "new.rpm", 600*1024, 2000)
+        running.beginBuild("repomd.xml")
+        finishing.beginBuild("repomd.xml")
+        finishing.endBuild([], {})
+        self.assertTrue(os.path.exists(old))
+        running.endBuild([], {})
+        self.assertFalse(os.path.exists(old))
+
+    def testSnapshotLookupLocksBuild(self):
+        cache = RbfCache(self.tempDir, 1)
+        cache.hasSnapshot("key")
+        self.assertNotEqual(None, cache.buildLock)
+        cache.unlockBuild()
+        self.assertEqual(None, cache.buildLock)
+
+    def testMetadataPathOfBackend(self):
+        for backend, metadataPath in [(RbfYumBackend("/", True), "repomd.xml"), (RbfDnfBackend("/", True), "repodata/repomd.xml")]:
+            cache = RbfCache(os.path.join(self.tempDir, backend.COMMAND), 1)
+            repoCacheDir = cache.getRepoCacheDir("http://repo")
+            cache.beginBuild(backend.getMetadataPath())
+            self.assertEqual(set(), cache.listMetadata())
+            if not os.path.isdir(os.path.dirname(os.path.join(repoCacheDir, metadataPath))):
+                os.makedirs(os.path.dirname(os.path.join(repoCacheDir, metadataPath)))
+            open(os.path.join(repoCacheDir, metadataPath), "w").close()
+            self.assertEqual(set([cache.getRepoKey("http://repo")]), cache.listMetadata())
+            cache.unlockBuild()
+
+if __name__ == "__main__":
+    unittest.main()
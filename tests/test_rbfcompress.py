@@ -0,0 +1,81 @@
+"""Tests for RbfCompressor"""
+
+import os
+import gzip
+import hashlib
+import unittest
+
+from rbftestutils import RbfTestCase
+from rbfcompress import RbfCompressor, lzma
+
+class RbfCompressorTest(RbfTestCase):
+    """Compresses small partitioned images with small frames"""
+    FRAME_SIZE = 64*1024
+
+    def setUp(self):
+        RbfTestCase.setUp(self)
+        self.imagePath = self.getPath("test.img")
+
+    def writeImage(self, table="msdos"):
+        """4M image with 2 partitions. The first holds random data, the rest of the image is zero"""
+        return self.writePartitionedImage(self.imagePath, 4*1024*1024, table, ["1M", "1M"], [os.urandom(1024*1024 - 1000)])
+
+    def compress(self, formats):
+        compressor = RbfCompressor(self.imagePath, formats, 2, RbfCompressorTest.FRAME_SIZE, 1)
+        compressor.setLabel(1, "/ ext4")
+        return compressor.run(self.imagePath + ".manifest.json")
+
+    def testGzipRoundTrip(self):
+        self.writeImage()
+        manifest = self.compress(["gz"])
+        compressed = gzip.open(self.imagePath + ".gz", "rb")
+        self.assertEqual(self.readFile(self.imagePath), compressed.read())
+        compressed.close()
+        self.assertEqual(64, len(manifest["artifacts"][0]["frames"]))
+
+    def testXzRoundTrip(self):
+        if lzma == None:
+            self.skipTest("No lzma Module")
+        self.writeImage()
+        self.compress(["xz"])
+        self.assertEqual(self.readFile(self.imagePath), lzma.decompress(self.readFile(self.imagePath + ".xz")))
+
+    def testReadFrame(self):
+        if lzma == None:
+            self.skipTest("No lzma Module")
+        layout = self.writeImage()
+        manifest = self.compress(["gz", "xz"])
+        data = self.readFile(self.imagePath)
+        dataOffset = layout[0][3]*512 + RbfCompressorTest.FRAME_SIZE + 10
+        zeroOffset = 3*1024*1024 + 10
+        for suffix in [".gz", ".xz"]:
+            frame = RbfCompressor(self.imagePath, []).readFrame(self.imagePath + suffix, manifest, dataOffset)
+            frameBegin = dataOffset//RbfCompressorTest.FRAME_SIZE*RbfCompressorTest.FRAME_SIZE
+            self.assertEqual(data[frameBegin:frameBegin + RbfCompressorTest.FRAME_SIZE], frame)
+            # All zero frames share one compressed frame
+            frame = RbfCompressor(self.imagePath, []).readFrame(self.imagePath + suffix, manifest, zeroOffset)
+            self.assertEqual(b"\0"*RbfCompressorTest.FRAME_SIZE, frame)
+
+    def testManifest(self):
+        self.writeImage()
+        manifest = self.compress(["gz"])
+        data = self.readFile(self.imagePath)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), manifest["sha256"])
+        self.assertEqual([1, 2], [p["number"] for p in manifest["partitions"]])
+        self.assertEqual("/ ext4", manifest["partitions"][0]["label"])
+        for partition in manifest["partitions"]:
+            self.assertEqual(hashlib.sha256(data[partition["offset"]:partition["offset"] + partition["size"]]).hexdigest(), partition["sha256"])
+        self.assertEqual(hashlib.sha256(self.readFile(self.imagePath + ".gz")).hexdigest(), manifest["artifacts"][0]["sha256"])
+
+    def testGptPartitions(self):
+        layout = self.writeImage("gpt")
+        image = open(self.imagePath, "rb")
+        partitions = RbfCompressor(self.imagePath, []).readPartitions(image)
+        image.close()
+        self.assertEqual([(p[0], p[3]*512, (p[4] - p[3] + 1)*512) for p in layout], partitions)
+
+    def testUnknownFormat(self):
+        self.assertRaises(ValueError, RbfCompressor, self.imagePath, ["bz2"])
+
+if __name__ == "__main__":
+    unittest.main()
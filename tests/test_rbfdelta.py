@@ -0,0 +1,58 @@
+"""Tests for RbfDelta"""
+
+import os
+import unittest
+
+from rbftestutils import RbfTestCase
+from rbfdelta import RbfDelta
+
+class RbfDeltaTest(RbfTestCase):
+    """Creates & applies deltas between small partitioned images"""
+    IMAGE_SIZE = 8*1024*1024
+
+    def setUp(self):
+        RbfTestCase.setUp(self)
+        self.oldPath = self.getPath("old.img")
+        self.newPath = self.getPath("new.img")
+        self.outPath = self.getPath("out.img")
+        self.deltaPath = self.getPath("new.delta")
+
+    def writeImages(self, oldSizes, oldContents, newSizes, newContents, newTable="msdos"):
+        self.writePartitionedImage(self.oldPath, RbfDeltaTest.IMAGE_SIZE, "msdos", oldSizes, oldContents)
+        self.writePartitionedImage(self.newPath, RbfDeltaTest.IMAGE_SIZE, newTable, newSizes, newContents)
+        RbfDelta(self.oldPath, self.newPath).create(self.deltaPath)
+
+    def testRoundTrip(self):
+        root = os.urandom(1024*1024)
+        changed = root[0:8192] + os.urandom(4096) + root[12288:]
+        self.writeImages(["2M", "2M"], [root, os.urandom(4096)], ["2M", "2M", "1M"], [changed, os.urandom(4096), b"\0"*4096])
+        RbfDelta(self.oldPath, self.outPath).apply(self.deltaPath)
+        self.assertEqual(self.readFile(self.newPath), self.readFile(self.outPath))
+        self.assertTrue(os.path.getsize(self.deltaPath) < 64*1024)
+
+    def testMovedAndGrownPartitions(self):
+        boot = os.urandom(512*1024)
+        root = os.urandom(1024*1024)
+        self.writeImages(["1M", "2M"], [boot, root], ["2M", "3M"], [boot, root[4096:] + root[0:4096]], "gpt")
+        RbfDelta(self.oldPath, self.outPath).apply(self.deltaPath)
+        self.assertEqual(self.readFile(self.newPath), self.readFile(self.outPath))
+        self.assertTrue(os.path.getsize(self.deltaPath) < 64*1024)
+
+    def testWrongOldImage(self):
+        self.writeImages(["2M"], [os.urandom(4096)], ["2M"], [os.urandom(4096)])
+        self.writePartitionedImage(self.oldPath, RbfDeltaTest.IMAGE_SIZE, "msdos", ["2M"], [os.urandom(4096)])
+        self.assertRaises(ValueError, RbfDelta(self.oldPath, self.outPath).apply, self.deltaPath)
+
+    def testTruncatedDelta(self):
+        self.writeImages(["2M"], [os.urandom(4096)], ["2M"], [os.urandom(4096)])
+        delta = open(self.deltaPath, "r+b")
+        delta.truncate(os.path.getsize(self.deltaPath) - 10)
+        delta.close()
+        self.assertRaises(ValueError, RbfDelta(self.oldPath, self.outPath).apply, self.deltaPath)
+
+    def testApplyInPlaceRefused(self):
+        self.writeImages(["2M"], [os.urandom(4096)], ["2M"], [os.urandom(4096)])
+        self.assertRaises(ValueError, RbfDelta(self.oldPath, self.oldPath).apply, self.deltaPath)
+
+if __name__ == "__main__":
+    unittest.main()
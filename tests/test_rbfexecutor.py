@@ -0,0 +1,208 @@
+"""Tests for RbfExecutor"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbfexecutor import RbfStage, RbfExecutor
+
+class RbfExecutorTest(unittest.TestCase):
+    """Runs small stage graphs writing marker files in a temp directory"""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tempDir = tempfile.mkdtemp()
+        self.stageDir = os.path.join(self.tempDir, "stages")
+        self.checkpointPath = os.path.join(self.tempDir, "checkpoint.json")
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempDir)
+
+    def getExecutor(self, jobs=4):
+        executor = RbfExecutor(self.stageDir, jobs, "")
+        executor.setCheckpoint(self.checkpointPath, {})
+        executor.loadCheckpoint(self.checkpointPath)
+        return executor
+
+    def addStage(self, executor, name, inputs, command, interactive=False):
+        stage = executor.addStage(RbfStage(name, inputs, [name], interactive))
+        stage.write("echo " + name + " >> " + os.path.join(self.tempDir, "ran") + "\n" + command + "\n")
+        return stage
+
+    def getRan(self):
+        if not os.path.exists(os.path.join(self.tempDir, "ran")):
+            return []
+        ranFile = open(os.path.join(self.tempDir, "ran"))
+        ran = ranFile.read().split()
+        ranFile.close()
+        os.remove(os.path.join(self.tempDir, "ran"))
+        return ran
+
+    def getEntry(self, executor, name):
+        return [e for e in executor.report if e["stage"] == name][-1]
+
+    def testDependencyOrder(self):
+        executor = self.getExecutor()
+        self.addStage(executor, "a", [], "true")
+        self.addStage(executor, "b", ["a"], "true")
+        self.addStage(executor, "c", ["b"], "true")
+        self.assertEqual(0, executor.run())
+        self.assertEqual(["a", "b", "c"], self.getRan())
+
+    def testUnknownInput(self):
+        executor = self.getExecutor()
+        self.assertRaises(ValueError, executor.addStage, RbfStage("a", ["missing"], ["a"]))
+
+    def testResumeAfterFailedStage(self):
+        marker = os.path.join(self.tempDir, "fixed")
+        for attempt in range(0, 2):
+            executor = self.getExecutor()
+            self.addStage(executor, "a", [], "true")
+            self.addStage(executor, "b", ["a"], "[ -e " + marker + " ] || exit 205")
+            self.addStage(executor, "c", ["b"], "true")
+            if attempt == 0:
+                self.assertEqual(205, executor.run())
+                self.assertEqual("b", executor.failedStage)
+                self.assertEqual(["a", "b"], self.getRan())
+                open(marker, "w").close()
+            else:
+                self.assertEqual(0, executor.run())
+                self.assertEqual(["b", "c"], self.getRan())
+
+    def testChangedStageRerunsDependents(self):
+        for command in ["true", "echo changed"]:
+            executor = self.getExecutor()
+            self.addStage(executor, "a", [], "true")
+            self.addStage(executor, "b", ["a"], command)
+            self.addStage(executor, "c", ["b"], "true")
+            self.assertEqual(0, executor.run())
+        self.assertEqual(["a", "b", "c", "b", "c"], self.getRan())
+
+    def testUsedFileChangeRerunsStage(self):
+        usedPath = os.path.join(self.tempDir, "board.sh")
+        for contents in ["a", "a", "b"]:
+            usedFile = open(usedPath, "w")
+            usedFile.write(contents)
+            usedFile.close()
+            executor = self.getExecutor()
+            self.addStage(executor, "a", [], "true")
+            self.addStage(executor, "board", ["a"], "true").addPath(usedPath)
+            self.assertEqual(0, executor.run())
+        self.assertEqual(["a", "board", "board"], self.getRan())
+
+    def testRerunStageNeverRestored(self):
+        for attempt in range(0, 2):
+            executor = self.getExecutor()
+            stage = self.addStage(executor, "mount", [], "true")
+            stage.rerun = True
+            self.addStage(executor, "b", ["mount"], "true")
+            self.assertEqual(0, executor.run())
+        self.assertEqual(["mount", "b", "mount"], self.getRan())
+
+    def testCheckpointData(self):
+        executor = RbfExecutor(self.stageDir, 1, "")
+        self.assertEqual(None, executor.loadCheckpoint(self.checkpointPath))
+        executor.setCheckpoint(self.checkpointPath, {"uuids": ["1234"]})
+        self.addStage(executor, "a", [], "true")
+        self.assertEqual(0, executor.run())
+        self.assertEqual({"uuids": ["1234"]}, RbfExecutor(self.stageDir, 1, "").loadCheckpoint(self.checkpointPath))
+
+    def testWarnedStageRerunsOnResume(self):
+        for attempt in range(0, 2):
+            executor = self.getExecutor()
+            self.addStage(executor, "a", [], "true")
+            self.addStage(executor, "b", ["a"], "exit 213").setPolicy(RbfStage.WARN)
+            self.addStage(executor, "c", ["a"], "exit " + str(207 - attempt*207))
+            executor.run()
+            self.assertEqual([{"stage": "b", "exitCode": 213}], executor.warnings)
+        self.assertEqual(["a", "b", "b", "c", "c"], sorted(self.getRan()))
+
+    def testRetryPolicy(self):
+        counter = os.path.join(self.tempDir, "counter")
+        executor = self.getExecutor()
+        self.addStage(executor, "a", [], "echo x >> " + counter + "; [ $(wc -l < " + counter + ") -ge 3 ] || exit 1").setPolicy(RbfStage.RETRY, 2, 0)
+        self.assertEqual(0, executor.run())
+        self.assertEqual([1, 2, 3], [e["attempt"] for e in executor.report])
+
+    def testInteractiveStageRunsAloneWhenReady(self):
+        executor = self.getExecutor()
+        self.addStage(executor, "x", [], "true")
+        self.addStage(executor, "slow", [], "sleep 0.5")
+        self.addStage(executor, "prompt", ["x"], "sleep 0.2", True)
+        self.addStage(executor, "later", ["x"], "true")
+        self.assertEqual(0, executor.run())
+        slow = self.getEntry(executor, "slow")
+        prompt = self.getEntry(executor, "prompt")
+        later = self.getEntry(executor, "later")
+        self.assertTrue(prompt["start"] >= slow["start"] + slow["wallTime"] - 0.01)
+        self.assertTrue(later["start"] >= prompt["start"] + prompt["wallTime"] - 0.01)
+
+    def testMetricsOnlyForStagesRunAlone(self):
+        grown = os.path.join(self.tempDir, "grown")
+        open(grown, "w").close()
+        executor = RbfExecutor(self.stageDir, 4, "", {"grownBytes": lambda: os.path.getsize(grown)})
+        self.addStage(executor, "alone", [], "head -c 1000 /dev/zero >> " + grown)
+        self.addStage(executor, "left", ["alone"], "head -c 10 /dev/zero >> " + grown + "; sleep 0.3")
+        self.addStage(executor, "right", ["alone"], "head -c 10 /dev/zero >> " + grown + "; sleep 0.3")
+        self.assertEqual(0, executor.run())
+        self.assertEqual(1000, self.getEntry(executor, "alone")["grownBytes"])
+        self.assertFalse("overlapped" in self.getEntry(executor, "alone"))
+        for name in ["left", "right"]:
+            self.assertTrue(self.getEntry(executor, name)["overlapped"])
+            self.assertFalse("grownBytes" in self.getEntry(executor, name))
+            self.assertTrue("writtenBytes" in self.getEntry(executor, name))
+
+    def testMetricOnlySampledForItsStages(self):
+        sampled = []
+        def counter():
+            sampled.append(True)
+            return len(sampled)
+        executor = RbfExecutor(self.stageDir, 1, "", {"counted": counter}, {"counted": ["download"]})
+        self.addStage(executor, "a", [], "true")
+        self.addStage(executor, "download", ["a"], "true")
+        self.assertEqual(0, executor.run())
+        self.assertEqual(2, len(sampled))
+        self.assertFalse("counted" in self.getEntry(executor, "a"))
+        self.assertEqual(1, self.getEntry(executor, "download")["counted"])
+
+    def testStageLogs(self):
+        executor = self.getExecutor()
+        self.addStage(executor, "a", [], "echo output of a")
+        self.assertEqual(0, executor.run())
+        stageLog = open(os.path.join(self.stageDir, "a.log"))
+        self.assertTrue("output of a" in stageLog.read())
+        stageLog.close()
+
+    def testInteractiveStageLogs(self):
+        executor = self.getExecutor()
+        self.addStage(executor, "prompt", [], "echo output of prompt; exit 209", True)
+        self.assertEqual(209, executor.run())
+        stageLog = open(os.path.join(self.stageDir, "prompt.log"))
+        self.assertTrue("output of prompt" in stageLog.read())
+        stageLog.close()
+
+    def testStageErrorFailsBuild(self):
+        executor = self.getExecutor()
+        self.addStage(executor, "a", [], "true")
+        self.addStage(executor, "b", ["a"], "true")
+        def runStage(stage):
+            raise ValueError("Broken")
+        executor.runStage = runStage
+        self.assertEqual(-1, executor.run())
+        self.assertEqual("a", executor.failedStage)
+
+    def testFailingMetricSampledAsZero(self):
+        def broken():
+            raise ValueError("Broken")
+        executor = RbfExecutor(self.stageDir, 4, "", {"broken": broken})
+        self.addStage(executor, "a", [], "true")
+        self.assertEqual(0, executor.run())
+        self.assertEqual((0, 0), (executor.report[0]["broken"], executor.active))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests for RbfFlasher & RbfMultiFlasher"""
+
+import os
+import unittest
+
+from rbftestutils import RbfTestCase
+from rbfoutput import RbfBlockMap
+from rbfflash import RbfFlasher, RbfMultiFlasher
+
+class RbfFlasherTest(RbfTestCase):
+    """Flashes a small mapped image to existing files standing in for devices"""
+
+    def setUp(self):
+        RbfTestCase.setUp(self)
+        self.imagePath = self.getPath("test.img")
+        self.bmapPath = self.imagePath + ".bmap"
+        self.devicePath = self.getPath("device")
+        self.writeImage(self.devicePath, 0, {})
+        self.writeImage(self.imagePath, 2*1024*1024, {0: os.urandom(4096), 7: os.urandom(3*4096), 300: os.urandom(10)})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.write(self.bmapPath)
+
+    def corrupt(self, path, offset):
+        """Flips the bits of byte at offset"""
+        f = open(path, "r+b")
+        f.seek(offset)
+        data = bytearray(f.read(1))
+        f.seek(offset)
+        f.write(bytearray([data[0] ^ 0xff]))
+        f.close()
+
+    def testFlashToFile(self):
+        RbfFlasher(self.imagePath, self.devicePath, self.bmapPath, None, True).flash()
+        self.assertEqual(self.readFile(self.imagePath), self.readFile(self.devicePath))
+
+    def testOnlyMappedBlocksWritten(self):
+        self.writeImage(self.devicePath, 0, {0: b"\xff"*(2*1024*1024)})
+        RbfFlasher(self.imagePath, self.devicePath, self.bmapPath, None, True).flash()
+        image = self.readFile(self.imagePath)
+        device = self.readFile(self.devicePath)
+        self.assertEqual(image[0:4096], device[0:4096])
+        self.assertEqual(image[7*4096:10*4096], device[7*4096:10*4096])
+        self.assertEqual(b"\xff"*4096, device[4096:8192])
+
+    def testZeroBlocksOverwritten(self):
+        data = self.writeImage(self.imagePath, 0, {0: os.urandom(4096) + b"\0"*(2*1024*1024 - 8192) + os.urandom(4096)})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.write(self.bmapPath)
+        self.writeImage(self.devicePath, 0, {0: b"\xff"*(2*1024*1024)})
+        RbfFlasher(self.imagePath, self.devicePath, self.bmapPath, None, True).flash()
+        self.assertEqual(data, self.readFile(self.devicePath))
+
+    def testVerifyDetectsCorruptedDevice(self):
+        flasher = RbfFlasher(self.imagePath, self.devicePath, self.bmapPath, None, True)
+        flasher.flash()
+        self.corrupt(self.devicePath, 8*4096)
+        self.assertRaises(ValueError, flasher.verify)
+
+    def testChangedImageRefused(self):
+        self.corrupt(self.imagePath, 100)
+        self.assertRaises(ValueError, RbfFlasher(self.imagePath, self.devicePath, self.bmapPath).flash)
+
+    def testMissingDeviceRefused(self):
+        devicePath = self.getPath("missing")
+        self.assertRaises(ValueError, RbfFlasher(self.imagePath, devicePath, self.bmapPath, None, True).flash)
+        self.assertFalse(os.path.exists(devicePath))
+
+    def testFileRefusedWithoutAllowFile(self):
+        self.assertRaises(ValueError, RbfFlasher(self.imagePath, self.devicePath, self.bmapPath).flash)
+        self.assertEqual(0, os.path.getsize(self.devicePath))
+
+    def testCharacterDeviceRefused(self):
+        self.assertRaises(ValueError, RbfFlasher(self.imagePath, os.devnull, self.bmapPath, None, True).checkDevice)
+
+    def testMultiFlash(self):
+        devicePaths = [self.getPath("device" + str(i)) for i in range(0, 3)]
+        for devicePath in devicePaths:
+            self.writeImage(devicePath, 0, {})
+        results = RbfMultiFlasher(self.imagePath, devicePaths, self.bmapPath, None, True).flash()
+        image = self.readFile(self.imagePath)
+        for devicePath in devicePaths:
+            self.assertEqual(None, results[devicePath]["error"])
+            self.assertEqual(image, self.readFile(devicePath))
+
+    def testMultiFlashDropsFailedDevice(self):
+        devicePaths = [self.devicePath, self.getPath(os.path.join("missing", "device"))]
+        results = RbfMultiFlasher(self.imagePath, devicePaths, None, None, True).flash()
+        self.assertEqual(None, results[devicePaths[0]]["error"])
+        self.assertTrue(results[devicePaths[1]]["error"].startswith("Device Not Found"))
+        self.assertEqual(self.readFile(self.imagePath), self.readFile(devicePaths[0]))
+
+    def testMultiFlashHook(self):
+        results = RbfMultiFlasher(self.imagePath, [self.devicePath], self.bmapPath, ["false"], True).flash()
+        self.assertTrue(results[self.devicePath]["error"].startswith("Flash Hook Failed"))
+
+    def testDuplicateDevices(self):
+        self.assertRaises(ValueError, RbfMultiFlasher, self.imagePath, [self.devicePath, self.devicePath], self.bmapPath)
+
+if __name__ == "__main__":
+    unittest.main()
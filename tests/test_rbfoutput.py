@@ -0,0 +1,90 @@
+"""Tests for RbfBlockMap & sparse images"""
+
+import os
+import struct
+import unittest
+
+from rbftestutils import RbfTestCase
+from rbfoutput import RbfBlockMap, RbfSparseImage
+
+class RbfBlockMapTest(RbfTestCase):
+    """Maps small sparse images with data in a few blocks"""
+
+    def setUp(self):
+        RbfTestCase.setUp(self)
+        self.imagePath = self.getPath("test.img")
+
+    def decodeSparse(self, sparsePath):
+        """Returns raw image of Android sparse image, like simg2img"""
+        sparse = open(sparsePath, "rb")
+        header = struct.unpack(RbfSparseImage.HEADER_FORMAT, sparse.read(struct.calcsize(RbfSparseImage.HEADER_FORMAT)))
+        self.assertEqual(RbfSparseImage.MAGIC, header[0])
+        blockSize, blocks, chunks = header[5:8]
+        data = b""
+        for i in range(0, chunks):
+            chunkType, reserved, chunkBlocks, totalSize = struct.unpack(RbfSparseImage.CHUNK_FORMAT, sparse.read(struct.calcsize(RbfSparseImage.CHUNK_FORMAT)))
+            if chunkType == RbfSparseImage.CHUNK_RAW:
+                data = data + sparse.read(chunkBlocks*blockSize)
+            elif chunkType == RbfSparseImage.CHUNK_FILL:
+                data = data + sparse.read(4)*(chunkBlocks*blockSize//4)
+            else:
+                self.assertEqual(RbfSparseImage.CHUNK_DONT_CARE, chunkType)
+                data = data + b"\0"*(chunkBlocks*blockSize)
+        sparse.close()
+        self.assertEqual(blocks*blockSize, len(data))
+        return data
+
+    def testMapSkipsOnlyHoles(self):
+        self.writeImage(self.imagePath, 1024*1024, {3: b"a"*4096, 10: b"b"*4096*2 + b"\0"*4096 + b"c", 20: b"\0"*4096})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        self.assertEqual([(3, 3), (10, 13), (20, 20)], [(r[0], r[1]) for r in blockMap.ranges])
+        self.assertEqual(6, blockMap.getMappedBlocksCount())
+
+    def testWriteLoad(self):
+        self.writeImage(self.imagePath, 1024*1024 + 100, {5: b"a"*100, 256: b"b"*100})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.write(self.imagePath + ".bmap")
+        loaded = RbfBlockMap(self.imagePath)
+        loaded.load(self.imagePath + ".bmap")
+        self.assertEqual((blockMap.imageSize, blockMap.blockSize, blockMap.ranges), (loaded.imageSize, loaded.blockSize, loaded.ranges))
+        self.assertEqual(257, loaded.getBlocksCount())
+
+    def testCorruptedBmap(self):
+        self.writeImage(self.imagePath, 1024*1024, {5: b"a"})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.write(self.imagePath + ".bmap")
+        bmapFile = open(self.imagePath + ".bmap")
+        bmap = bmapFile.read().replace("> 5 <", "> 6 <")
+        bmapFile.close()
+        bmapFile = open(self.imagePath + ".bmap", "w")
+        bmapFile.write(bmap)
+        bmapFile.close()
+        self.assertRaises(ValueError, RbfBlockMap(self.imagePath).load, self.imagePath + ".bmap")
+
+    def testSparseImage(self):
+        data = self.writeImage(self.imagePath, 1024*1024 + 100, {0: os.urandom(5000), 100: os.urandom(4096), 256: b"x"*100})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.writeSparse(self.imagePath + ".simg")
+        decoded = self.decodeSparse(self.imagePath + ".simg")
+        self.assertEqual(data, decoded[0:len(data)])
+        self.assertEqual(b"\0"*(len(decoded) - len(data)), decoded[len(data):])
+        self.assertTrue(os.path.getsize(self.imagePath + ".simg") < 5*4096)
+
+    def testSparseImageFillsZeroBlocks(self):
+        data = self.writeImage(self.imagePath, 1024*1024, {0: b"\0"*4096*3 + b"a"*4096})
+        blockMap = RbfBlockMap(self.imagePath)
+        blockMap.map()
+        blockMap.writeSparse(self.imagePath + ".simg")
+        sparse = open(self.imagePath + ".simg", "rb")
+        sparse.seek(struct.calcsize(RbfSparseImage.HEADER_FORMAT))
+        chunk = struct.unpack(RbfSparseImage.CHUNK_FORMAT, sparse.read(struct.calcsize(RbfSparseImage.CHUNK_FORMAT)))
+        sparse.close()
+        self.assertEqual((RbfSparseImage.CHUNK_FILL, 3), (chunk[0], chunk[2]))
+        self.assertEqual(data, self.decodeSparse(self.imagePath + ".simg"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for RbfPrefetcher"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rbfprefetch
+from rbfprefetch import RbfPrefetcher
+
+class RbfPrefetcherTest(unittest.TestCase):
+    """Downloads from file:// repos with hand written metadata in a temp directory"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.repoDir = os.path.join(self.tempDir, "repo")
+        self.packagesDir = os.path.join(self.tempDir, "packages")
+        self.baseurl = "file://" + self.repoDir + "/"
+        os.makedirs(os.path.join(self.repoDir, "repodata"))
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempDir)
+
+    def writeRepo(self, packages, checksums):
+        """packages is Dict of file name -> contents. checksums is Dict of file name -> sha256 in the metadata"""
+        for name in packages:
+            package = open(os.path.join(self.repoDir, name), "wb")
+            package.write(packages[name])
+            package.close()
+        primary = open(os.path.join(self.repoDir, "repodata", "primary.xml"), "w")
+        primary.write('<metadata xmlns="http://linux.duke.edu/metadata/common">\n')
+        for name in packages:
+            primary.write('<package><location href="' + name + '"/>')
+            if name in checksums:
+                primary.write('<checksum type="sha256">' + checksums[name] + '</checksum>')
+            primary.write('</package>\n')
+        primary.write('</metadata>\n')
+        primary.close()
+        repomd = open(os.path.join(self.repoDir, "repodata", "repomd.xml"), "w")
+        repomd.write('<repomd xmlns="http://linux.duke.edu/metadata/repo"><data type="primary"><location href="repodata/primary.xml"/></data></repomd>\n')
+        repomd.close()
+
+    def prefetch(self, names):
+        prefetcher = RbfPrefetcher(2, 0)
+        prefetcher.addRepo(self.baseurl, self.packagesDir)
+        reportPath = os.path.join(self.tempDir, "prefetch.json")
+        ret = prefetcher.run([self.baseurl + name for name in names], reportPath)
+        reportFile = open(reportPath)
+        report = json.load(reportFile)
+        reportFile.close()
+        return ret, report
+
+    def sha256(self, data):
+        return hashlib.sha256(data).hexdigest()
+
+    def testDownloadAndCache(self):
+        self.writeRepo({"a.rpm": b"a"*100}, {"a.rpm": self.sha256(b"a"*100)})
+        ret, report = self.prefetch(["a.rpm"])
+        self.assertTrue(ret)
+        self.assertEqual((1, 100, []), (report["downloaded"], report["bytes"], report["unverified"]))
+        ret, report = self.prefetch(["a.rpm"])
+        self.assertEqual((0, 1), (report["downloaded"], report["cached"]))
+
+    def testChecksumMismatchLeavesNoPartFile(self):
+        self.writeRepo({"a.rpm": b"a"*100}, {"a.rpm": self.sha256(b"b")})
+        ret, report = self.prefetch(["a.rpm"])
+        self.assertFalse(ret)
+        self.assertEqual("Checksum Mismatch", report["failed"][0]["error"])
+        self.assertEqual([], os.listdir(self.packagesDir))
+
+    def testPackageWithoutChecksumRejected(self):
+        self.writeRepo({"a.rpm": b"a", "b.rpm": b"b"}, {"a.rpm": self.sha256(b"a")})
+        ret, report = self.prefetch(["a.rpm", "b.rpm"])
+        self.assertFalse(ret)
+        self.assertEqual([{"url": self.baseurl + "b.rpm", "error": "No Checksum In Repo Metadata"}], report["failed"])
+
+    def testRepoWithoutChecksumsUnverified(self):
+        self.writeRepo({"a.rpm": b"a"}, {})
+        ret, report = self.prefetch(["a.rpm"])
+        self.assertTrue(ret)
+        self.assertEqual([self.baseurl + "a.rpm"], report["unverified"])
+
+    def testInterruptedDownloadRemovesPartFile(self):
+        self.writeRepo({"a.rpm": b"a"}, {"a.rpm": self.sha256(b"a")})
+        closed = []
+        class Interrupted():
+            def read(self, size):
+                raise ValueError("Interrupted")
+            def close(self):
+                closed.append(True)
+        prefetcher = RbfPrefetcher(1, 1)
+        prefetcher.addRepo(self.baseurl, self.packagesDir)
+        prefetcher.loadChecksums(self.baseurl)
+        urlopen = rbfprefetch.urlopen
+        rbfprefetch.urlopen = lambda url, timeout: Interrupted()
+        try:
+            result = prefetcher.download(self.baseurl + "a.rpm")
+        finally:
+            rbfprefetch.urlopen = urlopen
+        self.assertEqual((RbfPrefetcher.FAILED, "Interrupted"), (result[1], result[3]))
+        self.assertEqual([True, True], closed)
+        self.assertEqual([], os.listdir(self.packagesDir))
+
+if __name__ == "__main__":
+    unittest.main()
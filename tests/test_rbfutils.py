@@ -0,0 +1,73 @@
+"""Tests for RbfPartitionTable"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rbfutils import RbfPartitionTable
+from rbfcompress import RbfCompressor
+
+class RbfPartitionTableTest(unittest.TestCase):
+    """Plans & writes tables into small sparse images & reads them back"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.imagePath = os.path.join(self.tempDir, "test.img")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def writeTable(self, table, align, sizes):
+        image = open(self.imagePath, "wb")
+        image.truncate(64*1024*1024)
+        image.close()
+        partitionTable = RbfPartitionTable("64M", table, align)
+        for size in sizes:
+            partitionTable.addPartition(size, "ext4")
+        return partitionTable.write(self.imagePath)
+
+    def readTable(self):
+        image = open(self.imagePath, "rb")
+        partitions = RbfCompressor(self.imagePath, []).readPartitions(image)
+        image.close()
+        return partitions
+
+    def testGptSmallAlignmentSkipsEntries(self):
+        layout = self.writeTable("gpt", "4K", ["8M", "8M"])
+        self.assertTrue(min([p[3] for p in layout]) >= 34)
+        self.assertEqual(layout[0][3] % 8, 0)
+        self.assertEqual([(1, layout[0][3]*512, 8*1024*1024), (2, layout[1][3]*512, 8*1024*1024)], self.readTable())
+
+    def testGptDefaultAlignment(self):
+        layout = self.writeTable("gpt", "1M", ["8M"])
+        self.assertEqual(2048, layout[0][3])
+
+    def testGptExtendedRejected(self):
+        partitionTable = RbfPartitionTable("64M", "gpt")
+        partitionTable.addPartition("8M", "ext4", "extended")
+        self.assertRaises(ValueError, partitionTable.plan)
+
+    def testMsdosEbrChain(self):
+        layout = self.writeTable("msdos", "1M", ["8M"]*6)
+        self.assertEqual(["primary"]*3 + ["extended"] + ["logical"]*3, [p[1] for p in layout])
+        expected = [(p[0], p[3]*512, (p[4] - p[3] + 1)*512) for p in layout if p[1] != "extended"]
+        self.assertEqual(expected, self.readTable())
+        self.assertEqual([1, 2, 3, 5, 6, 7], [p[0] for p in self.readTable()])
+
+    def testTooLarge(self):
+        partitionTable = RbfPartitionTable("64M", "msdos")
+        partitionTable.addPartition("64M", "ext4")
+        self.assertRaises(ValueError, partitionTable.plan)
+
+    def testTooManyPrimary(self):
+        partitionTable = RbfPartitionTable("64M", "msdos")
+        for i in range(0, 4):
+            partitionTable.addPartition("8M", "ext4")
+        partitionTable.addPartition("1M", "ext4", "extended")
+        self.assertRaises(ValueError, partitionTable.plan)
+
+if __name__ == "__main__":
+    unittest.main()